@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class FblocatieConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "fblocatie"
+
+    def ready(self):
+        from fblocatie import signals  # noqa: F401
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from fblocatie.models import Adres, calc_lat_lon_from_geometries
+
+
+class Command(BaseCommand):
+    help = (
+        "Derive the latitude, longitude and map url of adressen from their RD coordinates, "
+        "with one coordinate transformation per batch of adressen."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Update all adressen with RD coordinates, also those with lat/lon.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of adressen updated at once.")
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        adressen = Adres.objects.filter(rd_x__isnull=False, rd_y__isnull=False).order_by("pk")
+        if not kwargs["all"]:
+            adressen = adressen.filter(Q(lat__isnull=True) | Q(lon__isnull=True))
+        adressen = adressen.only("pk", "rd_x", "rd_y", "lat", "lon", "map_url")
+
+        updated = 0
+        last_pk = 0
+        while batch := list(adressen.filter(pk__gt=last_pk)[:batch_size]):
+            self.update_coordinates(batch)
+            updated += len(batch)
+            last_pk = batch[-1].pk
+
+        self.stdout.write(f"Updated the coordinates of {updated} adressen.")
+
+    @staticmethod
+    def update_coordinates(adressen: list):
+        """Set lat/lon and the map url of adressen with RD coordinates, with a single transformation and query"""
+        for adres, pnt in zip(adressen, calc_lat_lon_from_geometries([(adres.rd_x, adres.rd_y) for adres in adressen])):
+            adres.set_lat_lon(pnt)
+        Adres.objects.bulk_update(adressen, ["lat", "lon", "map_url"])
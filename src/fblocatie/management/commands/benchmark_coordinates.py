@@ -0,0 +1,67 @@
+import random
+import time
+
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+
+from fblocatie.models import LAT_LON_CACHE_SIZE, _calc_lat_lon, calc_lat_lon_from_geometries, calc_lat_lon_from_geometry
+
+# RD coordinates of the area of Amsterdam
+RD_X_RANGE = (110000, 135000)
+RD_Y_RANGE = (475000, 495000)
+
+
+def calc_lat_lon_uncached(rd_x, rd_y) -> dict:
+    """calc_lat_lon_from_geometry as it was before the transformation was cached: a new transformation per point"""
+    point_wgs84 = Point(rd_x, rd_y, srid=28992).transform(4326, clone=True)
+    return {"lat": point_wgs84.y, "lon": point_wgs84.x}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the transformation of RD coordinates to latitude and longitude, as done by Adres.save(): "
+        "with a new transformation per point, with the cached transformation, for remembered coordinates "
+        "and for all points in one batch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--points",
+            type=int,
+            default=1000,
+            help=f"Number of coordinates to transform, at most {LAT_LON_CACHE_SIZE} to measure remembered coordinates.",
+        )
+
+    def handle(self, *args, **kwargs):
+        if kwargs["points"] < 1:
+            raise CommandError("--points must be at least 1.")
+
+        coordinates = self.generate_coordinates(kwargs["points"])
+        self.stdout.write(f"{kwargs['points']} points")
+        self.stdout.write(f"{'transform':>10}  {'seconds':>8}  {'us/point':>9}  {'speedup':>8}")
+
+        _calc_lat_lon.cache_clear()
+        results = []
+        baseline = None
+        for name, transform in (
+            ("uncached", lambda: [calc_lat_lon_uncached(rd_x, rd_y) for rd_x, rd_y in coordinates]),
+            ("cached", lambda: [calc_lat_lon_from_geometry(rd_x, rd_y) for rd_x, rd_y in coordinates]),
+            ("remembered", lambda: [calc_lat_lon_from_geometry(rd_x, rd_y) for rd_x, rd_y in coordinates]),
+            ("batch", lambda: calc_lat_lon_from_geometries(coordinates)),
+        ):
+            started = time.perf_counter()
+            results.append(transform())
+            duration = time.perf_counter() - started
+            baseline = baseline or duration
+            self.stdout.write(
+                f"{name:>10}  {duration:>8.3f}  {duration / len(coordinates) * 1e6:>9.1f}  {baseline / duration:>7.1f}x"
+            )
+
+        if any(result != results[0] for result in results):
+            raise CommandError("The transformations give different results.")
+
+    @staticmethod
+    def generate_coordinates(count: int) -> list[tuple[float, float]]:
+        """Return `count` random RD coordinates in Amsterdam, the same for every run"""
+        generator = random.Random(count)
+        return [(generator.uniform(*RD_X_RANGE), generator.uniform(*RD_Y_RANGE)) for _ in range(count)]
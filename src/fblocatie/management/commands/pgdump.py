@@ -1,17 +1,109 @@
+import hashlib
+import mimetypes
 import os
-import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tempfile import SpooledTemporaryFile
 
+from django.apps import apps
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
 from django.utils.module_loading import import_string as get_storage_class
 
-from import_export_csv.exporter import fetch_locations_for_export, get_csv_response
+from import_export_csv.exporter import fetch_locations_for_export, get_export_columns, iter_csv, iter_csv_shards
+
+# Apps of which all tables are included in the dump
+DUMP_APPS = ["fblocatie", "referentie_tabellen"]
+# Table dumps larger than this are spooled to disk instead of memory
+SPOOL_SIZE = 8 * 1024 * 1024
+# Size of the blocks that are read from a table dump when writing it to the ZIP
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def get_dump_models() -> list:
+    """Return the models of which the table is dumped, including the auto created many to many tables"""
+    return [
+        model
+        for app_label in DUMP_APPS
+        for model in apps.get_app_config(app_label).get_models(include_auto_created=True)
+        if model._meta.managed and not model._meta.proxy
+    ]
+
+
+def dump_table(model, snapshot: str | None = None) -> tuple:
+    """Dump the table of `model` as CSV with PostgreSQL COPY, over the database connection of the current thread.
+
+    With a `snapshot` (see pg_export_snapshot) the table is read as it was in that snapshot, so tables that are
+    dumped over separate connections are consistent with each other. The connection is closed afterwards, as this
+    runs in a worker thread. Returns a tuple of the table name, the dump file, the number of rows and the duration.
+    """
+    started = time.monotonic()
+    table = model._meta.db_table
+    output = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            if snapshot:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot])
+            sql = "COPY (SELECT * FROM {} ORDER BY {}) TO STDOUT WITH (FORMAT csv, HEADER)".format(
+                connection.ops.quote_name(table), connection.ops.quote_name(model._meta.pk.column)
+            )
+            cursor.copy_expert(sql, output)
+            rows = cursor.rowcount
+    except Exception:
+        output.close()
+        raise
+    finally:
+        connection.close()
+
+    output.seek(0)
+    return table, output, rows, time.monotonic() - started
+
+
+class _StreamSink:
+    """Unseekable binary stream that collects what is written until it is taken"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def iter_zip(files):
+    """Yield a ZIP archive of the (name, binary file) pairs in `files` as chunks of bytes, while it is written"""
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, f in files:
+            with archive.open(name, "w", force_zip64=True) as entry:
+                while block := f.read(COPY_BLOCK_SIZE):
+                    entry.write(block)
+                    if chunk := sink.take():
+                        yield chunk
+            if chunk := sink.take():
+                yield chunk
+    # The central directory
+    yield sink.take()
 
 
 class OverwriteStorage:
     """Set storage to pgdump container
     and overwrite existing files instead of using hash postfixes."""
 
+    # Size of the blocks that are staged in a block blob; the maximum that is held in memory during an upload
+    BLOCK_SIZE = 4 * 1024 * 1024
+
     def __init__(self, *args, **kwargs):
         if hasattr(settings, "STORAGES") and "pgdump" in settings.STORAGES:
             storage_class = get_storage_class(settings.STORAGES["pgdump"]["BACKEND"])
@@ -30,47 +122,199 @@ class OverwriteStorage:
             self.storage.delete(name)
         return self.storage.save(name, content)
 
+    def save_stream(self, name, chunks, skip_unchanged=False) -> tuple[int, str, bool]:
+        """Write an iterable of byte chunks to `name`, replacing the existing file.
+
+        The chunks are uploaded while they are generated: as staged blocks of a block blob on Azure storage,
+        or written to a partial file on local file system storage. Only when everything is written, the new content
+        replaces the existing file. With `skip_unchanged` the existing file is kept when it has the same SHA-256 hash
+        as the new content. Returns the number of bytes, the hash and whether the file was replaced.
+        """
+        if hasattr(self.storage, "client"):
+            return self._save_stream_as_blocks(name, chunks, skip_unchanged)
+
+        try:
+            path = self.storage.path(name)
+        except NotImplementedError:
+            raise NotImplementedError(f"{type(self.storage).__name__} does not support streaming uploads")
+        return self._save_stream_to_file(path, chunks, skip_unchanged)
+
+    def _save_stream_as_blocks(self, name, chunks, skip_unchanged=False) -> tuple[int, str, bool]:
+        from azure.core.exceptions import ResourceNotFoundError
+        from azure.storage.blob import ContentSettings
+
+        blob_name = self.storage._get_valid_path(name) if hasattr(self.storage, "_get_valid_path") else name
+        blob_client = self.storage.client.get_blob_client(blob_name)
+
+        block_ids = []
+        size = 0
+        digest = hashlib.sha256()
+
+        def stage(data: bytes):
+            # Block ids must have the same length for all blocks of a blob
+            block_id = f"{len(block_ids):08d}"
+            blob_client.stage_block(block_id, data)
+            block_ids.append(block_id)
+
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer.extend(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+            if len(buffer) >= self.BLOCK_SIZE:
+                stage(bytes(buffer))
+                buffer.clear()
+        if buffer or not block_ids:
+            stage(bytes(buffer))
+
+        sha256 = digest.hexdigest()
+        if skip_unchanged:
+            try:
+                existing_sha256 = blob_client.get_blob_properties().metadata.get("sha256")
+            except ResourceNotFoundError:
+                existing_sha256 = None
+            if existing_sha256 == sha256:
+                # Blocks that are never committed are removed by Azure storage
+                return size, sha256, False
+
+        # Committing the block list replaces the existing blob in one step
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        blob_client.commit_block_list(
+            block_ids, content_settings=ContentSettings(content_type=content_type), metadata={"sha256": sha256}
+        )
+        return size, sha256, True
+
+    @staticmethod
+    def _save_stream_to_file(path, chunks, skip_unchanged=False) -> tuple[int, str, bool]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write next to the existing file and swap it in when complete, so readers never see a partial file
+        partial_path = f"{path}.partial"
+        size = 0
+        digest = hashlib.sha256()
+        try:
+            with open(partial_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+
+            sha256 = digest.hexdigest()
+            if skip_unchanged and os.path.exists(path):
+                with open(path, "rb") as f:
+                    if hashlib.file_digest(f, "sha256").hexdigest() == sha256:
+                        return size, sha256, False
+            os.replace(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        return size, sha256, True
+
 
 class Command(BaseCommand):
     help = "Export all models in specified apps to CSV files, compress them into a ZIP, and upload to Azure Storage."
 
-    TMP_DIRECTORY = "/tmp/tmp_pgdump"
     EXPORT_FILE_NAME = "all_locations.csv"
+    DUMP_FILE_NAME = "pgdump.zip"
+    # Number of locations that are fetched from the database at a time
+    CHUNK_SIZE = 500
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--columns",
+            nargs="+",
+            help="Only export these CSV columns (default: all columns).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of tables that are dumped at the same time, each over its own database connection.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of processes that build the locations CSV export in parallel, in shards of pandcodes.",
+        )
 
     def handle(self, *args, **kwargs):
-        self.create_export_csv()
+        columns = kwargs.get("columns")
+        try:
+            get_export_columns(columns)
+        except ValueError as e:
+            raise CommandError(e)
+        workers = kwargs.get("workers", 4)
+        if workers < 1:
+            raise CommandError("--workers must be at least 1.")
+        processes = kwargs.get("processes", 1)
+        if processes < 1:
+            raise CommandError("--processes must be at least 1.")
 
-        self.upload_to_blob()
+        self.upload_export_csv(columns, processes=processes)
 
-        self.remove_dump()
+        self.upload_dump_zip(workers=workers)
 
         self.stdout.write("Data dump completed successfully.")
 
-    def create_export_csv(self):
+    def upload_export_csv(self, columns=None, processes=1):
         """
-        Build the locations CSV export.
+        Stream the locations CSV export, optionally limited to the given columns, straight into Azure Storage.
+        With multiple processes the export is built in parallel shards.
         """
-        os.makedirs(self.TMP_DIRECTORY, exist_ok=True)
+        storage = OverwriteStorage()
 
-        csv_data = get_csv_response(fetch_locations_for_export()).content
-        file_path = os.path.join(self.TMP_DIRECTORY, self.EXPORT_FILE_NAME)
-        with open(file_path, "wb") as f:
-            f.write(csv_data)
+        started = time.monotonic()
+        locations = fetch_locations_for_export(columns)
+        if processes > 1:
+            chunks = (data for _, data in iter_csv_shards(locations, columns, processes=processes))
+        else:
+            chunks = iter_csv(locations.iterator(chunk_size=self.CHUNK_SIZE), columns, chunk_rows=self.CHUNK_SIZE)
+        # Consumers re-ingest the export when it changes, so an unchanged export is not uploaded again
+        size, sha256, uploaded = storage.save_stream(self.EXPORT_FILE_NAME, chunks, skip_unchanged=True)
+        duration = time.monotonic() - started
+
+        if uploaded:
+            self.stdout.write(
+                f"Successfully uploaded {self.EXPORT_FILE_NAME} ({size} bytes, sha256 {sha256}) to Azure Storage "
+                f"in {duration:.2f}s."
+            )
+        else:
+            self.stdout.write(
+                f"Skipped upload of {self.EXPORT_FILE_NAME}: unchanged ({size} bytes, sha256 {sha256}), "
+                f"checked in {duration:.2f}s."
+            )
 
-    def upload_to_blob(self):
+    def upload_dump_zip(self, workers=4):
         """
-        Upload the export CSV file to Azure Storage.
+        Dump all tables of the dump apps to CSV files, and stream them as a ZIP into Azure Storage.
         """
         storage = OverwriteStorage()
 
-        file_path = os.path.join(self.TMP_DIRECTORY, self.EXPORT_FILE_NAME)
-        with open(file_path, "rb") as f:
-            storage.save_without_postfix(name=self.EXPORT_FILE_NAME, content=f)
+        started = time.monotonic()
+        size, _, _ = storage.save_stream(
+            self.DUMP_FILE_NAME, iter_zip(self.iter_table_dumps(get_dump_models(), workers))
+        )
 
-        self.stdout.write(f"Successfully uploaded {self.EXPORT_FILE_NAME} to Azure Storage.")
+        self.stdout.write(
+            f"Successfully uploaded {self.DUMP_FILE_NAME} ({size} bytes) to Azure Storage "
+            f"in {time.monotonic() - started:.2f}s."
+        )
 
-    def remove_dump(self):
+    def iter_table_dumps(self, models, workers=4):
         """
-        Remove the temporary directory and its contents.
+        Dump the tables of `models` concurrently and yield (file name, dump file) pairs as the dumps complete.
         """
-        shutil.rmtree(self.TMP_DIRECTORY)
+        # Share the snapshot of this transaction with the workers, so all tables are dumped at the same moment
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute("SELECT pg_export_snapshot()")
+            snapshot = cursor.fetchone()[0]
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(dump_table, model, snapshot) for model in models]
+                for future in as_completed(futures):
+                    table, dump, rows, duration = future.result()
+                    self.stdout.write(f"Dumped {table}: {rows} rows in {duration:.2f}s")
+                    with dump:
+                        yield f"{table}.csv", dump
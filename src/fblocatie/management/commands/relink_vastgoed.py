@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from fblocatie.models import relink_vastgoed
+
+
+class Command(BaseCommand):
+    help = (
+        "Link every locatie to the vastgoed at its adres, or to no vastgoed when its adres has none, "
+        "with a single UPDATE."
+    )
+
+    def handle(self, *args, **kwargs):
+        relinked = relink_vastgoed()
+        self.stdout.write(f"Linked {relinked} locaties to the vastgoed at their adres.")
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("fblocatie", "0004_remove_locatie_beveiliging_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="locatie",
+            name="import_fingerprint",
+            field=models.CharField(blank=True, default="", editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("fblocatie", "0005_locatie_import_fingerprint"),
+    ]
+
+    operations = [
+        # New pandcodes are allocated from a sequence that starts after the highest pandcode, see reserve_pandcodes()
+        migrations.RunSQL(
+            sql=[
+                "CREATE SEQUENCE fblocatie_locatie_pandcode_seq OWNED BY fblocatie_locatie.pandcode",
+                "SELECT setval('fblocatie_locatie_pandcode_seq', COALESCE(MAX(pandcode), 0) + 1, false) "
+                "FROM fblocatie_locatie",
+            ],
+            reverse_sql="DROP SEQUENCE fblocatie_locatie_pandcode_seq",
+        ),
+    ]
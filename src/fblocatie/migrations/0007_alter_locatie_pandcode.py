@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("fblocatie", "0006_locatie_pandcode_sequence"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="locatie",
+            name="pandcode",
+            field=models.IntegerField(blank=True, primary_key=True, serialize=False, verbose_name="FB pandcode"),
+        ),
+    ]
@@ -1,7 +1,11 @@
+import struct
+import threading
+from functools import lru_cache
+
+from django.contrib.gis.gdal import CoordTransform, OGRGeometry, SpatialReference
 from django.contrib.gis.geos import Point
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Max
+from django.db import connection, models
 from django.utils import timezone
 
 from fblocatie.querysets import LocatieQuerySet
@@ -29,17 +33,143 @@ class TimeStampMixin(models.Model):
         abstract = True
 
 
+def _differs(field, value, loaded) -> bool:
+    """Whether a field value differs from its loaded value, also when it is set as text like "1990" by an import"""
+    if value == loaded:
+        return False
+    try:
+        return field.to_python(value) != loaded
+    except ValidationError:
+        return True
+
+
+class ChangeTrackingMixin(models.Model):
+    """Remember the field values loaded from the database, so saves write only the fields that changed.
+
+    save() of a loaded object updates only the changed fields, and the fields that are set automatically like
+    updated_at, and does nothing when no field changed. Objects that are not loaded from the database are saved as
+    usual. With update_fields, only the changed fields among them are considered.
+    """
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_values()
+        return instance
+
+    def _remember_values(self, fields=None):
+        """Remember the current values of `fields`, names or attnames, or of all fields"""
+        # Deferred fields are not in __dict__ until they are loaded or set
+        values = {
+            field.attname: self.__dict__[field.attname]
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__ and (fields is None or field.name in fields or field.attname in fields)
+        }
+        if fields is None:
+            self._loaded_values = values
+        else:
+            self.__dict__.setdefault("_loaded_values", {}).update(values)
+
+    def changed_fields(self) -> list[str] | None:
+        """Names of the fields that differ from the values loaded from the database, None for a new object"""
+        loaded = self.__dict__.get("_loaded_values")
+        if loaded is None or self._state.adding:
+            return None
+        return [
+            field.name
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
+            and (field.attname not in loaded or _differs(field, self.__dict__[field.attname], loaded[field.attname]))
+        ]
+
+    def loaded_value(self, attname: str):
+        """The value of a field as loaded from the database, None when it was not loaded"""
+        return self.__dict__.get("_loaded_values", {}).get(attname)
+
+    def has_changed(self, *fields: str) -> bool:
+        """Whether any of `fields`, or any field at all without `fields`, differs from the loaded values"""
+        changed = self.changed_fields()
+        if changed is None:
+            return True
+        return any(name in changed for name in fields) if fields else bool(changed)
+
+    def save(self, *args, **kwargs):
+        changed = self.changed_fields()
+        # A changed primary key is saved as a new row, like without change tracking
+        if changed is not None and self._meta.pk.name not in changed:
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None:
+                changed = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if field.name in changed and (field.name in update_fields or field.attname in update_fields)
+                ]
+            if not changed:
+                return
+            if update_fields is None:
+                auto_now = [field.name for field in self._meta.concrete_fields if getattr(field, "auto_now", False)]
+                kwargs["update_fields"] = [*changed, *auto_now]
+        super().save(*args, **kwargs)
+        self._remember_values()
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        # Reading a deferred field refreshes only that field; the changes of the other fields are kept
+        self._remember_values(fields)
+
+
+# The coordinate transformations of the threads of this process
+_transformations = threading.local()
+
+# Number of recently calculated coordinates that are remembered
+LAT_LON_CACHE_SIZE = 4096
+
+
+def rd_to_wgs84() -> CoordTransform:
+    """Return the transformation from srid=28992 (RD-coordinates) to srid=4326 (WGS coordinates).
+
+    Building a transformation is much slower than transforming a point, so it is built once. GDAL transformations
+    cannot be used by multiple threads at the same time, so every thread has its own.
+    """
+    transformation = getattr(_transformations, "rd_to_wgs84", None)
+    if transformation is None:
+        transformation = CoordTransform(SpatialReference(28992), SpatialReference(4326))
+        _transformations.rd_to_wgs84 = transformation
+    return transformation
+
+
+@lru_cache(maxsize=LAT_LON_CACHE_SIZE)
+def _calc_lat_lon(rd_x: float, rd_y: float) -> tuple[float, float]:
+    point_wgs84 = Point(rd_x, rd_y, srid=28992).transform(rd_to_wgs84(), clone=True)
+    return point_wgs84.y, point_wgs84.x
+
+
 def calc_lat_lon_from_geometry(rd_x, rd_y) -> dict:
     """Calculate Point latitude and longitude (srid=4326; WGS coordinates)
-    from given geometry in srid=28992 (RD-coordinates)"""
-    point_rd = Point(rd_x, rd_y, srid=28992)
-    point_wgs84 = point_rd.transform(4326, clone=True)
-    return {"lat": point_wgs84.y, "lon": point_wgs84.x}
+    from given geometry in srid=28992 (RD-coordinates); recent results are remembered"""
+    lat, lon = _calc_lat_lon(float(rd_x), float(rd_y))
+    return {"lat": lat, "lon": lon}
+
+
+def calc_lat_lon_from_geometries(coordinates: list) -> list[dict]:
+    """Calculate the latitude and longitude (srid=4326) of a list of (rd_x, rd_y) coordinates (srid=28992),
+    like calc_lat_lon_from_geometry, with a single coordinate transformation for all points"""
+    if not coordinates:
+        return []
+    # A MultiPoint in little endian WKB: the byte order, type and number of points, then every point
+    wkb = struct.pack("<BII", 1, 4, len(coordinates))
+    wkb += b"".join(struct.pack("<BIdd", 1, 1, rd_x, rd_y) for rd_x, rd_y in coordinates)
+    points = OGRGeometry(memoryview(wkb), srs=28992)
+    points.transform(rd_to_wgs84())
+    return [{"lat": lat, "lon": lon} for lon, lat in points.coords]
 
 
 # voor toekomstige BAG koppeling:
 # in nummeraanduidingen zijn de koppelsleutels voor verblijfobjecten en openbareuruimtes te vinden
-class Adres(models.Model):
+class Adres(ChangeTrackingMixin):
     pand_id = models.CharField(verbose_name="Pand identificatie", max_length=16, blank=True, null=True)
     vot_id = models.CharField(verbose_name="Verblijfsobject identificatie", max_length=16, blank=True, null=True)
     straat = models.CharField(max_length=80)  ##kan opgehaald via /v1/bag/openbareruimtes
@@ -81,7 +211,11 @@ class Adres(models.Model):
                     f"{self.huisnummertoevoeging if self.huisnummertoevoeging else ''} bestaat al in de database."
                 )
 
-    def save(self, *args, **kwargs):
+    def normalize(self, coordinates: bool = True):
+        """Capitalize the names, validate the BAG ids and derive lat/lon from the RD coordinates; called by save().
+
+        Without `coordinates` lat/lon are not derived, see normalize_many().
+        """
         if self.straat:
             self.straat = self.straat[0].upper() + self.straat[1:]
         if self.woonplaats:
@@ -93,15 +227,38 @@ class Adres(models.Model):
         if self.vot_id and self.vot_id[4:6] != "01":  # positie 5-6: 01 = een verblijfsobject
             raise ValidationError(f"{self.vot_id} is geen geldige verblijfsobjectidentificatie.")
 
-        if None not in (self.rd_x, self.rd_y):
+        if coordinates and None not in (self.rd_x, self.rd_y):
             rd_x = float(self.rd_x)
             rd_y = float(self.rd_y)
-            pnt = calc_lat_lon_from_geometry(rd_x, rd_y)
-            self.lat = round(pnt["lat"], 6)
-            self.lon = round(pnt["lon"], 6)
-            self.map_url = f"https://data.amsterdam.nl/data/geozoek?center={self.lat}%2C{self.lon}&locatie={self.lat}%2C{self.lon}+&zoom=10"
+            self.set_lat_lon(calc_lat_lon_from_geometry(rd_x, rd_y))
+
+    def set_lat_lon(self, pnt: dict):
+        """Set lat/lon and the map url from a result of calc_lat_lon_from_geometry"""
+        self.lat = round(pnt["lat"], 6)
+        self.lon = round(pnt["lon"], 6)
+        self.map_url = f"https://data.amsterdam.nl/data/geozoek?center={self.lat}%2C{self.lon}&locatie={self.lat}%2C{self.lon}+&zoom=10"
+
+    @staticmethod
+    def normalize_many(adressen: list):
+        """Normalize adressen like normalize(), with the RD coordinates of all adressen transformed at once"""
+        with_coordinates = []
+        for adres in adressen:
+            adres.normalize(coordinates=False)
+            if None not in (adres.rd_x, adres.rd_y):
+                with_coordinates.append(adres)
+
+        coordinates = [(float(adres.rd_x), float(adres.rd_y)) for adres in with_coordinates]
+        for adres, pnt in zip(with_coordinates, calc_lat_lon_from_geometries(coordinates)):
+            adres.set_lat_lon(pnt)
 
+    def save(self, *args, **kwargs):
+        # The coordinates are only transformed again when they changed
+        self.normalize(coordinates=self.has_changed("rd_x", "rd_y") or self.lat is None)
+        if not self.has_changed():
+            return
         super().save(*args, **kwargs)
+        # The locaties at this adres differ from their last import now
+        Locatie.objects.filter(adres=self).exclude(import_fingerprint="").update(import_fingerprint="")
 
     def __str__(self):
         adres_str = f"{self.straat} {str(self.huisnummer)}"
@@ -115,7 +272,7 @@ class Adres(models.Model):
 
 
 # voor toekomstige koppeling met Gemeentelijk Vastgoed
-class Vastgoed(models.Model):
+class Vastgoed(ChangeTrackingMixin):
     adres = models.OneToOneField(Adres, on_delete=models.CASCADE, related_name="adres_extension")
     GV_key = models.CharField(verbose_name="GV(planon)", blank=True, null=True)
     gv_id = models.CharField(verbose_name="BRES ID", blank=True, null=True)
@@ -164,6 +321,18 @@ class Vastgoed(models.Model):
         on_delete=models.RESTRICT,
     )
 
+    def save(self, *args, **kwargs):
+        if not self.has_changed():
+            return
+        # Locatie.save() only looks up the vastgoed when the adres of the locatie changes, so the locaties at a new
+        # adres of this vastgoed, and at the adres it had before, are linked here
+        adressen = {self.adres_id, self.loaded_value("adres_id")} if self.has_changed("adres") else set()
+        super().save(*args, **kwargs)
+        if adressen:
+            relink_vastgoed(adressen - {None})
+        # The locaties at the adres of this vastgoed differ from their last import now
+        Locatie.objects.filter(adres_id=self.adres_id).exclude(import_fingerprint="").update(import_fingerprint="")
+
     def __str__(self):
         # return f"{self.GV_key} {self.bezit}"
         return f"Vastgoed {self.adres}"
@@ -172,18 +341,64 @@ class Vastgoed(models.Model):
         verbose_name_plural = "Vastgoed"
 
 
-# Auto generate a new pandcode based on the current highest in the database
+def relink_vastgoed(adres_ids=None) -> int:
+    """Link locaties to the vastgoed at their adres, or to no vastgoed when there is none, with a single UPDATE.
+
+    Only the locaties at `adres_ids` are linked when given. Returns the number of locaties whose vastgoed changed.
+    """
+    sql = (
+        f"UPDATE {Locatie._meta.db_table} AS locatie SET vastgoed_id = vastgoed.id "
+        f"FROM {Adres._meta.db_table} AS adres "
+        f"LEFT JOIN {Vastgoed._meta.db_table} AS vastgoed ON vastgoed.adres_id = adres.id "
+        "WHERE locatie.adres_id = adres.id AND locatie.vastgoed_id IS DISTINCT FROM vastgoed.id"
+    )
+    params = []
+    if adres_ids is not None:
+        sql += " AND adres.id = ANY(%s)"
+        params.append(list(adres_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+# New pandcodes are allocated from this sequence, which starts after the highest pandcode, see migration 0006
+PANDCODE_SEQUENCE = "fblocatie_locatie_pandcode_seq"
+
+
+def reserve_pandcodes(count: int) -> list[int]:
+    """Allocate `count` new pandcodes with one query, for example for the locaties of a bulk create.
+
+    Concurrent callers get different pandcodes. Pandcodes that are allocated but not used are not handed out again,
+    so there can be gaps between pandcodes.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)", [PANDCODE_SEQUENCE, count])
+        return [pandcode for (pandcode,) in cursor.fetchall()]
+
+
+def advance_pandcode_sequence(pandcode: int):
+    """Continue the sequence after `pandcode` when it would hand it out later, after a locatie is created with a
+    pandcode that was chosen instead of allocated"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT setval(%s, %s) FROM {PANDCODE_SEQUENCE} WHERE %s >= last_value + is_called::int",
+            [PANDCODE_SEQUENCE, pandcode, pandcode],
+        )
+
+
+# Auto generate a new pandcode, for a locatie that is saved without one
 def compute_pandcode() -> int:
-    return (Locatie.objects.aggregate(Max("pandcode"))["pandcode__max"] or 0) + 1
+    return reserve_pandcodes(1)[0]
 
 
-class Locatie(TimeStampMixin):
+class Locatie(ChangeTrackingMixin, TimeStampMixin):
     """
     Base class for the location
     """
 
+    # Allocated by save() when left empty, not as a default, which would allocate one for every unsaved Locatie()
     pandcode = models.IntegerField(
-        verbose_name="FB pandcode", primary_key=True, default=compute_pandcode
+        verbose_name="FB pandcode", primary_key=True, blank=True
     )  # leidend voor externe leveranciers en datakoppelingen
     afkorting = models.CharField(
         verbose_name="Afkorting", max_length=15
@@ -215,6 +430,8 @@ class Locatie(TimeStampMixin):
     routecode = models.CharField(
         max_length=15, default="FB"
     )  # dit zijn opties in de huidige db?? gek - location_property_id=14???
+    # Hash of the values of the last bulk import, to skip unchanged rows; cleared when the locatie is saved otherwise
+    import_fingerprint = models.CharField(max_length=64, blank=True, default="", editable=False)
     pand_directies = models.ManyToManyField(Directie, related_name="locatie_pand_directies")
     voorzieningen = models.ManyToManyField(Voorziening, blank=True)
     contracten = models.ManyToManyField(Contract, blank=True)
@@ -302,18 +519,12 @@ class Locatie(TimeStampMixin):
         if self.vastgoed and self.vastgoed.adres != self.adres:
             raise ValidationError("Het geselecteerde vastgoed behoort niet tot het geselecteerde adres.")
 
-    def save(self, *args, **kwargs):
+    def normalize(self):
+        """Set the default and derived field values; called by save() and by bulk imports that bypass it"""
         # set default routecode
         if self.routecode is None:
             self.routecode = "FB"
 
-        # Automatic set the vastgoed based on the adres else None
-        if self.adres:
-            try:
-                self.vastgoed = Vastgoed.objects.get(adres=self.adres)
-            except Vastgoed.DoesNotExist:
-                self.vastgoed = None
-
         # set archief datum if not set yet
         if self.archief == "True" and self.archief_datum is None:
             self.archief_datum = timezone.now()
@@ -325,7 +536,27 @@ class Locatie(TimeStampMixin):
             case "nee" | "Nee":
                 self.ambtenaar = "False"
 
+    def save(self, *args, **kwargs):
+        # Automatic set the vastgoed based on the adres else None, when either changed
+        if self.has_changed("adres", "vastgoed") and self.adres:
+            try:
+                self.vastgoed = Vastgoed.objects.get(adres=self.adres)
+            except Vastgoed.DoesNotExist:
+                self.vastgoed = None
+
+        self.normalize()
+        # The locatie differs from its last import now, also when only some fields are saved (update_or_create)
+        if self.has_changed():
+            self.import_fingerprint = ""
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = [*kwargs["update_fields"], "import_fingerprint"]
+        # A pandcode that is chosen instead of allocated has to be skipped by the sequence
+        chosen_pandcode = self._state.adding and self.pandcode is not None
+        if self.pandcode is None:
+            self.pandcode = compute_pandcode()
         super().save(*args, **kwargs)
+        if chosen_pandcode:
+            advance_pandcode_sequence(self.pandcode)
 
     class Meta:
         ordering = ["pandcode"]
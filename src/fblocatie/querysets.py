@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from decimal import Decimal, InvalidOperation
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db.models import Q
 from django.db.models.query import QuerySet
@@ -16,6 +17,7 @@ from fblocatie.utils.search_mappings import (
     PERSON_LOOKUP_PREFIXES,
     TEXT_FIELD_LOOKUPS,
 )
+from shared.singleflight import single_flight, single_flight_key
 
 TRUE_STRINGS = {"ja", "j", "true", "1", "yes", "y"}
 FALSE_STRINGS = {"nee", "n", "false", "0", "no"}
@@ -129,5 +131,27 @@ class LocatieQuerySet(QuerySet):
             qs = qs.distinct()
         return qs
 
+    def coalesced_search_filter(self, params: dict, user: User) -> QuerySet:
+        """Return the same locations as `search_filter`, with concurrent identical searches computed once.
+
+        The matching pandcodes are shared between workers through `single_flight` for
+        settings.SINGLE_FLIGHT_SEARCH_TIMEOUT seconds; searches without a search term are cheap and are not coalesced.
+        """
+        if not _extract_search_term(params):
+            return self.search_filter(params=params, user=user)
+
+        key = single_flight_key(
+            "locatie-search",
+            base_query=str(self.values_list("pk").query),
+            params={name: params.get(name) for name in ("property", "search", "archive")},
+            is_staff=user.is_staff,
+        )
+        pandcodes = single_flight(
+            key,
+            lambda: list(self.search_filter(params=params, user=user).values_list("pk", flat=True)),
+            timeout=settings.SINGLE_FLIGHT_SEARCH_TIMEOUT,
+        )
+        return self.filter(pk__in=pandcodes)
+
     def archive_filter(self, archive: str = "") -> QuerySet:
         return self.filter(filter_on_archive(archive))
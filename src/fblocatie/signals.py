@@ -0,0 +1,38 @@
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from fblocatie.models import Locatie
+
+# The many to many fields of Locatie by their through model
+LOCATIE_MANY_TO_MANY = {field.remote_field.through: field for field in Locatie._meta.local_many_to_many}
+
+
+def _changed_pandcodes(sender, instance, action: str, reverse: bool, pk_set) -> set:
+    """The pandcodes of the locaties whose links change, from either side of the relation"""
+    if not reverse:
+        return {instance.pk} if action == "post_clear" or pk_set else set()
+    if action == "pre_clear":
+        # After the clear, the locaties that were linked are not known anymore
+        field = LOCATIE_MANY_TO_MANY[sender]
+        return set(
+            sender.objects.filter(**{field.m2m_reverse_field_name(): instance}).values_list(
+                field.m2m_field_name(), flat=True
+            )
+        )
+    return set(pk_set or ())
+
+
+@receiver(m2m_changed)
+def locatie_links_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Mark locaties as changed when their many to many links change, like Locatie.save() does for the fields.
+
+    Saving a locatie whose fields did not change writes nothing, so an edit of only its links would otherwise
+    keep the fingerprint of its last import, and the next import would skip the row and keep the edit.
+    """
+    actions = ("pre_clear", "post_add", "post_remove") if reverse else ("post_add", "post_remove", "post_clear")
+    if sender not in LOCATIE_MANY_TO_MANY or action not in actions:
+        return
+    pandcodes = _changed_pandcodes(sender, instance, action, reverse, pk_set)
+    if pandcodes:
+        Locatie.objects.filter(pk__in=pandcodes).update(import_fingerprint="", updated_at=timezone.now())
@@ -26,7 +26,9 @@ class LocatieListView(LoginRequiredMixin, ListView):
             )
         )
         ordering = self.get_ordering()
-        return queryset.search_filter(params=self.request.GET.dict(), user=self.request.user).order_by(ordering)
+        return queryset.coalesced_search_filter(params=self.request.GET.dict(), user=self.request.user).order_by(
+            ordering
+        )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
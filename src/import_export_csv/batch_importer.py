@@ -0,0 +1,458 @@
+import hashlib
+import itertools
+import json
+import logging
+from collections import defaultdict, deque
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F
+
+from fblocatie.models import Adres, Locatie, Vastgoed, advance_pandcode_sequence, relink_vastgoed
+from import_export_csv.importer import (
+    ADRES_MATCH_KEYS,
+    LOCATIE_MATCH_KEYS,
+    VASTGOED_MATCH_KEYS,
+    ImporterProcessCSV,
+)
+from import_export_csv.mappings import LOCATIE_MANY_TO_MANY_FIELDS, LOCATIE_REFERENTIE_TABELLEN, VG_REFERENTIE_TABELLEN
+from import_export_csv.stats import ImportStats
+from referentie_tabellen.models import Persoon
+from shared.parallel import fork_map
+
+log = logging.getLogger(__name__)
+
+# Maximum number of rows that are written together
+CHUNK_SIZE = 500
+
+# Fields that must have a value to write a row in bulk. Rows without them are imported row by row,
+# which reports the same errors as before.
+ADRES_REQUIRED_FIELDS = ["straat", "postcode", "huisnummer", "woonplaats"]
+VASTGOED_REQUIRED_FIELDS = ["bezit_id"]
+LOCATIE_REQUIRED_FIELDS = ["pandcode", "afkorting", "naam", "locatie_soort_id", "dvk_naam_id"]
+
+
+# Part of the fingerprint of imported rows; change it when the same row is imported with other values
+FINGERPRINT_VERSION = 1
+
+
+def _field_names(model, keys) -> list[str]:
+    """Return the model field names for data keys, that can be field names or attnames (bezit_id)"""
+    return [model._meta.get_field(key).name for key in keys]
+
+
+def current_links(field_name: str, pandcodes) -> dict[int, dict[int, int]]:
+    """Load the links of the many to many field `field_name` of locaties with one query.
+
+    Returns {pandcode: {linked id: id of the through table row}}, with an empty dict for locaties without links.
+    """
+    field = Locatie._meta.get_field(field_name)
+    source, target = field.m2m_column_name(), field.m2m_reverse_name()
+
+    links = defaultdict(dict)
+    for pk, pandcode, target_id in field.remote_field.through.objects.filter(
+        **{f"{source}__in": list(pandcodes)}
+    ).values_list("pk", source, target):
+        links[pandcode][target_id] = pk
+    return links
+
+
+def sync_many_to_many(field_name: str, wanted: dict) -> tuple[int, int]:
+    """Set the many to many field `field_name` of locaties to ids, like .set() for every locatie.
+
+    `wanted` maps the pandcode of a locatie to the ids it should be linked to. The current links of all these locaties
+    are loaded with one query; the missing links are added with one bulk_create and the other links removed with one
+    delete. Returns the numbers of added and removed links.
+    """
+    field = Locatie._meta.get_field(field_name)
+    through = field.remote_field.through
+    source, target = field.m2m_column_name(), field.m2m_reverse_name()
+    current = current_links(field_name, wanted)
+
+    added, removed = [], []
+    for pandcode, ids in wanted.items():
+        links, ids = current[pandcode], set(ids)
+        added.extend(through(**{source: pandcode, target: target_id}) for target_id in ids - links.keys())
+        removed.extend(pk for target_id, pk in links.items() if target_id not in ids)
+
+    if added:
+        through.objects.bulk_create(added)
+    if removed:
+        through.objects.filter(pk__in=removed).delete()
+    return len(added), len(removed)
+
+
+class BulkRow:
+    """A row of the import file that is parsed and validated for a bulk write"""
+
+    def __init__(self, index: int, adres: dict, vastgoed: dict, locatie: dict, many_to_many: dict):
+        self.index = index
+        self.adres = adres
+        self.vastgoed = vastgoed
+        self.locatie = locatie
+        self.many_to_many = many_to_many
+        # Computed when the row is parsed, in the parsing process when rows are parsed in parallel
+        self.fingerprint = self.compute_fingerprint()
+        self.existing_adres = None
+        # Fingerprint of the last import of the locatie, see BatchImporter.match_existing()
+        self.stored_fingerprint = None
+        # (section, message) when the row cannot be written in bulk, see BatchImporter.match_existing()
+        self.conflict = None
+        self.adres_obj = None
+        self.vastgoed_obj = None
+        self.locatie_obj = None
+
+    @property
+    def locatie_id(self):
+        return self.locatie["afkorting"]
+
+    def compute_fingerprint(self) -> str:
+        """Hash of the imported values: the mapped fields and the sorted ids of the many to many fields"""
+        values = {
+            "version": FINGERPRINT_VERSION,
+            "adres": self.adres,
+            "vastgoed": self.vastgoed,
+            "locatie": self.locatie,
+            "many_to_many": {field: sorted(set(ids)) for field, ids in self.many_to_many.items()},
+        }
+        # Personen are set as objects, they are identified by their id
+        data = json.dumps(values, sort_keys=True, default=lambda obj: obj.pk)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def keys(self) -> set:
+        """Identifiers of the objects this row writes; rows that share one must be written in file order"""
+        return {
+            ("adres", tuple(self.adres[key] for key in ADRES_MATCH_KEYS)),
+            ("pandcode", self.locatie["pandcode"]),
+            ("naam", self.locatie["naam"]),
+        }
+
+
+# The importer with the loaded lookups, inherited by the processes that parse rows, see BatchImporter.parse_rows()
+_parse_importer = None
+
+
+def _parse_batch(batch: list) -> list:
+    """Parse a batch of (index, row) pairs in a worker process, see BatchImporter.parse_rows()"""
+    parser = BatchImporter(_parse_importer)
+    return [parser.parse_row(index, row)[0] for index, row in batch]
+
+
+class BatchImporter:
+    """Import rows of a CSV file in chunks with set based writes.
+
+    Rows are parsed and validated in memory with the lookups of the ImporterProcessCSV. The Adres, Vastgoed and
+    Locatie objects of a chunk are then written with a few bulk queries. Rows with errors, or that may get errors
+    from the database, are imported row by row with ImporterProcessCSV.main(), so they report the same errors.
+    When a bulk write fails, its rows are imported row by row as well.
+
+    Rows with the same fingerprint as the last import of their locatie are not written at all. Saving a locatie, or
+    its adres or vastgoed, outside the bulk import clears the fingerprint, so the next import writes the row again.
+
+    With multiple `processes`, rows are parsed in a pool of forked processes while the chunks before them are
+    written, see parse_rows().
+
+    The number of objects written per model and the time spent per phase are kept in `stats`.
+    """
+
+    def __init__(self, importer: ImporterProcessCSV | None = None, chunk_size: int = CHUNK_SIZE, processes: int = 1):
+        self.importer = importer if importer is not None else ImporterProcessCSV()
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.stats = ImportStats()
+
+    def import_rows(self, rows):
+        """Import (index, row) pairs and yield (index, locatie_id, errors) for every row, in file order"""
+        chunk = []
+        chunk_keys = set()
+        for index, row, parsed in self.stats.timed("parse", self.parse_rows(rows)):
+            if parsed is None:
+                # Write the rows before this one first, they may touch the same objects
+                yield from self.write_chunk(chunk)
+                chunk, chunk_keys = [], set()
+                yield self.import_row(index, row)
+                continue
+
+            keys = parsed.keys()
+            if len(chunk) >= self.chunk_size or keys & chunk_keys:
+                yield from self.write_chunk(chunk)
+                chunk, chunk_keys = [], set()
+            chunk.append((parsed, row))
+            chunk_keys |= keys
+
+        yield from self.write_chunk(chunk)
+
+    def import_row(self, index: int, row: dict) -> tuple:
+        """Import a single row with ImporterProcessCSV.main()"""
+        importer = self.importer
+        with self.stats.timer("write"):
+            try:
+                importer.main(row)
+            except ValidationError as err:
+                importer.errors["main"] = f"Error in main: {err}"
+
+        for model in ImportStats.MODELS:
+            # The changes of main() are rolled back on an error in main
+            if model in importer.errors or "main" in importer.errors:
+                self.stats.add(model, "failed")
+            elif model in importer.created:
+                self.stats.add(model, "created" if importer.created[model] else "updated")
+        return index, importer.locatie_id, importer.errors
+
+    def parse_rows(self, rows):
+        """Yield (index, row, parsed row or None) for (index, row) pairs, see parse_row().
+
+        With multiple processes, batches of rows are parsed in a pool of forked processes, against a snapshot of the
+        referentie tabellen that is loaded before forking. The batches are taken from `rows` while the parsed rows
+        are consumed, a few batches ahead. The pool closes the database connections of this process, so this cannot
+        be used inside a transaction.
+        """
+        if self.processes <= 1:
+            for index, row in rows:
+                yield index, row, self.parse_row(index, row)[0]
+            return
+
+        referentie_tabellen = VG_REFERENTIE_TABELLEN + LOCATIE_REFERENTIE_TABELLEN + LOCATIE_MANY_TO_MANY_FIELDS
+        self.importer.references.load({model for _, model in referentie_tabellen if model != Persoon})
+        self.importer.personen.load()
+
+        batches = deque()
+
+        def take_batches():
+            rows_iter = iter(rows)
+            while batch := list(itertools.islice(rows_iter, self.chunk_size)):
+                batches.append(batch)
+                yield batch
+
+        # The processes inherit the importer when they are forked, only the rows are sent to them
+        global _parse_importer
+        _parse_importer = self.importer
+        try:
+            for parsed_rows in fork_map(_parse_batch, take_batches(), self.processes):
+                for (index, row), parsed in zip(batches.popleft(), parsed_rows):
+                    yield index, row, parsed
+        finally:
+            _parse_importer = None
+
+    def parse_row(self, index: int, row: dict) -> tuple[BulkRow | None, dict]:
+        """Parse a row for a bulk write.
+
+        Returns the parsed row, or None when the row is to be imported row by row, and the errors found in the row
+        per section (adres, vastgoed, locatie).
+        """
+        importer = self.importer
+        data = dict(row)
+        locatie = importer.get_locatie_data(data)
+        adres = importer.get_adres_data(data)
+        vastgoed = importer.get_vastgoed_data(data)
+
+        errors = {}
+        importer.error_list = []
+        vastgoed = importer.get_referentietabellen_fields(VG_REFERENTIE_TABELLEN, vastgoed)
+        if importer.error_list:
+            errors["vastgoed"], importer.error_list = importer.error_list, []
+        locatie = importer.get_referentietabellen_fields(LOCATIE_REFERENTIE_TABELLEN, locatie)
+        many_to_many = {
+            field: importer._get_many_to_many(string=locatie.pop(field), model=model)
+            for field, model in LOCATIE_MANY_TO_MANY_FIELDS
+            if field in locatie
+        }
+        if importer.error_list:
+            errors["locatie"], importer.error_list = importer.error_list, []
+        if errors:
+            return None, errors
+
+        for section, fields, match_keys, required_fields in (
+            ("adres", adres, ADRES_MATCH_KEYS, ADRES_REQUIRED_FIELDS),
+            ("vastgoed", vastgoed, [], VASTGOED_REQUIRED_FIELDS),
+            ("locatie", locatie, LOCATIE_MATCH_KEYS, LOCATIE_REQUIRED_FIELDS),
+        ):
+            missing = [key for key in match_keys if key not in fields]
+            missing += [key for key in required_fields if key not in missing and fields.get(key) is None]
+            if missing:
+                errors[section] = [f"geen waarde voor {', '.join(missing)}"]
+        if errors:
+            return None, errors
+
+        for section, fields, key in (("adres", adres, "huisnummer"), ("locatie", locatie, "pandcode")):
+            try:
+                fields[key] = int(fields[key])
+            except ValueError:
+                errors[section] = [f"{key} '{fields[key]}' is geen geheel getal"]
+        if errors:
+            return None, errors
+
+        return BulkRow(index, adres, vastgoed, locatie, many_to_many), errors
+
+    def write_chunk(self, chunk: list):
+        """Write the parsed rows of a chunk in bulk and yield their results in file order"""
+        if not chunk:
+            return
+        rows = {parsed.index: row for parsed, row in chunk}
+        with self.stats.timer("resolve"):
+            bulk_rows, single_rows = self.match_existing([parsed for parsed, _ in chunk])
+
+        results = {}
+        unchanged = [parsed for parsed in bulk_rows if parsed.fingerprint == parsed.stored_fingerprint]
+        for parsed in unchanged:
+            results[parsed.index] = (parsed.index, parsed.locatie_id, {})
+        for model in ImportStats.MODELS:
+            self.stats.add(model, "unchanged", len(unchanged))
+        bulk_rows = [parsed for parsed in bulk_rows if parsed.fingerprint != parsed.stored_fingerprint]
+
+        if bulk_rows:
+            try:
+                with transaction.atomic():
+                    with self.stats.timer("write"):
+                        self.write_adressen(bulk_rows)
+                        self.write_vastgoed(bulk_rows)
+                        self.write_locaties(bulk_rows)
+                        self.clear_shared_fingerprints(bulk_rows)
+                        # Like Vastgoed.save(), bulk_create() does not link the other locaties at the adressen
+                        relink_vastgoed({parsed.adres_obj.pk for parsed in bulk_rows})
+                    with self.stats.timer("m2m"):
+                        self.write_many_to_many(bulk_rows)
+            except Exception as e:
+                log.warning(f"Bulk import of {len(bulk_rows)} rows failed, importing them row by row: {e}")
+                single_rows.extend(bulk_rows)
+            else:
+                results.update({parsed.index: (parsed.index, parsed.locatie_id, {}) for parsed in bulk_rows})
+                self.count_written(bulk_rows)
+
+        for parsed in sorted(single_rows, key=lambda parsed: parsed.index):
+            results[parsed.index] = self.import_row(parsed.index, rows[parsed.index])
+
+        for index in sorted(results):
+            yield results[index]
+
+    def count_written(self, parsed_rows: list):
+        """Count the objects of rows written in bulk as created or updated"""
+        for parsed in parsed_rows:
+            existing = {
+                "adres": parsed.existing_adres is not None,
+                "vastgoed": getattr(parsed.existing_adres, "vastgoed_pk", None) is not None,
+                "locatie": parsed.stored_fingerprint is not None,
+            }
+            for model, exists in existing.items():
+                self.stats.add(model, "updated" if exists else "created")
+
+    @staticmethod
+    def match_existing(parsed_rows: list) -> tuple[list, list]:
+        """Find the existing adressen of the rows; return the rows to write in bulk and the rows to import one by one.
+
+        Rows that match multiple adressen, or a pandcode with another afkorting, get an error from the database
+        in the row by row import. The fingerprints of the last import of the locaties are set on the rows, and the
+        existing adressen have the pk of their vastgoed as `vastgoed_pk`.
+        """
+        adressen = defaultdict(list)
+        for adres in Adres.objects.filter(postcode__in={parsed.adres["postcode"] for parsed in parsed_rows}).annotate(
+            vastgoed_pk=F("adres_extension")
+        ):
+            adressen[tuple(getattr(adres, key) for key in ADRES_MATCH_KEYS)].append(adres)
+        afkortingen, fingerprints = {}, {}
+        for pandcode, afkorting, fingerprint in Locatie.objects.filter(
+            pandcode__in=[parsed.locatie["pandcode"] for parsed in parsed_rows]
+        ).values_list("pandcode", "afkorting", "import_fingerprint"):
+            afkortingen[pandcode] = afkorting
+            fingerprints[pandcode] = fingerprint
+
+        bulk_rows, single_rows = [], []
+        for parsed in parsed_rows:
+            matches = adressen[tuple(parsed.adres[key] for key in ADRES_MATCH_KEYS)]
+            afkorting = afkortingen.get(parsed.locatie["pandcode"], parsed.locatie["afkorting"])
+            if len(matches) > 1:
+                parsed.conflict = ("adres", f"het adres komt {len(matches)} keer voor")
+            elif afkorting != parsed.locatie["afkorting"]:
+                parsed.conflict = ("locatie", f"pandcode {parsed.locatie['pandcode']} hoort bij afkorting {afkorting}")
+            if parsed.conflict:
+                single_rows.append(parsed)
+                continue
+            parsed.existing_adres = matches[0] if matches else None
+            parsed.stored_fingerprint = fingerprints.get(parsed.locatie["pandcode"])
+            bulk_rows.append(parsed)
+        return bulk_rows, single_rows
+
+    @staticmethod
+    def _group_by_update_fields(parsed_rows: list, data_attr: str, match_keys: list) -> dict:
+        groups = defaultdict(list)
+        for parsed in parsed_rows:
+            fields = tuple(key for key in getattr(parsed, data_attr) if key not in match_keys)
+            groups[fields].append(parsed)
+        return groups
+
+    def write_adressen(self, parsed_rows: list):
+        """Create the new adressen and update the existing ones, like Adres.objects.update_or_create()"""
+        # Adres has no unique constraint on its match keys, the existing adressen are matched in match_existing
+        for parsed in parsed_rows:
+            if parsed.existing_adres is None:
+                parsed.adres_obj = Adres(**parsed.adres)
+            else:
+                parsed.adres_obj = parsed.existing_adres
+                for key, value in parsed.adres.items():
+                    setattr(parsed.adres_obj, key, value)
+        Adres.normalize_many([parsed.adres_obj for parsed in parsed_rows])
+
+        Adres.objects.bulk_create([parsed.adres_obj for parsed in parsed_rows if parsed.existing_adres is None])
+
+        existing = [parsed for parsed in parsed_rows if parsed.existing_adres is not None]
+        for fields, group in self._group_by_update_fields(existing, "adres", ADRES_MATCH_KEYS).items():
+            if not fields:
+                continue
+            update_fields = _field_names(Adres, fields)
+            # Derived from the RD coordinates by normalize_many(), like Adres.save() does
+            if {"rd_x", "rd_y"} & set(update_fields):
+                update_fields += ["lat", "lon", "map_url"]
+            Adres.objects.bulk_update([parsed.adres_obj for parsed in group], update_fields)
+
+    def write_vastgoed(self, parsed_rows: list):
+        """Create or update the vastgoed of the adressen, like Vastgoed.objects.update_or_create()"""
+        for fields, group in self._group_by_update_fields(parsed_rows, "vastgoed", VASTGOED_MATCH_KEYS).items():
+            for parsed in group:
+                parsed.vastgoed_obj = Vastgoed(adres=parsed.adres_obj, **parsed.vastgoed)
+            Vastgoed.objects.bulk_create(
+                [parsed.vastgoed_obj for parsed in group],
+                update_conflicts=True,
+                unique_fields=VASTGOED_MATCH_KEYS,
+                update_fields=_field_names(Vastgoed, fields),
+            )
+
+    def write_locaties(self, parsed_rows: list):
+        """Create or update the locaties, like Locatie.objects.update_or_create() with Locatie.save()"""
+        for fields, group in self._group_by_update_fields(parsed_rows, "locatie", LOCATIE_MATCH_KEYS).items():
+            for parsed in group:
+                parsed.locatie_obj = Locatie(
+                    adres=parsed.adres_obj,
+                    vastgoed=parsed.vastgoed_obj,
+                    import_fingerprint=parsed.fingerprint,
+                    **parsed.locatie,
+                )
+                parsed.locatie_obj.normalize()
+            # Like update_or_create, only the imported fields and the automatically updated fields are updated
+            update_fields = [*_field_names(Locatie, fields), "adres", "vastgoed", "import_fingerprint", "updated_at"]
+            Locatie.objects.bulk_create(
+                [parsed.locatie_obj for parsed in group],
+                update_conflicts=True,
+                unique_fields=["pandcode"],
+                update_fields=update_fields,
+            )
+        # The pandcodes come from the file, so new pandcodes have to be allocated after them
+        advance_pandcode_sequence(max(parsed.locatie["pandcode"] for parsed in parsed_rows))
+
+    @staticmethod
+    def clear_shared_fingerprints(parsed_rows: list):
+        """Clear the fingerprints of other locaties at the updated adressen, their adres or vastgoed may have changed"""
+        adressen = [parsed.existing_adres for parsed in parsed_rows if parsed.existing_adres is not None]
+        if adressen:
+            Locatie.objects.filter(adres__in=adressen).exclude(
+                pandcode__in=[parsed.locatie["pandcode"] for parsed in parsed_rows]
+            ).update(import_fingerprint="")
+
+    @staticmethod
+    def write_many_to_many(parsed_rows: list):
+        """Set the many to many fields of the locaties, with a few queries per field for the whole chunk"""
+        wanted = defaultdict(dict)
+        for parsed in parsed_rows:
+            for field, ids in parsed.many_to_many.items():
+                wanted[field][parsed.locatie_obj.pandcode] = ids
+        for field, ids in wanted.items():
+            sync_many_to_many(field, ids)
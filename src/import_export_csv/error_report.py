@@ -0,0 +1,120 @@
+import csv
+import io
+import os
+import re
+import uuid
+
+from django.contrib import messages
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+# Import error reports are stored in the default storage in this directory
+ERROR_REPORT_DIRECTORY = "import_errors"
+# Number of error types, and of row numbers per type, in the messages; the report file has all of them
+MESSAGE_GROUPS = 20
+MESSAGE_ROWS = 10
+
+# Part of the row of errors that are not in the adres, vastgoed or locatie, and of rows that are not imported
+SECTION_LABELS = {"main": "rij"}
+SKIPPED = "overgeslagen"
+
+
+def error_type(message: str) -> str:
+    """The type of an error message: its first line, without the quoted values of the row"""
+    # The quotes of a model class, as in "<class 'referentie_tabellen.models.LocatieSoort'>", and of the messages of
+    # a ValidationError, as in "['Ongeldige waarde']", are kept
+    return re.sub(r"(?<!<class )(?<!\[)'[^']*'", "'...'", message.split("\n")[0]).strip()
+
+
+def _describe_rows(rows: list) -> str:
+    described = ", ".join(str(row) for row in rows[:MESSAGE_ROWS])
+    if len(rows) > MESSAGE_ROWS:
+        described += f" en {len(rows) - MESSAGE_ROWS} andere"
+    return described
+
+
+class ImportErrorReport:
+    """The errors of an import, grouped by the part of the row they are in and their type, with the row numbers.
+
+    The parts are adres, vastgoed, locatie, rij and overgeslagen, for rows that are not imported at all. Rows are
+    numbered from 1 for the first row after the header, like the messages of the import.
+    """
+
+    def __init__(self):
+        # {(section, error type): {"level": message level, "example": first message, "rows": [row numbers],
+        # "locaties": [afkortingen]}}
+        self.groups = {}
+        self.rows = set()
+
+    def add(self, row_number: int, section: str, message: str, locatie_id=None, level: int = messages.ERROR):
+        group = self.groups.setdefault(
+            (SECTION_LABELS.get(section, section), error_type(message)),
+            {"level": level, "example": message, "rows": [], "locaties": []},
+        )
+        if row_number not in group["rows"][-1:]:
+            group["rows"].append(row_number)
+            if locatie_id:
+                group["locaties"].append(locatie_id)
+        self.rows.add(row_number)
+
+    def add_skipped(self, row_number: int, reason: str):
+        """Add a row that is not imported at all"""
+        self.add(row_number, SKIPPED, reason, level=messages.WARNING)
+
+    def add_errors(self, row_number: int, locatie_id, errors: dict):
+        """Add the errors of an imported row, {section: error or list of errors}"""
+        for section, section_errors in errors.items():
+            for error in section_errors if isinstance(section_errors, list) else [section_errors]:
+                # Errors of personen are (naam, exception)
+                message = f"'{error[0]}' {error[1]}" if isinstance(error, tuple) else str(error).strip()
+                self.add(row_number, section, message, locatie_id)
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    def messages(self) -> list[tuple[int, str]]:
+        """Summary messages, (level, message), with the most common errors first"""
+        groups = sorted(self.groups.items(), key=lambda item: -len(item[1]["rows"]))
+        result = []
+        for (section, kind), group in groups[:MESSAGE_GROUPS]:
+            rows = group["rows"]
+            label = f"1 rij ({rows[0]})" if len(rows) == 1 else f"{len(rows)} rijen ({_describe_rows(rows)})"
+            if section == SKIPPED:
+                result.append((group["level"], f"{label} niet verwerkt want {kind}"))
+            else:
+                result.append((group["level"], f"{label} met een fout in {section}: {kind}"))
+        if len(groups) > MESSAGE_GROUPS:
+            result.append((messages.ERROR, f"En {len(groups) - MESSAGE_GROUPS} andere soorten fouten."))
+        return result
+
+    def to_csv(self) -> bytes:
+        """The report as a CSV file, a row per type of error"""
+        output = io.StringIO()
+        writer = csv.writer(output, delimiter=";")
+        writer.writerow(["onderdeel", "fout", "aantal", "rijen", "locaties", "voorbeeld"])
+        for (section, kind), group in self.groups.items():
+            writer.writerow(
+                [
+                    section,
+                    kind,
+                    len(group["rows"]),
+                    ", ".join(str(row) for row in group["rows"]),
+                    ", ".join(group["locaties"]),
+                    group["example"],
+                ]
+            )
+        return output.getvalue().encode("utf-8-sig")
+
+    def save(self) -> str:
+        """Store the report in the default storage and return its name, see report_path()"""
+        file_name = default_storage.save(
+            f"{ERROR_REPORT_DIRECTORY}/importfouten_{uuid.uuid4().hex}.csv", ContentFile(self.to_csv())
+        )
+        return os.path.basename(file_name)
+
+
+def report_path(name: str) -> str:
+    """The path in the default storage of a stored report; raises a ValueError for a name that is not a report"""
+    if not re.fullmatch(r"importfouten_\w+\.csv", name):
+        raise ValueError(f"{name} is geen foutenverslag.")
+    return f"{ERROR_REPORT_DIRECTORY}/{name}"
@@ -4,6 +4,8 @@ from django.http import HttpResponse
 from django.utils import timezone
 
 from fblocatie.models import Locatie
+from referentie_tabellen.models import Persoon
+from shared.parallel import fork_map
 
 from .mappings import (
     ADRES_MAPPING,
@@ -15,63 +17,220 @@ from .mappings import (
     VG_REFERENTIE_TABELLEN,
 )
 
+# Number of locations in a shard of a parallel export
+SHARD_ROWS = 1000
+
+EXPORT_ADRES_MAPPING = {**ADRES_MAPPING, **EXPORT_ONLY_ADRES_MAPPING}
+
+# All export columns in the order they appear in the CSV file
+EXPORT_COLUMNS = list(LOCATIE_MAPPING.values()) + list(EXPORT_ADRES_MAPPING.values()) + list(VG_MAPPING.values())
+
 
 def _get_field(obj, field):
     value = getattr(obj, field, None)
     return "" if value is None else value
 
 
-def fetch_locations_for_export():
-    return Locatie.objects.select_related(
-        "adres",
-        "vastgoed",
-        *[field for field, _ in LOCATIE_REFERENTIE_TABELLEN],
-        *[f"vastgoed__{field}" for field, _ in VG_REFERENTIE_TABELLEN],
-    ).prefetch_related(*[field for field, _ in LOCATIE_MANY_TO_MANY_FIELDS])
+def _str_fields(model) -> list[str]:
+    """Return the fields a referentie tabel needs to render itself with str()"""
+    return ["voornaam", "achternaam"] if model is Persoon else ["name"]
+
+
+def get_export_columns(columns=None) -> list[str]:
+    """Return the export columns in file order, limited to `columns` when given.
+
+    Raises a ValueError for columns that are not part of the export.
+    """
+    if not columns:
+        return list(EXPORT_COLUMNS)
+
+    unknown = set(columns) - set(EXPORT_COLUMNS)
+    if unknown:
+        raise ValueError(f"Onbekende kolom(men) voor de export: {', '.join(sorted(unknown))}")
+
+    return [column for column in EXPORT_COLUMNS if column in columns]
+
+
+def fetch_locations_for_export(columns=None):
+    """Return the locations queryset for the export.
+
+    Only the joins, prefetches and SQL columns needed for the selected `columns` are used.
+    """
+    columns = set(get_export_columns(columns))
 
+    many_to_many_fields = [field for field, _ in LOCATIE_MANY_TO_MANY_FIELDS if LOCATIE_MAPPING[field] in columns]
+    locatie_fields = [
+        field
+        for field, column in LOCATIE_MAPPING.items()
+        if column in columns and field not in dict(LOCATIE_MANY_TO_MANY_FIELDS)
+    ]
+    adres_fields = [field for field, column in EXPORT_ADRES_MAPPING.items() if column in columns]
+    vg_fields = [field for field, column in VG_MAPPING.items() if column in columns]
 
-def build_csv_row(locatie) -> dict:
+    select_related = []
+    only_fields = ["pandcode", *locatie_fields]
+
+    for field, model in LOCATIE_REFERENTIE_TABELLEN:
+        if field in locatie_fields:
+            select_related.append(field)
+            only_fields.extend(f"{field}__{str_field}" for str_field in _str_fields(model))
+
+    if adres_fields:
+        select_related.append("adres")
+        only_fields.extend(f"adres__{field}" for field in adres_fields)
+
+    if vg_fields:
+        select_related.append("vastgoed")
+        only_fields.extend(f"vastgoed__{field}" for field in vg_fields)
+        for field, model in VG_REFERENTIE_TABELLEN:
+            if field in vg_fields:
+                select_related.append(f"vastgoed__{field}")
+                only_fields.extend(f"vastgoed__{field}__{str_field}" for str_field in _str_fields(model))
+
+    return Locatie.objects.select_related(*select_related).prefetch_related(*many_to_many_fields).only(*only_fields)
+
+
+def build_csv_row(locatie, columns=None) -> dict:
+    columns = set(get_export_columns(columns))
+    many_to_many_fields = {field for field, _ in LOCATIE_MANY_TO_MANY_FIELDS}
     row = {}
 
     for model_field, csv_column in LOCATIE_MAPPING.items():
-        # Join many to many fields with " | " as separator, for the rest just get the field value
-        if any(model_field == field for field, _ in LOCATIE_MANY_TO_MANY_FIELDS):
-            row[csv_column] = " | ".join(str(item) for item in getattr(locatie, model_field).all())
+        if csv_column not in columns:
+            continue
+        # Join many to many fields with " | " as separator, for the rest just get the field value.
+        # The related items are sorted, without an ORDER BY the database may return them in any order, which would
+        # change the hash of an unchanged export
+        if model_field in many_to_many_fields:
+            items = sorted(getattr(locatie, model_field).all(), key=lambda item: item.pk)
+            row[csv_column] = " | ".join(str(item) for item in items)
         else:
             row[csv_column] = _get_field(locatie, model_field)
 
-    adres = getattr(locatie, "adres", None)
-    for model_field, csv_column in {**ADRES_MAPPING, **EXPORT_ONLY_ADRES_MAPPING}.items():
-        row[csv_column] = _get_field(adres, model_field)
+    # Only touch the related objects when one of their columns is exported; they may not be loaded
+    if columns.intersection(EXPORT_ADRES_MAPPING.values()):
+        adres = getattr(locatie, "adres", None)
+        for model_field, csv_column in EXPORT_ADRES_MAPPING.items():
+            if csv_column in columns:
+                row[csv_column] = _get_field(adres, model_field)
 
-    vastgoed = getattr(locatie, "vastgoed", None)
-    for model_field, csv_column in VG_MAPPING.items():
-        row[csv_column] = _get_field(vastgoed, model_field)
+    if columns.intersection(VG_MAPPING.values()):
+        vastgoed = getattr(locatie, "vastgoed", None)
+        for model_field, csv_column in VG_MAPPING.items():
+            if csv_column in columns:
+                row[csv_column] = _get_field(vastgoed, model_field)
 
     return row
 
 
-def get_csv_response(locations) -> HttpResponse:
+class _ChunkBuffer:
+    """Text stream that collects what is written until it is taken as UTF-8 bytes"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data: str):
+        self.parts.append(data)
+
+    def take(self) -> bytes:
+        data = "".join(self.parts).encode("utf-8")
+        self.parts = []
+        return data
+
+
+def _write_rows(output, locations, columns=None, header=True):
+    """Write the export CSV for `locations` to the text stream `output`, yielding the row count after every row"""
+    export_columns = get_export_columns(columns)
+
+    writer = csv.DictWriter(output, fieldnames=export_columns, delimiter=";")
+    if header:
+        # Add BOM to the file; because otherwise Excel won't know what's happening
+        output.write("\ufeff")
+        writer.writeheader()
+
+    for rows_written, locatie in enumerate(locations, start=1):
+        writer.writerow(build_csv_row(locatie, export_columns))
+        yield rows_written
+
+
+def write_csv(output, locations, columns=None, progress=None) -> int:
+    """Write the export CSV for `locations` to the text stream `output`.
+
+    `progress` is called with the number of rows written after every row.
+    Returns the number of rows written.
+    """
+    rows_written = 0
+    for rows_written in _write_rows(output, locations, columns):
+        if progress is not None:
+            progress(rows_written)
+    return rows_written
+
+
+def iter_csv(locations, columns=None, chunk_rows: int = 500, header=True):
+    """Yield the export CSV for `locations` as chunks of UTF-8 bytes, of `chunk_rows` rows each.
+
+    Pass a queryset `.iterator()` as `locations` to keep the memory use independent of the number of locations.
+    Without `header` only the rows are written, to continue an export.
+    """
+    buffer = _ChunkBuffer()
+    for rows_written in _write_rows(buffer, locations, columns, header):
+        if rows_written % chunk_rows == 0:
+            yield buffer.take()
+
+    # The header and the remaining rows
+    chunk = buffer.take()
+    if chunk:
+        yield chunk
+
+
+def _build_shard(shard) -> tuple[int, bytes]:
+    """Build the CSV rows of the locations in a pandcode range; runs in a forked process"""
+    columns, query, first_pandcode, last_pandcode, header = shard
+
+    locations = fetch_locations_for_export(columns)
+    locations.query = query
+    locations = locations.filter(pandcode__range=(first_pandcode, last_pandcode))
+
+    buffer = _ChunkBuffer()
+    rows_written = 0
+    for rows_written in _write_rows(buffer, locations.iterator(chunk_size=2000), columns, header):
+        pass
+    return rows_written, buffer.take()
+
+
+def iter_csv_shards(locations, columns=None, processes: int = 2, shard_rows: int | None = None):
+    """Yield the export CSV for `locations` as (number of rows, UTF-8 bytes) per shard of `shard_rows` locations.
+
+    The pandcode range of `locations` is split into shards that are built in parallel by a pool of `processes`
+    forked processes. The shards are yielded in pandcode order, so together they are the same CSV as iter_csv.
+    `locations` must be a queryset from fetch_locations_for_export with the same `columns`, optionally filtered.
+    """
+    shard_rows = shard_rows or SHARD_ROWS
+    pandcodes = list(locations.order_by("pandcode").values_list("pandcode", flat=True))
+    if not pandcodes:
+        yield 0, b"".join(iter_csv([], columns))
+        return
+
+    shards = [
+        (columns, locations.query, pandcodes[i], pandcodes[min(i + shard_rows, len(pandcodes)) - 1], i == 0)
+        for i in range(0, len(pandcodes), shard_rows)
+    ]
+    yield from fork_map(_build_shard, shards, processes)
+
+
+def csv_response(content: bytes = b"") -> HttpResponse:
+    """Return a CSV download response, optionally with already rendered content"""
     date = timezone.localtime(timezone.now()).strftime("%Y-%m-%d_%H.%M")
 
-    response = HttpResponse(
+    return HttpResponse(
+        content,
         content_type="text/csv; charset=utf-8",
         headers={"Content-Disposition": f'attachment; filename="locaties_export_{date}.csv"'},
     )
 
-    # Add BOM to the file; because otherwise Excel won't know what's happening
-    response.write("\ufeff".encode("utf-8"))
-
-    all_columns = (
-        list(LOCATIE_MAPPING.values())
-        + list(ADRES_MAPPING.values())
-        + list(EXPORT_ONLY_ADRES_MAPPING.values())
-        + list(VG_MAPPING.values())
-    )
-    writer = csv.DictWriter(response, fieldnames=all_columns, delimiter=";")
-    writer.writeheader()
 
-    for locatie in locations:
-        writer.writerow(build_csv_row(locatie))
+def get_csv_response(locations, columns=None) -> HttpResponse:
+    response = csv_response()
+    write_csv(response, locations, columns)
 
     return response
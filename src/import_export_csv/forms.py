@@ -1,6 +1,8 @@
 from django import forms
 from django.utils.safestring import mark_safe
 
+from .exporter import EXPORT_COLUMNS
+
 
 class LocatieImportForm(forms.Form):
     """Form to import a CSV file with location data"""
@@ -8,3 +10,20 @@ class LocatieImportForm(forms.Form):
     csv_file = forms.FileField(
         required=True, label="CSV bestand", help_text=mark_safe("Kies het locatie bronbestand dat je wilt uploaden.")
     )
+    dry_run = forms.BooleanField(
+        required=False,
+        label="Proefimport",
+        help_text="Laat alleen zien wat de import zou wijzigen, zonder iets op te slaan.",
+    )
+
+
+class LocatieExportForm(forms.Form):
+    """Form to select the columns of a location export"""
+
+    columns = forms.MultipleChoiceField(
+        required=False,
+        label="Kolommen",
+        choices=[(column, column) for column in EXPORT_COLUMNS],
+        widget=forms.CheckboxSelectMultiple,
+        help_text="Laat leeg om alle kolommen te exporteren.",
+    )
@@ -1,65 +1,178 @@
+import codecs
 import csv
+import itertools
+import logging
 
 from django.contrib import messages
-from django.core.exceptions import ValidationError
 
+from .batch_importer import BatchImporter
+from .error_report import ImportErrorReport
 from .importer import ImporterProcessCSV
 from .mappings import ADRES_MAPPING, LOCATIE_MAPPING, VG_MAPPING
 
+log = logging.getLogger(__name__)
 
-def handle_import_csv(request, csv_file) -> int:
-    """Process an uploaded CSV file and add Django messages for feedback.
+# Number of bytes read from the uploaded file at once
+READ_CHUNK_SIZE = 64 * 1024
+# Advisory lock that every import holds while it writes, so concurrent imports run one after another instead of
+# waiting for, and deadlocking on, each other's row locks on the same adressen and locaties
+IMPORT_LOCK = "import-locaties"
+
+
+def iter_csv_lines(csv_file, chunk_size: int = READ_CHUNK_SIZE):
+    """Yield the lines of an uploaded file, decoded incrementally as UTF-8 with an optional byte order mark.
 
-    Returns the number of locations added (best-effort; currently 0).
+    The file is read in chunks, so only one chunk and one line are held in memory at a time.
     """
-    location_added = 0
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    # Not csv_file.chunks(), an InMemoryUploadedFile returns all its content as one chunk
+    while chunk := csv_file.read(chunk_size):
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(keepends=True)
+        # The last line may continue in the next chunk
+        pending = lines.pop() if lines else ""
+        yield from lines
+    pending += decoder.decode(b"", final=True)
+    yield from pending.splitlines(keepends=True)
+
+
+def read_csv_rows(csv_file, chunk_size: int = READ_CHUNK_SIZE) -> csv.DictReader:
+    """Return a DictReader that streams the rows of an uploaded CSV file.
+
+    The dialect is sniffed from the first line. Raises csv.Error or UnicodeDecodeError when that line cannot be read.
+    """
+    lines = iter_csv_lines(csv_file, chunk_size)
+    first_line = next(lines, "")
+    csv_dialect = csv.Sniffer().sniff(sample=first_line, delimiters=";")
+    return csv.DictReader(
+        itertools.chain([first_line], lines), dialect=csv_dialect, restval="missing", restkey="excess"
+    )
+
+
+def is_csv_file(csv_file) -> bool:
+    return bool(csv_file) and csv_file.name.endswith(".csv")
 
-    if not csv_file or not csv_file.name.endswith(".csv"):
+
+def handle_import_csv(request, csv_file, importer=None, error_report=None) -> int:
+    """Process an uploaded CSV file and add Django messages for feedback.
+
+    `importer` is a BatchImporter, or an ImportPreview for an import that only reports the changes. The errors of
+    the rows are collected in `error_report`, the messages only summarize them.
+    Returns the number of locations created or updated.
+    """
+    if not is_csv_file(csv_file):
         messages.add_message(
             request, messages.ERROR, f"{getattr(csv_file, 'name', 'Bestand')} is geen geldig CSV bestand."
         )
-        return location_added
+        return 0
 
+    if importer is None:
+        importer = BatchImporter(ImporterProcessCSV())
+    import_csv_file(
+        csv_file,
+        report=lambda level, message: messages.add_message(request, level, message),
+        importer=importer,
+        error_report=error_report,
+    )
+    return importer.stats.locaties_written if isinstance(importer, BatchImporter) else 0
+
+
+def import_csv_file(
+    csv_file, report, progress=None, importer=None, skip_rows: int = 0, error_report: ImportErrorReport | None = None
+) -> tuple[int, int]:
+    """Import the locations of a CSV file while it is read.
+
+    Feedback is given with report(level, message), with the levels of django.contrib.messages. The errors of the rows
+    are collected in `error_report`, and reported with a message per type of error at the end.
+    When given, progress(rows_processed, error_rows) is called for every imported row. The import of a
+    BatchImporter ends with the statistics of its objects and phases. The first `skip_rows` rows are read but not
+    imported, to continue an import that was interrupted.
+    Returns the number of rows read and the number of rows with import errors.
+    """
     try:
-        csv_reader = csv_file.read().decode("utf-8-sig").splitlines()
-        csv_dialect = csv.Sniffer().sniff(sample=csv_reader[0], delimiters=";")
+        csv_dict = read_csv_rows(csv_file)
+        fieldnames = csv_dict.fieldnames
     except Exception:
         message = (
             "De locaties kunnen niet ingelezen worden. Zorg ervoor dat je ';'"
             " als scheidingsteken en UTF-8 als codering gebruikt."
         )
-        messages.add_message(request, messages.ERROR, message)
-        return location_added
-
-    csv_dict = csv.DictReader(csv_reader, dialect=csv_dialect, restval="missing", restkey="excess")
+        report(messages.ERROR, message)
+        return 0, 0
 
     # Report columns that will be processed during import
     processable_columns = set(ADRES_MAPPING.values()) | set(VG_MAPPING.values()) | set(LOCATIE_MAPPING.values())
-    used_columns = [key for key in csv_dict.fieldnames if key in processable_columns]
-    messages.add_message(request, messages.INFO, f"Kolommen {used_columns} worden verwerkt.")
-
-    # Process the rows from the import file
-    importer = ImporterProcessCSV()
-    for i, row in enumerate(csv_dict):
-        # Check if a row is missing a value/column
-        if "missing" in row.values():
-            message = f"Rij {i + 1} is niet verwerkt want deze mist een kolom"
-            messages.add_message(request, messages.WARNING, message)
-            continue
-
-        # Check if a row has too many values/columns
-        if row.get("excess"):
-            message = f"Rij {i + 1} is niet verwerkt want deze heeft teveel kolommen"
-            messages.add_message(request, messages.WARNING, message)
-            continue
-
-        try:
-            importer.main(row)
-        except ValidationError as err:
-            importer.errors["main"] = f"Error in main: {err}"
-
-        if importer.errors:
-            message = f"Fout importeren locatie {importer.locatie_id}: {importer.errors}"
-            messages.add_message(request, messages.ERROR, message)
-
-    return location_added
+    used_columns = [key for key in fieldnames if key in processable_columns]
+    report(messages.INFO, f"Kolommen {used_columns} worden verwerkt.")
+
+    if error_report is None:
+        error_report = ImportErrorReport()
+
+    # Number of rows read, and whether the rest of the file has an invalid encoding
+    rows_read = 0
+    undecodable = False
+
+    def importable_rows():
+        nonlocal rows_read, undecodable
+        rows = enumerate(csv_dict)
+        while True:
+            try:
+                i, row = next(rows)
+            except StopIteration:
+                return
+            except UnicodeDecodeError:
+                # The rows read so far are still imported
+                undecodable = True
+                return
+            rows_read = i + 1
+            if i < skip_rows:
+                continue
+
+            # Check if a row is missing a value/column
+            if "missing" in row.values():
+                error_report.add_skipped(i + 1, "de rij mist een kolom")
+                continue
+
+            # Check if a row has too many values/columns
+            if row.get("excess"):
+                error_report.add_skipped(i + 1, "de rij heeft teveel kolommen")
+                continue
+
+            yield i, row
+
+    # Process the rows from the import file, while it is read. Every chunk of rows is written in its own transaction.
+    if importer is None:
+        importer = BatchImporter(ImporterProcessCSV())
+    error_rows = 0
+    for i, locatie_id, errors in importer.import_rows(importable_rows()):
+        if errors:
+            error_rows += 1
+            error_report.add_errors(i + 1, locatie_id, errors)
+        if progress is not None:
+            progress(i + 1, error_rows)
+
+    for level, message in error_report.messages():
+        report(level, message)
+
+    if undecodable:
+        message = (
+            f"De locaties na rij {rows_read} kunnen niet ingelezen worden."
+            " Zorg ervoor dat je UTF-8 als codering gebruikt."
+        )
+        report(messages.ERROR, message)
+
+    if isinstance(importer, BatchImporter):
+        log.info(f"Imported {rows_read} rows: {importer.stats}")
+        report(messages.INFO, importer.stats.count_message())
+        report(messages.INFO, importer.stats.timing_message())
+
+    return rows_read, error_rows
+
+
+def count_csv_rows(csv_file) -> int | None:
+    """Return the number of rows of a CSV file, or None when it cannot be read"""
+    try:
+        return sum(1 for _ in read_csv_rows(csv_file))
+    except (csv.Error, UnicodeDecodeError):
+        return None
@@ -5,6 +5,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 
 from fblocatie.models import Adres, Locatie, Vastgoed
+from import_export_csv.lookups import PersoonResolver, ReferenceLookup
 from import_export_csv.mappings import (
     ADRES_MAPPING,
     LOCATIE_MANY_TO_MANY_FIELDS,
@@ -19,6 +20,11 @@ from referentie_tabellen.models import (
 
 log = logging.getLogger(__name__)
 
+# Fields that identify an existing object to update
+ADRES_MATCH_KEYS = ["postcode", "huisnummer", "huisletter", "huisnummertoevoeging"]
+VASTGOED_MATCH_KEYS = ["adres"]
+LOCATIE_MATCH_KEYS = ["pandcode", "afkorting"]
+
 
 class ImporterProcessCSV:
     def __init__(self):
@@ -29,29 +35,38 @@ class ImporterProcessCSV:
         self.adres_obj = None
         self.vastgoed_obj = None
         self.locatieteam_obj = None
+        # Whether the adres, vastgoed and locatie of the last row were created (True) or updated (False)
+        self.created = {}
+        # Names in the referentie tabellen, loaded once per import
+        self.references = ReferenceLookup()
+        self.personen = PersoonResolver()
 
     @staticmethod
     def set_empty_to_none(data: dict) -> dict:
         return {key: (None if value in ("", "x", "'-'", "?") else value) for key, value in data.items()}
 
-    def process_adres(self, row: dict) -> Adres:
-        self.error_list = []
-
-        adres_mapping = ADRES_MAPPING
-        data = {key: row.pop(value) for key, value in adres_mapping.items() if value in row}
+    def get_adres_data(self, row: dict) -> dict:
+        """Take the adres columns from the row, corrected for storage"""
+        data = {key: row.pop(value) for key, value in ADRES_MAPPING.items() if value in row}
         adres_data = self.set_empty_to_none(data)
 
         # data correction before dbstorage
         if "postcode" in adres_data and adres_data["postcode"] is not None and len(adres_data["postcode"]) > 6:
             adres_data["postcode"] = adres_data["postcode"].replace(" ", "")
+        return adres_data
 
-        match_keys = ["postcode", "huisnummer", "huisletter", "huisnummertoevoeging"]
+    def process_adres(self, row: dict) -> Adres:
+        self.error_list = []
+
+        adres_data = self.get_adres_data(row)
+
+        match_keys = ADRES_MATCH_KEYS
         match_adres = {key: adres_data[key] for key in match_keys if key in adres_data}
 
         update_fields = {key: value for key, value in adres_data.items() if key not in match_keys}
 
         try:
-            obj, _ = Adres.objects.update_or_create(defaults=update_fields, **match_adres)
+            obj, self.created["adres"] = Adres.objects.update_or_create(defaults=update_fields, **match_adres)
         except Exception as e:
             self.error_list.append(e)
             obj = None
@@ -62,15 +77,13 @@ class ImporterProcessCSV:
         # return obj
         self.adres_obj = obj
 
-    @staticmethod
-    def _get_persoon(naam: str) -> tuple[Union[Persoon, None], Union[tuple, None]]:
+    def _get_persoon(self, naam: str) -> tuple[Union[Persoon, None], Union[tuple, None]]:
         error = None
         if naam is None:
             return None, error
 
         try:
-            voornaam, achternaam = naam.strip().split(" ", 1)
-            obj = Persoon.objects.get(voornaam=voornaam.strip(), achternaam=achternaam.strip())
+            obj = self.personen.get(naam)
         except (ValueError, Persoon.DoesNotExist) as e:
             error = (f"{naam}", e)
             obj = None
@@ -86,21 +99,19 @@ class ImporterProcessCSV:
                     obj, error = self._get_persoon(data[field])
                     if error is not None:
                         self.error_list.append(error)
+                    data[field] = obj
                 else:
-                    obj = model.objects.get(name=data[field])
-                data[field] = obj
+                    # Set the id directly, the referentie tabel row itself is not needed
+                    data[f"{field}_id"] = self.references.get_id(model, data[field])
+                    del data[field]
             except ObjectDoesNotExist:
                 self.error_list.append(f" '{data[field]}' is niet aanwezig in de {model} tabel")
                 data[field] = None
         return data
 
-    def process_vastgoed(self, row: dict) -> Vastgoed:
-        self.error_list = []
-        # model : row
-        vg_mapping = VG_MAPPING
-        referentie_tabellen = VG_REFERENTIE_TABELLEN
-
-        data = {key: row.pop(value) for key, value in vg_mapping.items() if value in row}
+    def get_vastgoed_data(self, row: dict) -> dict:
+        """Take the vastgoed columns from the row, corrected for storage"""
+        data = {key: row.pop(value) for key, value in VG_MAPPING.items() if value in row}
         vg_data = self.set_empty_to_none(data)
 
         # data correction before dbstorage
@@ -110,6 +121,14 @@ class ImporterProcessCSV:
         for k in ["vvo", "bvo"]:
             if vg_data.get(k) is not None:
                 vg_data[k] = vg_data[k].replace(",", ".")
+        return vg_data
+
+    def process_vastgoed(self, row: dict) -> Vastgoed:
+        self.error_list = []
+        # model : row
+        referentie_tabellen = VG_REFERENTIE_TABELLEN
+
+        vg_data = self.get_vastgoed_data(row)
 
         # set adres onetoonefield
         vg_data["adres"] = self.adres_obj
@@ -117,13 +136,13 @@ class ImporterProcessCSV:
         vg_data = self.get_referentietabellen_fields(referentie_tabellen, vg_data)
 
         # update or create
-        match_keys = ["adres"]
+        match_keys = VASTGOED_MATCH_KEYS
         match_vg = {key: vg_data[key] for key in match_keys if key in vg_data}
 
         update_fields = {key: value for key, value in vg_data.items() if key not in match_keys}
 
         try:
-            obj, _ = Vastgoed.objects.update_or_create(defaults=update_fields, **match_vg)
+            obj, self.created["vastgoed"] = Vastgoed.objects.update_or_create(defaults=update_fields, **match_vg)
         except Exception as e:
             self.error_list.append(e)
             obj = None
@@ -149,26 +168,29 @@ class ImporterProcessCSV:
                     else:
                         objs.append(obj.id)
                 else:
-                    obj = model.objects.get(name=item)
-                    objs.append(obj.id)
+                    objs.append(self.references.get_id(model, item))
             except Exception as e:
                 self.error_list.append(f"Error '{item}' from {model}: {e}")
 
         return objs
 
+    def get_locatie_data(self, row: dict) -> dict:
+        """Take the locatie columns from the row"""
+        data = {key: row.pop(value) for key, value in LOCATIE_MAPPING.items() if value in row}
+        return self.set_empty_to_none(data)
+
     def main(self, row: dict):
         self.errors = {}
+        self.created = {}
 
         with transaction.atomic():
             # print('start row: ', row)
             self.error_list = []
             # model : row
-            locatie_mapping = LOCATIE_MAPPING
             many_to_many_fields = LOCATIE_MANY_TO_MANY_FIELDS
             referentie_tabellen = LOCATIE_REFERENTIE_TABELLEN
 
-            data = {key: row.pop(value) for key, value in locatie_mapping.items() if value in row}
-            loc_data = self.set_empty_to_none(data)
+            loc_data = self.get_locatie_data(row)
 
             # connect models in right order
             field_model_ids = [
@@ -185,7 +207,7 @@ class ImporterProcessCSV:
             loc_data = self.get_referentietabellen_fields(referentie_tabellen, loc_data)
 
             # update or create locatie
-            match_keys = ["pandcode", "afkorting"]
+            match_keys = LOCATIE_MATCH_KEYS
             match_loc = {key: loc_data[key] for key in match_keys if key in loc_data}
 
             update_fields = {
@@ -198,7 +220,7 @@ class ImporterProcessCSV:
                 self.pandcode = loc_data["pandcode"]
                 self.locatie_id = loc_data["afkorting"]
 
-                locatie, created = Locatie.objects.update_or_create(defaults=update_fields, **match_loc)
+                locatie, self.created["locatie"] = Locatie.objects.update_or_create(defaults=update_fields, **match_loc)
 
                 for f, m in many_to_many_fields:
                     if f in loc_data:
@@ -0,0 +1,257 @@
+import io
+import logging
+import os
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from shared.locks import advisory_lock, try_advisory_lock
+
+from .batch_importer import BatchImporter
+from .error_report import ERROR_REPORT_DIRECTORY, ImportErrorReport
+from .exporter import fetch_locations_for_export, iter_csv_shards, write_csv
+from .handle_import import IMPORT_LOCK, count_csv_rows, import_csv_file
+from .models import ExportJob, ImportJob
+
+log = logging.getLogger(__name__)
+
+# Number of rows between progress updates in the database
+PROGRESS_INTERVAL = 250
+# Export files are stored in the default storage in this directory
+EXPORT_DIRECTORY = "exports"
+# Uploaded import files are stored in the default storage in this directory
+IMPORT_DIRECTORY = "imports"
+# Jobs that were claimed shorter ago than this may not hold their job_lock() yet, see fail_abandoned_jobs()
+ABANDONED_JOB_GRACE = timedelta(minutes=1)
+
+
+def claim_next_job(model):
+    """Mark the oldest pending job of a job model as running and return it.
+
+    Rows locked by another worker are skipped, so multiple workers can process the queue.
+    """
+    with transaction.atomic():
+        job = (
+            model.objects.select_for_update(skip_locked=True)
+            .filter(status=model.Status.PENDING)
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+
+        job.status = model.Status.RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=["status", "started_at"])
+    return job
+
+
+def job_lock(job) -> str:
+    """Name of the advisory lock that the worker holds while it processes `job`, see fail_abandoned_jobs()"""
+    return f"{job._meta.model_name}:{job.pk}"
+
+
+def fail_abandoned_jobs(now=None) -> int:
+    """Mark the running and waiting jobs of workers that stopped, for example by a deploy, as failed.
+
+    A worker holds the job_lock() of a job while processing it. The lock is released when the worker stops, so the
+    lock of an abandoned job is free. The uploaded files of abandoned imports are deleted, they contain personal
+    data. Returns the number of failed jobs.
+    """
+    started_before = (now or timezone.now()) - ABANDONED_JOB_GRACE
+    failed = 0
+    for model in (ExportJob, ImportJob):
+        unfinished = [model.Status.RUNNING, model.Status.WAITING]
+        for job in model.objects.filter(status__in=unfinished, started_at__lt=started_before):
+            with try_advisory_lock(job_lock(job)) as acquired:
+                # A job that finished in the meantime is not changed
+                if not acquired or not model.objects.filter(pk=job.pk, status__in=unfinished).update(
+                    status=model.Status.FAILED,
+                    error="De verwerking is afgebroken, bijvoorbeeld door een herstart. Probeer het opnieuw.",
+                    finished_at=timezone.now(),
+                ):
+                    continue
+            log.warning(f"{job} was abandoned by its worker")
+            if model is ImportJob:
+                default_storage.delete(job.file_name)
+            failed += 1
+    return failed
+
+
+def claim_next_export_job() -> ExportJob | None:
+    return claim_next_job(ExportJob)
+
+
+def claim_next_import_job() -> ImportJob | None:
+    return claim_next_job(ImportJob)
+
+
+def _update_progress(job: ExportJob, rows_written: int):
+    if rows_written % PROGRESS_INTERVAL == 0:
+        ExportJob.objects.filter(pk=job.pk).update(rows_written=rows_written)
+
+
+def _write_csv_shards(output, job: ExportJob, locations) -> int:
+    """Write the export in shards that are built in parallel processes, with a progress update per shard"""
+    rows_written = 0
+    for rows, data in iter_csv_shards(locations, job.columns, processes=settings.EXPORT_PROCESSES):
+        output.write(data)
+        rows_written += rows
+        ExportJob.objects.filter(pk=job.pk).update(rows_written=rows_written)
+    return rows_written
+
+
+def run_export_job(job: ExportJob):
+    """Write the export of a job to storage and keep track of its progress"""
+    try:
+        locations = fetch_locations_for_export(job.columns)
+        if job.params:
+            locations = locations.search_filter(params=job.params, user=job.created_by or AnonymousUser())
+
+        job.total_rows = locations.count()
+        job.save(update_fields=["total_rows"])
+
+        date = timezone.localtime(job.created_at).strftime("%Y-%m-%d_%H.%M")
+        with tempfile.TemporaryFile() as tmp_file:
+            if settings.EXPORT_PROCESSES > 1:
+                rows_written = _write_csv_shards(tmp_file, job, locations)
+            else:
+                text_file = io.TextIOWrapper(tmp_file, encoding="utf-8", newline="")
+                rows_written = write_csv(
+                    text_file,
+                    locations.iterator(chunk_size=PROGRESS_INTERVAL),
+                    job.columns,
+                    progress=lambda rows: _update_progress(job, rows),
+                )
+                text_file.flush()
+                text_file.detach()
+            tmp_file.seek(0)
+            file_name = default_storage.save(f"{EXPORT_DIRECTORY}/locaties_export_{job.pk}_{date}.csv", File(tmp_file))
+    except Exception as e:
+        log.exception(f"Export job {job.pk} failed")
+        job.status = ExportJob.Status.FAILED
+        job.error = str(e)
+        job.finished_at = timezone.now()
+        job.save(update_fields=["status", "error", "finished_at"])
+        return
+
+    job.status = ExportJob.Status.DONE
+    job.rows_written = rows_written
+    job.file_name = file_name
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "rows_written", "file_name", "finished_at"])
+
+
+def create_import_job(csv_file, user) -> ImportJob:
+    """Store an uploaded file and queue its import"""
+    file_name = default_storage.save(f"{IMPORT_DIRECTORY}/{csv_file.name}", csv_file)
+    return ImportJob.objects.create(file_name=file_name, original_name=csv_file.name, created_by=user)
+
+
+class ImportProgress:
+    """Keep track of the progress of an import job, saved every PROGRESS_INTERVAL rows"""
+
+    def __init__(self, job: ImportJob):
+        self.job = job
+        self.saved_rows = 0
+
+    def __call__(self, rows_processed: int, error_rows: int):
+        self.job.rows_processed = rows_processed
+        self.job.error_rows = error_rows
+        if rows_processed - self.saved_rows >= PROGRESS_INTERVAL:
+            ImportJob.objects.filter(pk=self.job.pk).update(rows_processed=rows_processed, error_rows=error_rows)
+            self.saved_rows = rows_processed
+
+
+def _set_import_status(job: ImportJob, status: str):
+    job.status = status
+    job.save(update_fields=["status"])
+
+
+def run_import_job(job: ImportJob):
+    """Import the stored file of a job, keep track of its progress and store the report.
+
+    Waits, with the status WAITING, while another import is running. The stored file is deleted when the job is
+    finished, it contains personal data.
+    """
+    report = []
+    error_report = ImportErrorReport()
+    try:
+        with default_storage.open(job.file_name, "rb") as csv_file:
+            job.total_rows = count_csv_rows(csv_file)
+            job.save(update_fields=["total_rows"])
+
+            csv_file.seek(0)
+            # On a connection of its own, the parsing processes close the other connections
+            with advisory_lock(
+                IMPORT_LOCK, on_wait=lambda: _set_import_status(job, ImportJob.Status.WAITING), dedicated=True
+            ):
+                if job.status == ImportJob.Status.WAITING:
+                    _set_import_status(job, ImportJob.Status.RUNNING)
+                rows_read, error_rows = import_csv_file(
+                    csv_file,
+                    report=lambda level, message: report.append([level, message]),
+                    progress=ImportProgress(job),
+                    importer=BatchImporter(processes=settings.IMPORT_PROCESSES),
+                    error_report=error_report,
+                )
+        if error_report:
+            job.error_report = error_report.save()
+    except Exception as e:
+        log.exception(f"Import job {job.pk} failed")
+        job.status = ImportJob.Status.FAILED
+        job.error = str(e)
+        job.report = report
+        # The errors of the rows imported before the failure
+        job.error_report = error_report.save() if error_report else ""
+        job.finished_at = timezone.now()
+        job.save(
+            update_fields=["status", "error", "report", "error_report", "rows_processed", "error_rows", "finished_at"]
+        )
+        return
+    finally:
+        default_storage.delete(job.file_name)
+
+    job.status = ImportJob.Status.DONE
+    job.rows_processed = rows_read
+    job.error_rows = error_rows
+    job.report = report
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "rows_processed", "error_rows", "report", "error_report", "finished_at"])
+
+
+def delete_old_job_files(now=None) -> int:
+    """Delete export files, import error reports and left over import files older than JOB_FILE_RETENTION_DAYS.
+
+    They contain personal data, so they are not kept longer than needed. The files of unfinished import jobs are
+    kept. Returns the number of deleted files.
+    """
+    before = (now or timezone.now()) - timedelta(days=settings.JOB_FILE_RETENTION_DAYS)
+    unfinished_imports = set(
+        ImportJob.objects.exclude(status__in=[ImportJob.Status.DONE, ImportJob.Status.FAILED]).values_list(
+            "file_name", flat=True
+        )
+    )
+
+    deleted = []
+    for directory in (EXPORT_DIRECTORY, ERROR_REPORT_DIRECTORY, IMPORT_DIRECTORY):
+        try:
+            _, files = default_storage.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for name in files:
+            path = f"{directory}/{name}"
+            if path not in unfinished_imports and default_storage.get_modified_time(path) < before:
+                default_storage.delete(path)
+                deleted.append(path)
+
+    # The jobs refer to the reports by their name in the directory
+    ExportJob.objects.filter(file_name__in=deleted).update(file_name="")
+    ImportJob.objects.filter(error_report__in=[os.path.basename(path) for path in deleted]).update(error_report="")
+    return len(deleted)
@@ -0,0 +1,71 @@
+from collections import defaultdict
+
+from referentie_tabellen.models import Persoon
+
+
+class ReferenceLookup:
+    """Resolve names in referentie tabellen to ids in memory.
+
+    Every table is loaded once, the first time one of its names is looked up. Use one lookup per import,
+    so rows that are added to the referentie tabellen in the meantime are picked up by the next import.
+    """
+
+    def __init__(self):
+        self._tables = {}
+
+    def _names(self, model) -> dict[str, list[int]]:
+        if model not in self._tables:
+            names = defaultdict(list)
+            for pk, name in model.objects.values_list("pk", "name"):
+                names[name].append(pk)
+            self._tables[model] = dict(names)
+        return self._tables[model]
+
+    def load(self, models):
+        """Load the tables of `models` now, so later lookups do not query the database"""
+        for model in models:
+            self._names(model)
+
+    def get_id(self, model, name: str) -> int:
+        """Return the id of the `model` row with `name`.
+
+        Raises model.DoesNotExist or model.MultipleObjectsReturned, with the same message as model.objects.get().
+        """
+        ids = self._names(model).get(name, [])
+        if not ids:
+            raise model.DoesNotExist(f"{model._meta.object_name} matching query does not exist.")
+        if len(ids) > 1:
+            raise model.MultipleObjectsReturned(
+                f"get() returned more than one {model._meta.object_name} -- it returned {len(ids)}!"
+            )
+        return ids[0]
+
+
+class PersoonResolver:
+    """Resolve full names of personen ("voornaam achternaam") to Persoon rows in memory.
+
+    All personen are loaded once, the first time a name is resolved, into an index on voornaam and achternaam.
+    """
+
+    def __init__(self):
+        self._index = None
+
+    def _personen(self) -> dict[tuple[str, str], Persoon]:
+        if self._index is None:
+            self._index = {(persoon.voornaam, persoon.achternaam): persoon for persoon in Persoon.objects.all()}
+        return self._index
+
+    def load(self):
+        """Load the personen now, so later lookups do not query the database"""
+        self._personen()
+
+    def get(self, naam: str) -> Persoon:
+        """Return the Persoon with the full name `naam`, split into voornaam and achternaam on the first space.
+
+        Raises a ValueError for a name without a space, and Persoon.DoesNotExist like Persoon.objects.get().
+        """
+        voornaam, achternaam = naam.strip().split(" ", 1)
+        try:
+            return self._personen()[(voornaam.strip(), achternaam.strip())]
+        except KeyError:
+            raise Persoon.DoesNotExist("Persoon matching query does not exist.") from None
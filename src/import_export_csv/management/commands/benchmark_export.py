@@ -0,0 +1,50 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from import_export_csv.exporter import SHARD_ROWS, fetch_locations_for_export, iter_csv, iter_csv_shards
+
+
+class Command(BaseCommand):
+    help = "Measure the speedup of the sharded locations export for a number of processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            nargs="+",
+            default=[1, 2, 4],
+            help="Numbers of processes to measure; 1 is the export in a single process.",
+        )
+        parser.add_argument("--shard-rows", type=int, default=SHARD_ROWS, help="Number of locations in a shard.")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per number of processes; the best counts.")
+
+    def handle(self, *args, **kwargs):
+        if min(kwargs["processes"]) < 1 or kwargs["shard_rows"] < 1 or kwargs["repeat"] < 1:
+            raise CommandError("--processes, --shard-rows and --repeat must be at least 1.")
+
+        self.stdout.write(f"{fetch_locations_for_export().count()} locations, {os.cpu_count()} cores available")
+        self.stdout.write(f"{'processes':>9}  {'seconds':>8}  {'speedup':>7}  {'bytes':>10}")
+
+        baseline = None
+        for processes in kwargs["processes"]:
+            durations = []
+            for _ in range(kwargs["repeat"]):
+                started = time.perf_counter()
+                size = self.export(processes, kwargs["shard_rows"])
+                durations.append(time.perf_counter() - started)
+
+            duration = min(durations)
+            baseline = baseline or duration
+            self.stdout.write(f"{processes:>9}  {duration:>8.3f}  {baseline / duration:>6.2f}x  {size:>10}")
+
+    @staticmethod
+    def export(processes: int, shard_rows: int) -> int:
+        """Build the complete export and return its size in bytes"""
+        locations = fetch_locations_for_export()
+        if processes == 1:
+            chunks = iter_csv(locations.iterator(chunk_size=shard_rows))
+        else:
+            chunks = (data for _, data in iter_csv_shards(locations, processes=processes, shard_rows=shard_rows))
+        return sum(len(chunk) for chunk in chunks)
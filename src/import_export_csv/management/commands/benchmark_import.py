@@ -0,0 +1,80 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from fblocatie.models import reserve_pandcodes
+from import_export_csv.batch_importer import CHUNK_SIZE, BatchImporter
+from import_export_csv.importer import ImporterProcessCSV
+from referentie_tabellen.models import DienstverleningsKader, Directie, LocatieBezit, LocatieSoort
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the import of generated locations row by row and in bulk. "
+        "The imported locations are rolled back. Their pandcodes are reserved from the pandcode sequence, so they "
+        "are not handed out again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000, help="Number of locations to import.")
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Number of rows in a bulk write.")
+
+    def handle(self, *args, **kwargs):
+        if kwargs["rows"] < 1 or kwargs["chunk_size"] < 1:
+            raise CommandError("--rows and --chunk-size must be at least 1.")
+
+        self.stdout.write(f"{kwargs['rows']} rows, chunks of {kwargs['chunk_size']}")
+        self.stdout.write(f"{'import':>10}  {'seconds':>8}  {'rows/s':>8}  {'speedup':>7}  {'errors':>6}")
+
+        # Pandcodes from the sequence, so the import does not advance it. A rollback does not undo a sequence, and
+        # moving it back could hand out pandcodes that others allocated meanwhile; the reserved pandcodes are a gap
+        pandcodes = reserve_pandcodes(kwargs["rows"])
+
+        baseline = None
+        for name, bulk in (("row by row", False), ("bulk", True)):
+            with transaction.atomic():
+                rows = self.generate_rows(pandcodes)
+                started = time.perf_counter()
+                importer = BatchImporter(ImporterProcessCSV(), chunk_size=kwargs["chunk_size"])
+                if bulk:
+                    results = list(importer.import_rows(enumerate(rows)))
+                else:
+                    results = [importer.import_row(i, row) for i, row in enumerate(rows)]
+                duration = time.perf_counter() - started
+                transaction.set_rollback(True)
+
+            errors = sum(1 for _, _, row_errors in results if row_errors)
+            baseline = baseline or duration
+            self.stdout.write(
+                f"{name:>10}  {duration:>8.3f}  {len(rows) / duration:>8.0f}  {baseline / duration:>6.2f}x  {errors:>6}"
+            )
+
+    @staticmethod
+    def generate_rows(pandcodes: list[int]) -> list[dict]:
+        """Create the referentie tabel rows the import needs and return rows of an import file for `pandcodes`"""
+        soort, _ = LocatieSoort.objects.get_or_create(name="Benchmark")
+        dvk, _ = DienstverleningsKader.objects.get_or_create(name="Benchmark", defaults={"dvk_nr": 0})
+        directie, _ = Directie.objects.get_or_create(name="Benchmark")
+        LocatieBezit.objects.get_or_create(name="ntb")
+        return [
+            {
+                "pandcode": str(pandcode),
+                "naam": f"Benchmark {i}",
+                "afkorting": f"BM{i}",
+                "soort": soort.name,
+                "dvk_naam": dvk.name,
+                "budget_dir": directie.name,
+                "vlekken": directie.name,
+                "ambtenaar": "Ja",
+                "straat": "Benchmarkstraat",
+                "postcode": f"9{i // 1000 % 1000:03d}ZZ",
+                "huisnummer": str(i % 1000 + 1),
+                "huisletter": "",
+                "numtoeg": "",
+                "plaats": "Amsterdam",
+                "bezit": "",
+                "vvo": "100,5",
+            }
+            for i, pandcode in enumerate(pandcodes)
+        ]
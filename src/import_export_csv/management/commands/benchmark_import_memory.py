@@ -0,0 +1,71 @@
+import csv
+import tracemalloc
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+
+from import_export_csv.handle_import import READ_CHUNK_SIZE, read_csv_rows
+
+HEADER = "pandcode;naam;afkorting;soort;straat;postcode;huisnummer;plaats;notitie\n"
+
+
+def generate_file(rows: int) -> SimpleUploadedFile:
+    """Return an uploaded import file with `rows` generated locations"""
+    lines = (
+        f"{i};Locatie {i};L{i};Kantoor;Amstelstraat;1000AA;{i};Amsterdam;Een notitie van wat langere lengte\n"
+        for i in range(rows)
+    )
+    content = (HEADER + "".join(lines)).encode("utf-8-sig")
+    return SimpleUploadedFile("benchmark.csv", content, content_type="text/csv")
+
+
+def read_all_rows(csv_file) -> int:
+    """Read the rows like the import did before it was streamed: the whole file as bytes, str and list of lines"""
+    lines = csv_file.read().decode("utf-8-sig").splitlines()
+    dialect = csv.Sniffer().sniff(sample=lines[0], delimiters=";")
+    return sum(1 for _ in csv.DictReader(lines, dialect=dialect))
+
+
+def stream_rows(csv_file, chunk_size: int = READ_CHUNK_SIZE) -> int:
+    return sum(1 for _ in read_csv_rows(csv_file, chunk_size))
+
+
+def peak_memory(func, csv_file) -> tuple[int, int]:
+    """Return the result of func(csv_file) and the peak of the memory it allocated, in bytes"""
+    csv_file.seek(0)
+    tracemalloc.start()
+    try:
+        result = func(csv_file)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the peak memory of reading import files of a number of sizes, "
+        "read at once and streamed. The rows are read, not imported."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            nargs="+",
+            default=[10000, 50000, 200000],
+            help="Numbers of rows of the generated import files.",
+        )
+
+    def handle(self, *args, **kwargs):
+        if min(kwargs["rows"]) < 1:
+            raise CommandError("--rows must be at least 1.")
+
+        self.stdout.write(f"{'rows':>8}  {'file KiB':>9}  {'at once KiB':>11}  {'streamed KiB':>12}")
+        for rows in kwargs["rows"]:
+            csv_file = generate_file(rows)
+            read, at_once = peak_memory(read_all_rows, csv_file)
+            streamed_rows, streamed = peak_memory(stream_rows, csv_file)
+            if read != rows or streamed_rows != rows:
+                raise CommandError(f"Read {read} and streamed {streamed_rows} of {rows} rows.")
+            self.stdout.write(f"{rows:>8}  {csv_file.size // 1024:>9}  {at_once // 1024:>11}  {streamed // 1024:>12}")
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.management.base import BaseCommand, CommandError
+
+from import_export_csv.batch_importer import CHUNK_SIZE, BatchImporter
+from import_export_csv.error_report import ImportErrorReport
+from import_export_csv.handle_import import IMPORT_LOCK, count_csv_rows, import_csv_file
+from import_export_csv.importer import ImporterProcessCSV
+from shared.locks import advisory_lock
+
+
+class Checkpoint:
+    """The number of rows of an import file that are imported, stored in a file after every `interval` rows.
+
+    Rows are reported as processed after their chunk is committed, so an import that is interrupted can continue
+    after the stored number of rows. The size of the import file is stored as well, to not continue with another file.
+    """
+
+    def __init__(self, path: str, file_size: int, interval: int):
+        self.path = path
+        self.file_size = file_size
+        self.interval = interval
+        # Rows in the checkpoint file, and rows imported so far
+        self.rows = 0
+        self.processed = 0
+
+    def load(self) -> int:
+        """Return the number of imported rows of the last run, or 0 without a checkpoint"""
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            data = json.load(f)
+        if data["file_size"] != self.file_size:
+            raise CommandError(f"The checkpoint {self.path} is of another version of the import file.")
+        self.rows = self.processed = data["rows"]
+        return self.rows
+
+    def save(self, rows: int):
+        self.rows = rows
+        # Replace the checkpoint at once, an interrupted write must not leave a corrupt checkpoint
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump({"file_size": self.file_size, "rows": rows}, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def update(self, rows: int):
+        self.processed = rows
+        if rows - self.rows >= self.interval:
+            self.save(rows)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Command(BaseCommand):
+    help = (
+        "Import locations from a CSV file on disk, like the import form but without its upload limits and timeouts. "
+        "The file is streamed and written in chunks of rows, each in its own transaction. The number of imported rows "
+        "is stored in a checkpoint file, so an interrupted import can continue with --resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_file", help="Path of the CSV file to import.")
+        parser.add_argument("--resume", action="store_true", help="Continue after the rows in the checkpoint file.")
+        parser.add_argument(
+            "--checkpoint", help="Path of the checkpoint file (default: the path of the CSV file with .checkpoint)."
+        )
+        parser.add_argument(
+            "--error-report",
+            help="Path of the CSV file with all rows with errors (default: the path of the CSV file with .errors.csv).",
+        )
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Number of rows in a transaction.")
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=settings.IMPORT_PROCESSES,
+            help="Number of processes that parse the rows in parallel.",
+        )
+        parser.add_argument(
+            "--progress-interval", type=int, default=1000, help="Number of rows between progress messages."
+        )
+
+    def handle(self, *args, **kwargs):
+        self.verbosity = kwargs["verbosity"]
+        path = kwargs["csv_file"]
+        if not os.path.isfile(path):
+            raise CommandError(f"{path} does not exist.")
+        for option in ("chunk_size", "processes", "progress_interval"):
+            if kwargs[option] < 1:
+                raise CommandError(f"--{option.replace('_', '-')} must be at least 1.")
+
+        checkpoint = Checkpoint(
+            kwargs["checkpoint"] or f"{path}.checkpoint", os.path.getsize(path), interval=kwargs["chunk_size"]
+        )
+        if kwargs["resume"]:
+            skip_rows = checkpoint.load()
+        elif os.path.exists(checkpoint.path):
+            raise CommandError(
+                f"The checkpoint {checkpoint.path} of an interrupted import exists. "
+                "Continue the import with --resume, or remove the checkpoint to start over."
+            )
+        else:
+            skip_rows = 0
+
+        importer = BatchImporter(ImporterProcessCSV(), chunk_size=kwargs["chunk_size"], processes=kwargs["processes"])
+        error_report = ImportErrorReport()
+        error_report_path = kwargs["error_report"] or f"{path}.errors.csv"
+        started = time.perf_counter()
+        with open(path, "rb") as csv_file:
+            total_rows = count_csv_rows(csv_file)
+            csv_file.seek(0)
+            if skip_rows:
+                self.stdout.write(f"Continuing after row {skip_rows} of {total_rows}")
+
+            def progress(rows_processed: int, error_rows: int):
+                checkpoint.update(rows_processed)
+                if rows_processed % kwargs["progress_interval"] == 0:
+                    self.stdout.write(f"Imported {rows_processed} of {total_rows} rows, {error_rows} with errors")
+
+            try:
+                # On a connection of its own, the parsing processes close the other connections
+                with advisory_lock(
+                    IMPORT_LOCK,
+                    on_wait=lambda: self.stdout.write("Waiting until another import is finished"),
+                    dedicated=True,
+                ):
+                    rows_read, error_rows = import_csv_file(
+                        csv_file,
+                        report=self.report,
+                        progress=progress,
+                        importer=importer,
+                        skip_rows=skip_rows,
+                        error_report=error_report,
+                    )
+            except Exception as e:
+                checkpoint.save(checkpoint.processed)
+                self.write_error_report(error_report, error_report_path)
+                raise CommandError(
+                    f"The import failed after row {checkpoint.rows}: {e}. Continue the import with --resume."
+                ) from e
+
+        checkpoint.remove()
+        duration = time.perf_counter() - started
+        self.stdout.write(f"Imported {rows_read - skip_rows} rows in {duration:.1f} seconds, {error_rows} with errors")
+        self.stdout.write(str(importer.stats))
+        self.write_error_report(error_report, error_report_path)
+
+    def write_error_report(self, error_report: ImportErrorReport, path: str):
+        if error_report:
+            with open(path, "wb") as f:
+                f.write(error_report.to_csv())
+            self.stdout.write(f"The rows with errors are in {path}")
+
+    def report(self, level: int, message: str):
+        if level >= messages.WARNING:
+            self.stderr.write(message)
+        elif self.verbosity > 1:
+            self.stdout.write(message)
@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from import_export_csv.jobs import (
+    claim_next_export_job,
+    claim_next_import_job,
+    delete_old_job_files,
+    fail_abandoned_jobs,
+    job_lock,
+    run_export_job,
+    run_import_job,
+)
+from shared.locks import advisory_lock
+
+# Seconds between cleanups of abandoned jobs and old job files
+CLEANUP_INTERVAL = 3600
+
+
+class Command(BaseCommand):
+    help = "Process queued background export and import jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Process the queued jobs and exit.")
+        parser.add_argument(
+            "--poll-interval", type=float, default=5, help="Seconds to wait for new jobs when the queue is empty."
+        )
+
+    def handle(self, *args, **kwargs):
+        last_cleanup = None
+        while True:
+            if last_cleanup is None or time.monotonic() - last_cleanup >= CLEANUP_INTERVAL:
+                failed = fail_abandoned_jobs()
+                if failed:
+                    self.stdout.write(f"Marked {failed} abandoned jobs as failed")
+                deleted = delete_old_job_files()
+                if deleted:
+                    self.stdout.write(f"Deleted {deleted} old job files")
+                last_cleanup = time.monotonic()
+
+            job = claim_next_export_job()
+            if job is not None:
+                self.stdout.write(f"Processing export job {job.pk}")
+                # On a connection of its own, the parallel processes close the other connections
+                with advisory_lock(job_lock(job), dedicated=True):
+                    run_export_job(job)
+                self.stdout.write(f"Export job {job.pk}: {job.get_status_display()}")
+                continue
+
+            job = claim_next_import_job()
+            if job is not None:
+                self.stdout.write(f"Processing import job {job.pk}")
+                with advisory_lock(job_lock(job), dedicated=True):
+                    run_import_job(job)
+                self.stdout.write(f"Import job {job.pk}: {job.get_status_display()}")
+                continue
+
+            if kwargs["once"]:
+                break
+            time.sleep(kwargs["poll_interval"])
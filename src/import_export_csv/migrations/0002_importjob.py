@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("import_export_csv", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportJob",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "In de wachtrij"),
+                            ("running", "Bezig"),
+                            ("done", "Klaar"),
+                            ("failed", "Mislukt"),
+                        ],
+                        default="pending",
+                        max_length=10,
+                    ),
+                ),
+                ("error", models.TextField(blank=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True, verbose_name="Aanmaakdatum")),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                ("file_name", models.CharField(max_length=255, verbose_name="Bestand")),
+                ("original_name", models.CharField(blank=True, max_length=255, verbose_name="Geüpload bestand")),
+                ("rows_processed", models.IntegerField(default=0, verbose_name="Verwerkte rijen")),
+                ("error_rows", models.IntegerField(default=0, verbose_name="Rijen met fouten")),
+                ("total_rows", models.IntegerField(blank=True, null=True, verbose_name="Totaal aantal rijen")),
+                ("report", models.JSONField(blank=True, default=list, verbose_name="Verslag")),
+                (
+                    "created_by",
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-created_at"],
+                "abstract": False,
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("import_export_csv", "0002_importjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="importjob",
+            name="error_report",
+            field=models.CharField(blank=True, max_length=255, verbose_name="Foutenverslag"),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("import_export_csv", "0003_importjob_error_report"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="exportjob",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "In de wachtrij"),
+                    ("waiting", "Wacht op een andere import"),
+                    ("running", "Bezig"),
+                    ("done", "Klaar"),
+                    ("failed", "Mislukt"),
+                ],
+                default="pending",
+                max_length=10,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="importjob",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "In de wachtrij"),
+                    ("waiting", "Wacht op een andere import"),
+                    ("running", "Bezig"),
+                    ("done", "Klaar"),
+                    ("failed", "Mislukt"),
+                ],
+                default="pending",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.contrib.messages import constants as message_constants
+from django.db import models
+
+
+class BackgroundJob(models.Model):
+    """
+    A job that is processed by the background worker (`manage.py process_jobs`)
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "In de wachtrij"
+        # Started, but waiting until another import is finished, see import_export_csv.handle_import.IMPORT_LOCK
+        WAITING = "waiting", "Wacht op een andere import"
+        RUNNING = "running", "Bezig"
+        DONE = "done", "Klaar"
+        FAILED = "failed", "Mislukt"
+
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    error = models.TextField(blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(verbose_name="Aanmaakdatum", auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (self.Status.DONE, self.Status.FAILED)
+
+    class Meta:
+        abstract = True
+        ordering = ["-created_at"]
+
+
+class ExportJob(BackgroundJob):
+    """
+    A location export that is written to storage by the background worker
+    """
+
+    params = models.JSONField(verbose_name="Zoekparameters", default=dict, blank=True)
+    columns = models.JSONField(verbose_name="Kolommen", default=list, blank=True)
+    rows_written = models.IntegerField(verbose_name="Geschreven rijen", default=0)
+    total_rows = models.IntegerField(verbose_name="Totaal aantal rijen", blank=True, null=True)
+    file_name = models.CharField(verbose_name="Bestand", max_length=255, blank=True)
+
+    def __str__(self):
+        return f"Export {self.pk} ({self.get_status_display()})"
+
+    @property
+    def progress(self) -> int:
+        """Percentage of the rows written"""
+        if not self.total_rows:
+            return 100 if self.status == self.Status.DONE else 0
+        return int(self.rows_written * 100 / self.total_rows)
+
+
+class ImportJob(BackgroundJob):
+    """
+    A location import of an uploaded file that is stored and processed by the background worker
+    """
+
+    file_name = models.CharField(verbose_name="Bestand", max_length=255)
+    original_name = models.CharField(verbose_name="Geüpload bestand", max_length=255, blank=True)
+    rows_processed = models.IntegerField(verbose_name="Verwerkte rijen", default=0)
+    error_rows = models.IntegerField(verbose_name="Rijen met fouten", default=0)
+    total_rows = models.IntegerField(verbose_name="Totaal aantal rijen", blank=True, null=True)
+    # The messages of the import, as [level, message] with the levels of django.contrib.messages
+    report = models.JSONField(verbose_name="Verslag", default=list, blank=True)
+    # Name of the stored report with all rows with errors, see import_export_csv.error_report
+    error_report = models.CharField(verbose_name="Foutenverslag", max_length=255, blank=True)
+
+    def __str__(self):
+        return f"Import {self.pk} ({self.get_status_display()})"
+
+    @property
+    def progress(self) -> int:
+        """Percentage of the rows processed"""
+        if not self.total_rows:
+            return 100 if self.status == self.Status.DONE else 0
+        return min(int(self.rows_processed * 100 / self.total_rows), 100)
+
+    @property
+    def report_messages(self) -> list[tuple[str, str]]:
+        """The messages of the report as (tag, message), with the tags of django.contrib.messages"""
+        return [(message_constants.DEFAULT_TAGS.get(level, ""), message) for level, message in self.report]
@@ -0,0 +1,211 @@
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+
+from fblocatie.models import Adres, Locatie, Vastgoed
+from import_export_csv.batch_importer import CHUNK_SIZE, BatchImporter, current_links
+from import_export_csv.importer import ADRES_MATCH_KEYS, LOCATIE_MATCH_KEYS, VASTGOED_MATCH_KEYS, ImporterProcessCSV
+
+
+class RowDiff:
+    """The changes that a row of an import file would make"""
+
+    CREATED = "created"
+    UPDATED = "updated"
+    UNCHANGED = "unchanged"
+    ERROR = "error"
+
+    LABELS = {CREATED: "Nieuw", UPDATED: "Gewijzigd", UNCHANGED: "Ongewijzigd", ERROR: "Fout"}
+
+    def __init__(self, index: int, locatie_id, status: str, changes: dict | None = None, errors: dict | None = None):
+        self.index = index
+        self.locatie_id = locatie_id
+        self.status = status
+        # {field: (current value, imported value)}; fields of the adres and vastgoed are prefixed with "adres." and
+        # "vastgoed.", related objects are described by their name
+        self.changes = changes or {}
+        self.errors = errors or {}
+
+    @property
+    def label(self) -> str:
+        return self.LABELS[self.status]
+
+    def __repr__(self):
+        return f"RowDiff({self.index}, {self.locatie_id!r}, {self.status!r}, {self.changes!r}, {self.errors!r})"
+
+
+class ImportPreview:
+    """Compute the changes of an import without writing to the database.
+
+    Rows are parsed with the lookups of the ImporterProcessCSV and compared, per chunk, with the current locaties,
+    adressen, vastgoed and many to many links, which are loaded with a few queries per chunk. Every row is compared
+    with the current state of the database, not with the changes of earlier rows in the same file.
+
+    import_rows() has the interface of BatchImporter.import_rows(), so a preview can replace the import; the diffs of
+    the rows are collected in `diffs`.
+    """
+
+    def __init__(self, importer: ImporterProcessCSV | None = None, chunk_size: int = CHUNK_SIZE):
+        self.batch = BatchImporter(importer, chunk_size)
+        self.chunk_size = chunk_size
+        self.diffs = []
+
+    def import_rows(self, rows):
+        """Preview (index, row) pairs and yield (index, locatie_id, errors) for every row, in file order"""
+        for diff in self.preview_rows(rows):
+            self.diffs.append(diff)
+            yield diff.index, diff.locatie_id, diff.errors
+
+    def preview_rows(self, rows):
+        """Yield a RowDiff for every (index, row) pair, in file order"""
+        chunk = []
+        for index, row in rows:
+            parsed, errors = self.batch.parse_row(index, row)
+            if parsed is None:
+                yield from self.preview_chunk(chunk)
+                chunk = []
+                yield RowDiff(index, row.get("afkorting"), RowDiff.ERROR, errors=errors)
+                continue
+
+            chunk.append(parsed)
+            if len(chunk) >= self.chunk_size:
+                yield from self.preview_chunk(chunk)
+                chunk = []
+        yield from self.preview_chunk(chunk)
+
+    def summary(self) -> dict[str, int]:
+        """Number of rows per status of the rows previewed so far"""
+        counts = dict.fromkeys(RowDiff.LABELS, 0)
+        for diff in self.diffs:
+            counts[diff.status] += 1
+        return counts
+
+    def summary_labels(self) -> list[tuple[str, int]]:
+        """(label, number of rows) per status"""
+        return [(RowDiff.LABELS[status], count) for status, count in self.summary().items()]
+
+    def preview_chunk(self, parsed_rows: list):
+        if not parsed_rows:
+            return
+        bulk_rows, conflict_rows = BatchImporter.match_existing(parsed_rows)
+        diffs = {
+            parsed.index: RowDiff(
+                parsed.index, parsed.locatie_id, RowDiff.ERROR, errors={parsed.conflict[0]: [parsed.conflict[1]]}
+            )
+            for parsed in conflict_rows
+        }
+
+        pandcodes = [parsed.locatie["pandcode"] for parsed in bulk_rows]
+        locaties = Locatie.objects.filter(pandcode__in=pandcodes).in_bulk()
+        vastgoed = {
+            obj.adres_id: obj
+            for obj in Vastgoed.objects.filter(
+                adres__in=[parsed.existing_adres for parsed in bulk_rows if parsed.existing_adres is not None]
+            )
+        }
+        namen = dict(
+            Locatie.objects.filter(naam__in=[parsed.locatie["naam"] for parsed in bulk_rows]).values_list(
+                "naam", "pandcode"
+            )
+        )
+        links = {
+            field: current_links(field, locaties)
+            for field in {field for parsed in bulk_rows for field in parsed.many_to_many}
+        }
+
+        for parsed in bulk_rows:
+            diffs[parsed.index] = self.compare(parsed, locaties, vastgoed, namen, links)
+
+        self.describe(list(diffs.values()))
+        for index in sorted(diffs):
+            yield diffs[index]
+
+    @staticmethod
+    def compare(parsed, locaties: dict, vastgoed: dict, namen: dict, links: dict) -> RowDiff:
+        """Compare a parsed row with the current objects it would update"""
+        pandcode = parsed.locatie["pandcode"]
+        if namen.get(parsed.locatie["naam"], pandcode) != pandcode:
+            message = f"de naam {parsed.locatie['naam']} is al in gebruik bij pandcode {namen[parsed.locatie['naam']]}"
+            return RowDiff(parsed.index, parsed.locatie_id, RowDiff.ERROR, errors={"locatie": [message]})
+
+        locatie = locaties.get(pandcode)
+        current_adres = parsed.existing_adres
+        new_adres = Adres(**parsed.adres)
+        new_locatie = Locatie(**parsed.locatie)
+        changes, errors = {}, {}
+        try:
+            new_adres.normalize()
+        except ValidationError as e:
+            errors["adres"] = e.messages
+        new_locatie.normalize()
+
+        for section, prefix, new, data, match_keys, current in (
+            ("adres", "adres.", new_adres, parsed.adres, ADRES_MATCH_KEYS, current_adres),
+            (
+                "vastgoed",
+                "vastgoed.",
+                Vastgoed(**parsed.vastgoed),
+                parsed.vastgoed,
+                VASTGOED_MATCH_KEYS,
+                vastgoed.get(getattr(current_adres, "pk", None)),
+            ),
+            ("locatie", "", new_locatie, parsed.locatie, LOCATIE_MATCH_KEYS, locatie),
+        ):
+            for key in data:
+                if key in match_keys:
+                    continue
+                field = new._meta.get_field(key)
+                try:
+                    value = field.to_python(getattr(new, field.attname))
+                except ValidationError as e:
+                    errors.setdefault(section, []).extend(f"{field.name}: {message}" for message in e.messages)
+                    continue
+                current_value = getattr(current, field.attname) if current is not None else None
+                if value != current_value:
+                    changes[f"{prefix}{field.name}"] = (current_value, value)
+
+        if locatie is not None and locatie.adres_id != getattr(current_adres, "pk", None):
+            changes["adres"] = (locatie.adres_id, current_adres.pk if current_adres is not None else str(new_adres))
+
+        for field, ids in parsed.many_to_many.items():
+            current_ids = set(links[field][pandcode]) if locatie is not None else set()
+            if set(ids) != current_ids:
+                changes[field] = (current_ids, set(ids))
+
+        if errors:
+            status = RowDiff.ERROR
+        elif locatie is None:
+            status = RowDiff.CREATED
+        else:
+            status = RowDiff.UPDATED if changes else RowDiff.UNCHANGED
+        return RowDiff(parsed.index, parsed.locatie_id, status, changes, errors)
+
+    @staticmethod
+    def describe(diffs: list):
+        """Replace the ids of related objects in the changes by the names of the objects, with a query per model"""
+        relations = []
+        ids = defaultdict(set)
+        for diff in diffs:
+            for key, values in diff.changes.items():
+                section, _, name = key.rpartition(".")
+                field = {"adres": Adres, "vastgoed": Vastgoed, "": Locatie}[section]._meta.get_field(name)
+                if not field.is_relation:
+                    continue
+                relations.append((diff, key, field.related_model))
+                for value in values:
+                    ids[field.related_model].update(value if isinstance(value, set) else [value])
+
+        names = {
+            model: {
+                pk: str(obj) for pk, obj in model.objects.in_bulk([pk for pk in pks if isinstance(pk, int)]).items()
+            }
+            for model, pks in ids.items()
+        }
+
+        def name(model, value):
+            if isinstance(value, set):
+                return ", ".join(sorted(str(name(model, pk)) for pk in value))
+            return names[model].get(value, value)
+
+        for diff, key, model in relations:
+            diff.changes[key] = tuple(name(model, value) for value in diff.changes[key])
@@ -0,0 +1,65 @@
+import time
+from contextlib import contextmanager
+
+
+class ImportStats:
+    """The number of objects an import created, updated, left unchanged or failed to write, per model,
+    and the seconds spent per phase of the import.
+
+    The phases are parse (reading and parsing the rows), resolve (finding the existing objects), write (writing the
+    adressen, vastgoed and locaties, and the rows imported row by row) and m2m (the many to many links).
+    """
+
+    MODELS = {"locatie": "Locaties", "adres": "Adressen", "vastgoed": "Vastgoed"}
+    RESULTS = {"created": "nieuw", "updated": "gewijzigd", "unchanged": "ongewijzigd", "failed": "fout"}
+    PHASES = {"parse": "inlezen", "resolve": "opzoeken", "write": "schrijven", "m2m": "koppelingen"}
+
+    def __init__(self):
+        self.counts = {model: dict.fromkeys(self.RESULTS, 0) for model in self.MODELS}
+        self.timings = dict.fromkeys(self.PHASES, 0.0)
+
+    def add(self, model: str, result: str, count: int = 1):
+        self.counts[model][result] += count
+
+    @contextmanager
+    def timer(self, phase: str):
+        """Add the time spent in the with block to `phase`"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.perf_counter() - started
+
+    def timed(self, phase: str, iterable):
+        """Yield the items of `iterable` and add the time spent producing them to `phase`"""
+        iterator = iter(iterable)
+        while True:
+            with self.timer(phase):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    @property
+    def locaties_written(self) -> int:
+        return self.counts["locatie"]["created"] + self.counts["locatie"]["updated"]
+
+    def count_message(self) -> str:
+        return " ".join(
+            f"{label}: {', '.join(f'{self.counts[model][result]} {name}' for result, name in self.RESULTS.items())}."
+            for model, label in self.MODELS.items()
+        )
+
+    def timing_message(self) -> str:
+        timings = ", ".join(
+            f"{name} {self.timings[phase]:.2f}".replace(".", ",") for phase, name in self.PHASES.items()
+        )
+        return f"Tijd per fase (seconden): {timings}."
+
+    def __str__(self):
+        counts = "; ".join(
+            f"{model} " + ", ".join(f"{count} {result}" for result, count in self.counts[model].items())
+            for model in self.MODELS
+        )
+        timings = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in self.timings.items())
+        return f"{counts}; {timings}"
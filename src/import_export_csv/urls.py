@@ -1,8 +1,19 @@
 from django.urls import path
 
-from import_export_csv.views import LocatieImportView, LocationExportView
+from import_export_csv.views import (
+    ExportJobDownloadView,
+    ExportJobView,
+    ImportErrorReportView,
+    ImportJobView,
+    LocatieImportView,
+    LocationExportView,
+)
 
 urlpatterns = [
     path("import", view=LocatieImportView.as_view(), name="locatie-import"),
+    path("import/<int:pk>", view=ImportJobView.as_view(), name="import-job"),
+    path("import/fouten/<str:name>", view=ImportErrorReportView.as_view(), name="import-error-report"),
     path("export", view=LocationExportView.as_view(), name="locatie-export"),
+    path("export/<int:pk>", view=ExportJobView.as_view(), name="export-job"),
+    path("export/<int:pk>/download", view=ExportJobDownloadView.as_view(), name="export-job-download"),
 ]
@@ -1,12 +1,21 @@
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.shortcuts import render
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404, redirect, render
 from django.views.generic import View
 
-from import_export_csv.forms import LocatieImportForm
-from import_export_csv.handle_import import handle_import_csv
+from import_export_csv.error_report import ImportErrorReport, report_path
+from import_export_csv.forms import LocatieExportForm, LocatieImportForm
+from import_export_csv.handle_import import IMPORT_LOCK, handle_import_csv, is_csv_file
+from import_export_csv.jobs import create_import_job
+from import_export_csv.models import ExportJob, ImportJob
+from import_export_csv.preview import ImportPreview
+from shared.locks import try_advisory_lock
+from shared.singleflight import single_flight, single_flight_key
 
-from .exporter import fetch_locations_for_export, get_csv_response
+from .exporter import csv_response, fetch_locations_for_export, get_csv_response
 
 
 class IsStaffMixin(UserPassesTestMixin):
@@ -26,15 +35,35 @@ class LocatieImportView(LoginRequiredMixin, IsStaffMixin, View):
 
     def post(self, request):
         form = self.form(request.POST, request.FILES)
-        if form.is_valid():
+        preview = None
+        error_report = ImportErrorReport()
+        if form.is_valid() and form.cleaned_data.get("dry_run"):
+            # Nothing is written, so the preview of a large file fits in the request as well
+            preview = ImportPreview()
+            location_added = handle_import_csv(
+                request, form.cleaned_data.get("csv_file"), importer=preview, error_report=error_report
+            )
+            messages.add_message(request, messages.INFO, "Proefimport: er is niets opgeslagen.")
+        elif form.is_valid():
             csv_file = form.cleaned_data.get("csv_file")
-            location_added = handle_import_csv(request, csv_file)
+            # Large files are imported by the background worker, to stay within the request timeout
+            if is_csv_file(csv_file) and csv_file.size > settings.IMPORT_ASYNC_THRESHOLD:
+                job = create_import_job(csv_file, request.user)
+                return redirect("import_export_urls:import-job", pk=job.pk)
+            with try_advisory_lock(IMPORT_LOCK) as acquired:
+                if acquired:
+                    location_added = handle_import_csv(request, csv_file, error_report=error_report)
+            if not acquired:
+                # Another import is running; the background worker imports the file when that one is finished
+                job = create_import_job(csv_file, request.user)
+                return redirect("import_export_urls:import-job", pk=job.pk)
         else:
             message = "Het formulier is niet juist ingevuld."
             messages.add_message(request, messages.ERROR, message)
             location_added = 0
 
-        context = {"form": form}
+        # The messages only summarize the errors, all rows with errors are in the report
+        context = {"form": form, "preview": preview, "error_report": error_report.save() if error_report else None}
         if location_added > 0:
             # Message for succesful imports
             message = f"{location_added} locatie(s) geïmporteerd/ge-update."
@@ -42,15 +71,85 @@ class LocatieImportView(LoginRequiredMixin, IsStaffMixin, View):
         return render(request, template_name=self.template_name, context=context)
 
 
+class ImportJobView(LoginRequiredMixin, IsStaffMixin, View):
+    template = "import_export_csv/locatie-import-job.html"
+
+    def get(self, request, pk: int, *args, **kwargs):
+        job = get_object_or_404(ImportJob, pk=pk)
+        return render(request=request, template_name=self.template, context={"job": job})
+
+
+class ImportErrorReportView(LoginRequiredMixin, IsStaffMixin, View):
+    def get(self, request, name: str, *args, **kwargs):
+        try:
+            path = report_path(name)
+        except ValueError:
+            raise Http404 from None
+        if not default_storage.exists(path):
+            raise Http404
+        return FileResponse(default_storage.open(path, "rb"), as_attachment=True, filename=name)
+
+
 class LocationExportView(LoginRequiredMixin, View):
     template = "import_export_csv/locatie-export.html"
+    form = LocatieExportForm
 
     def get(self, request, *args, **kwargs):
         if request.GET:
-            locations = fetch_locations_for_export().search_filter(params=request.GET.dict(), user=request.user)
-            return get_csv_response(locations)
-        return render(request=request, template_name=self.template)
+            form = self.form(request.GET)
+            if not form.is_valid():
+                return self._render_invalid(request, form)
+            columns = form.cleaned_data["columns"]
+            params = request.GET.dict()
+            locations = fetch_locations_for_export(columns).search_filter(params=params, user=request.user)
+            return self._export(request, locations, columns, params)
+        return render(request=request, template_name=self.template, context={"form": self.form()})
 
     def post(self, request, *args, **kwargs):
-        all_locations = fetch_locations_for_export()
-        return get_csv_response(all_locations)
+        form = self.form(request.POST)
+        if not form.is_valid():
+            return self._render_invalid(request, form)
+        columns = form.cleaned_data["columns"]
+        all_locations = fetch_locations_for_export(columns)
+        return self._export(request, all_locations, columns)
+
+    def _export(self, request, locations, columns, params=None):
+        # Large exports are written by the background worker, to stay within the request timeout
+        if locations.count() > settings.EXPORT_ASYNC_THRESHOLD:
+            job = ExportJob.objects.create(params=params or {}, columns=columns, created_by=request.user)
+            return redirect("import_export_urls:export-job", pk=job.pk)
+
+        # Identical exports requested at the same time by different users are only built once
+        key = single_flight_key("locatie-export", params=params, columns=columns, is_staff=request.user.is_staff)
+        return csv_response(single_flight(key, lambda: get_csv_response(locations, columns).content))
+
+    def _render_invalid(self, request, form):
+        message = "Het formulier is niet juist ingevuld."
+        messages.add_message(request, messages.ERROR, message)
+        return render(request=request, template_name=self.template, context={"form": form})
+
+
+class ExportJobMixin(LoginRequiredMixin):
+    def get_job(self, pk: int) -> ExportJob:
+        job = get_object_or_404(ExportJob, pk=pk)
+        # Exports can contain archived locations, only show them to the user that requested them
+        if job.created_by != self.request.user and not self.request.user.is_staff:
+            raise Http404
+        return job
+
+
+class ExportJobView(ExportJobMixin, View):
+    template = "import_export_csv/locatie-export-job.html"
+
+    def get(self, request, pk: int, *args, **kwargs):
+        return render(request=request, template_name=self.template, context={"job": self.get_job(pk)})
+
+
+class ExportJobDownloadView(ExportJobMixin, View):
+    def get(self, request, pk: int, *args, **kwargs):
+        job = self.get_job(pk)
+        # The file is deleted after JOB_FILE_RETENTION_DAYS, see jobs.delete_old_job_files()
+        if job.status != ExportJob.Status.DONE or not job.file_name:
+            raise Http404
+        file_name = job.file_name.rsplit("/", 1)[-1]
+        return FileResponse(default_storage.open(job.file_name, "rb"), as_attachment=True, filename=file_name)
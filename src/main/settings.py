@@ -216,6 +216,39 @@ if os.getenv("AZURE_FEDERATED_TOKEN_FILE"):
     STORAGES |= STORAGE_AZURE  # update storages with storage_azure
 
 
+# Caches
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Shared by all uwsgi workers; the table is created by the migrations of the shared app
+    "shared": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "shared_cache",
+    },
+}
+
+# Seconds that the result of a coalesced computation (shared.singleflight) is reused
+SINGLE_FLIGHT_TIMEOUT = int(os.getenv("SINGLE_FLIGHT_TIMEOUT", 10))
+# Seconds that the matching locations of a coalesced search are reused. Short, so only searches that overlap share
+# the result and a search does not miss recent changes
+SINGLE_FLIGHT_SEARCH_TIMEOUT = int(os.getenv("SINGLE_FLIGHT_SEARCH_TIMEOUT", 1))
+
+# Exports with more locations than this threshold are written by the background worker (manage.py process_jobs)
+EXPORT_ASYNC_THRESHOLD = int(os.getenv("EXPORT_ASYNC_THRESHOLD", 1000))
+
+# Number of processes that build a background export in parallel shards (1: no parallel processes)
+EXPORT_PROCESSES = int(os.getenv("EXPORT_PROCESSES", 1))
+
+# Uploaded import files larger than this number of bytes are imported by the background worker (manage.py process_jobs)
+IMPORT_ASYNC_THRESHOLD = int(os.getenv("IMPORT_ASYNC_THRESHOLD", 512 * 1024))
+
+# Number of processes that parse the rows of a background import in parallel (1: no parallel processes)
+IMPORT_PROCESSES = int(os.getenv("IMPORT_PROCESSES", 1))
+
+# Days that export files and import error reports are kept, they contain personal data (manage.py process_jobs)
+JOB_FILE_RETENTION_DAYS = int(os.getenv("JOB_FILE_RETENTION_DAYS", 7))
+
 # Content Security Policy (CSP) settings
 CONTENT_SECURITY_POLICY = {
     "DIRECTIVES": {
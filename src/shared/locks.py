@@ -0,0 +1,61 @@
+import hashlib
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def advisory_lock_id(name: str) -> int:
+    """Return a stable signed 64 bit PostgreSQL advisory lock id for `name`"""
+    digest = hashlib.sha256(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], byteorder="big", signed=True)
+
+
+def _unlock(connection, lock_id: int):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_id])
+
+
+@contextmanager
+def advisory_lock(name: str, using: str = DEFAULT_DB_ALIAS, on_wait=None, dedicated: bool = False):
+    """Hold a PostgreSQL session level advisory lock on `name` for the duration of the context.
+
+    Blocks until the lock is available. Every process or thread that uses the same name waits for the current holder.
+    When another session holds the lock, `on_wait()` is called before waiting for it.
+
+    A `dedicated` lock is held on a database connection of its own, which is not closed by connections.close_all(),
+    for example by shared.parallel.fork_map(). Closing the connection would release the lock.
+    """
+    lock_id = advisory_lock_id(name)
+    connection = connections.create_connection(using) if dedicated else connections[using]
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [lock_id])
+        if not cursor.fetchone()[0]:
+            if on_wait is not None:
+                on_wait()
+            cursor.execute("SELECT pg_advisory_lock(%s)", [lock_id])
+    try:
+        yield
+    finally:
+        _unlock(connection, lock_id)
+        if dedicated:
+            connection.close()
+
+
+@contextmanager
+def try_advisory_lock(name: str, using: str = DEFAULT_DB_ALIAS):
+    """Hold the advisory lock on `name` for the duration of the context if no other session holds it.
+
+    Does not wait; yields whether the lock was taken.
+    """
+    lock_id = advisory_lock_id(name)
+    connection = connections[using]
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [lock_id])
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            _unlock(connection, lock_id)
@@ -0,0 +1,31 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import connections
+
+
+def fork_map(func, iterable, processes: int):
+    """Yield `func(item)` for every item of `iterable`, computed in a pool of forked processes, in the original order.
+
+    The processes are forked from the current process, so they share its loaded Django setup. The database connections
+    of the current process are closed before forking, every process opens its own connection. Do not call this inside
+    a transaction, as that would be closed as well.
+
+    The processes are forked when the first item is submitted, so `func` can use module globals that are set before
+    calling this, instead of receiving large objects with every item that are pickled each time.
+
+    Items are taken from `iterable` while the results are consumed, at most two per process ahead of the result
+    that is yielded, so a large iterable is not read into memory at once.
+    """
+    # A connection that is shared with forked processes is corrupted by their queries
+    connections.close_all()
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork")) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
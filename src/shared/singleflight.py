@@ -0,0 +1,43 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .locks import advisory_lock
+
+# Cache that is shared by all uwsgi workers
+SHARED_CACHE = "shared"
+
+_MISSING = object()
+
+
+def single_flight_key(prefix: str, **parts) -> str:
+    """Build a cache key for `prefix` from json serialisable parts"""
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"{prefix}:{digest}"
+
+
+def single_flight(key: str, compute, timeout: int | None = None):
+    """Return the result of `compute()`, computed only once for concurrent calls with the same key.
+
+    The first caller takes a PostgreSQL advisory lock on the key and stores the result in the shared cache.
+    Callers that arrive while it is computing wait for the lock and reuse the cached result instead of computing it
+    again. Results are kept for `timeout` seconds (default: settings.SINGLE_FLIGHT_TIMEOUT).
+    """
+    if timeout is None:
+        timeout = settings.SINGLE_FLIGHT_TIMEOUT
+    cache = caches[SHARED_CACHE]
+
+    result = cache.get(key, _MISSING)
+    if result is not _MISSING:
+        return result
+
+    with advisory_lock(f"single-flight:{key}"):
+        # Another worker may have computed the result while we were waiting for the lock
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = compute()
+            cache.set(key, result, timeout)
+
+    return result
@@ -0,0 +1,52 @@
+import pytest
+
+from referentie_tabellen.models import DienstverleningsKader, Directie, LocatieBezit, LocatieSoort, Voorziening
+
+
+@pytest.fixture()
+def storage_dir(settings, tmp_path):
+    """Keep the files of the default storage in a temporary directory"""
+    settings.MEDIA_ROOT = str(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture()
+def referenties():
+    """The referentie tabel values that the rows of csv_row refer to"""
+    LocatieSoort.objects.create(name="Kantoor")
+    DienstverleningsKader.objects.create(name="Basis", dvk_nr=1)
+    LocatieBezit.objects.create(name="ntb")
+    LocatieBezit.objects.create(name="Eigendom")
+    Directie.objects.create(name="Directie")
+    Voorziening.objects.create(name="Fietsenstalling")
+    Voorziening.objects.create(name="Lift")
+
+
+@pytest.fixture()
+def csv_row():
+    """Build a row of an import file for pandcode and huisnummer `nummer`, with `columns` replacing the defaults"""
+
+    def build(nummer: int, **columns) -> dict:
+        row = {
+            "pandcode": str(nummer),
+            "naam": f"Locatie {nummer}",
+            "afkorting": f"L{nummer}",
+            "soort": "Kantoor",
+            "dvk_naam": "Basis",
+            "ambtenaar": "Ja",
+            "vlekken": "Directie",
+            "voorz": "Fietsenstalling",
+            "straat": "straat",
+            "postcode": "1000 AA",
+            "huisnummer": str(nummer),
+            "huisletter": "",
+            "numtoeg": "",
+            "plaats": "amsterdam",
+            "bezit": "",
+            "vvo": "12,5",
+            "bouwjaar": "1990",
+        }
+        row.update(columns)
+        return row
+
+    return build
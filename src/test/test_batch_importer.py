@@ -0,0 +1,403 @@
+import io
+from unittest.mock import patch
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from model_bakery import baker
+
+from fblocatie.models import Adres, Locatie, Vastgoed, compute_pandcode
+from import_export_csv import batch_importer
+from import_export_csv.batch_importer import BatchImporter, sync_many_to_many
+from import_export_csv.importer import ImporterProcessCSV
+from referentie_tabellen.models import LocatieBezit, LocatieSoort, Voorziening
+from shared.parallel import fork_map
+
+
+def _snapshot() -> dict:
+    """The imported data, without ids and timestamps that differ between imports"""
+    return {
+        "adressen": list(
+            Adres.objects.order_by("postcode", "huisnummer").values(
+                "straat", "postcode", "huisnummer", "huisletter", "huisnummertoevoeging", "woonplaats"
+            )
+        ),
+        "vastgoed": list(
+            Vastgoed.objects.order_by("adres__huisnummer").values("adres__huisnummer", "bezit__name", "vvo")
+        ),
+        "locaties": list(
+            Locatie.objects.values(
+                "pandcode",
+                "naam",
+                "afkorting",
+                "ambtenaar",
+                "routecode",
+                "locatie_soort__name",
+                "adres__huisnummer",
+                "vastgoed__adres__huisnummer",
+            )
+        ),
+        "voorzieningen": list(
+            Locatie.voorzieningen.through.objects.order_by("locatie").values_list("locatie", flat=True)
+        ),
+        "pand_directies": list(
+            Locatie.pand_directies.through.objects.order_by("locatie").values_list("locatie", flat=True)
+        ),
+    }
+
+
+def _import(rows: list, bulk: bool) -> tuple[list, dict]:
+    """Import the rows in a transaction that is rolled back, return the results and the imported data"""
+    with transaction.atomic():
+        importer = BatchImporter(ImporterProcessCSV(), chunk_size=3)
+        copies = ((i, dict(row)) for i, row in enumerate(rows))
+        if bulk:
+            results = list(importer.import_rows(copies))
+        else:
+            results = [importer.import_row(i, row) for i, row in copies]
+        snapshot = _snapshot()
+        transaction.set_rollback(True)
+    # Compare errors on their first line, the details of database errors contain ids and timestamps
+    results = [
+        (i, locatie_id, {key: [str(error).split("\n")[0] for error in value] for key, value in errors.items()})
+        for i, locatie_id, errors in results
+    ]
+    return results, snapshot
+
+
+@pytest.mark.django_db
+def test_import_rows_creates_and_updates_in_bulk(referenties, csv_row):
+    rows = [csv_row(nummer) for nummer in range(1, 6)]
+
+    results = list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+
+    assert results == [(i, f"L{i + 1}", {}) for i in range(5)]
+    locatie = Locatie.objects.get(pandcode=3)
+    assert locatie.adres.postcode == "1000AA"
+    assert locatie.adres.straat == "Straat"
+    assert locatie.vastgoed.bezit.name == "ntb"
+    assert locatie.vastgoed.vvo == 12.5
+    assert locatie.ambtenaar is True
+    assert locatie.routecode == "FB"
+    assert locatie.voorzieningen.get().name == "Fietsenstalling"
+
+    rows = [csv_row(nummer, naam=f"Gewijzigd {nummer}", bezit="Eigendom", voorz="") for nummer in range(1, 6)]
+    results = list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+
+    assert all(errors == {} for _, _, errors in results)
+    assert Adres.objects.count() == Vastgoed.objects.count() == Locatie.objects.count() == 5
+    locatie = Locatie.objects.get(pandcode=3)
+    assert locatie.naam == "Gewijzigd 3"
+    assert locatie.vastgoed.bezit.name == "Eigendom"
+    assert not locatie.voorzieningen.exists()
+
+
+@pytest.mark.django_db
+def test_import_rows_uses_fewer_queries_than_row_by_row(referenties, csv_row):
+    rows = [csv_row(nummer) for nummer in range(1, 51)]
+    bulk_rows = [csv_row(nummer) for nummer in range(101, 151)]
+
+    with CaptureQueriesContext(connection) as row_by_row:
+        importer = BatchImporter(ImporterProcessCSV())
+        for i, row in enumerate(rows):
+            importer.import_row(i, row)
+    with CaptureQueriesContext(connection) as bulk:
+        list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(bulk_rows)))
+
+    assert Locatie.objects.count() == 100
+    assert len(bulk.captured_queries) * 5 < len(row_by_row.captured_queries)
+
+
+@pytest.mark.django_db
+def test_import_rows_matches_row_by_row_import(referenties, csv_row):
+    BatchImporter().import_row(0, csv_row(90, naam="Bestaand", afkorting="B90"))
+    rows = [
+        csv_row(1),
+        csv_row(2, soort="Onbekend"),
+        csv_row(3, voorz="Fietsenstalling | Onbekend"),
+        csv_row(4),
+        # Updates the adres and locatie of the first row
+        csv_row(1, straat="Nieuwe straat"),
+        # Pandcode of an existing locatie with another afkorting
+        csv_row(90),
+        csv_row(5, pandcode="geen nummer"),
+        csv_row(6, naam="Bestaand"),
+        csv_row(7),
+    ]
+
+    assert _import(rows, bulk=True) == _import(rows, bulk=False)
+
+
+@pytest.mark.django_db
+def test_import_rows_falls_back_to_row_by_row_when_bulk_write_fails(referenties, csv_row):
+    BatchImporter().import_row(0, csv_row(90, naam="Bestaand", afkorting="B90"))
+    # The naam of the second row already exists, which fails the bulk write of the chunk
+    rows = [csv_row(1), csv_row(2, naam="Bestaand"), csv_row(3)]
+
+    results = list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+
+    assert [(i, locatie_id, list(errors)) for i, locatie_id, errors in results] == [
+        (0, "L1", []),
+        (1, "L2", ["locatie"]),
+        (2, "L3", []),
+    ]
+    assert "locatie niet aangemaakt" in results[1][2]["locatie"][0]
+    assert set(Locatie.objects.values_list("pandcode", flat=True)) == {1, 3, 90}
+
+
+@pytest.mark.django_db
+def test_import_rows_advances_pandcode_sequence(referenties, csv_row):
+    pandcode = compute_pandcode() + 100
+
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate([csv_row(pandcode - 1), csv_row(pandcode)])))
+
+    assert compute_pandcode() == pandcode + 1
+
+
+@pytest.mark.django_db
+def test_import_rows_derives_lat_lon_from_rd_coordinates(referenties, csv_row):
+    rows = [csv_row(1, rd_x="122324", rd_y="487928"), csv_row(2, rd_x="131508", rd_y="479894"), csv_row(3)]
+
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+
+    assert list(Adres.objects.order_by("huisnummer").values_list("lat", "lon")) == [
+        (52.378247, 4.907321),
+        (52.306511, 5.042756),
+        (None, None),
+    ]
+
+
+@pytest.mark.django_db
+def test_import_rows_derives_lat_lon_of_existing_adressen_from_changed_rd_coordinates(referenties, csv_row):
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate([csv_row(1, rd_x="122324", rd_y="487928")])))
+
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate([csv_row(1, rd_x="131508", rd_y="479894")])))
+
+    adres = Adres.objects.get()
+    assert (adres.lat, adres.lon) == (52.306511, 5.042756)
+    assert "center=52.306511%2C5.042756" in adres.map_url
+
+
+@pytest.mark.django_db
+def test_import_rows_skips_unchanged_rows(referenties, csv_row):
+    rows = [csv_row(nummer) for nummer in range(1, 51)]
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+    updated_at = dict(Locatie.objects.values_list("pandcode", "updated_at"))
+
+    importer = BatchImporter(ImporterProcessCSV())
+    with CaptureQueriesContext(connection) as unchanged:
+        results = list(importer.import_rows(enumerate(rows)))
+
+    assert results == [(i, f"L{i + 1}", {}) for i in range(50)]
+    assert importer.stats.counts["locatie"]["unchanged"] == 50
+    assert dict(Locatie.objects.values_list("pandcode", "updated_at")) == updated_at
+    assert not [query for query in unchanged.captured_queries if not query["sql"].startswith("SELECT")]
+
+
+@pytest.mark.django_db
+def test_import_rows_writes_changed_rows(referenties, csv_row):
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate([csv_row(1), csv_row(2), csv_row(3)])))
+
+    importer = BatchImporter(ImporterProcessCSV())
+    rows = [csv_row(1, naam="Gewijzigd"), csv_row(2, voorz="Fietsenstalling | Lift"), csv_row(3), csv_row(4)]
+    list(importer.import_rows(enumerate(rows)))
+
+    assert importer.stats.counts["locatie"]["unchanged"] == 1
+    assert Locatie.objects.get(pandcode=1).naam == "Gewijzigd"
+    assert Locatie.objects.get(pandcode=2).voorzieningen.count() == 2
+    assert Locatie.objects.filter(pandcode=4).exists()
+
+
+@pytest.mark.django_db
+def test_import_row_by_row_clears_the_fingerprint(referenties, csv_row):
+    rows = [csv_row(1), csv_row(2)]
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+
+    # Like a row that is imported row by row after a lookup error, a conflict or a failed bulk write
+    BatchImporter(ImporterProcessCSV()).import_row(0, csv_row(1, naam="Versie 2"))
+    assert Locatie.objects.get(pandcode=1).import_fingerprint == ""
+
+    importer = BatchImporter(ImporterProcessCSV())
+    list(importer.import_rows(enumerate(rows)))
+
+    assert importer.stats.counts["locatie"]["unchanged"] == 1
+    assert Locatie.objects.get(pandcode=1).naam == "Locatie 1"
+
+
+@pytest.mark.django_db
+def test_saving_outside_the_import_clears_the_fingerprint(referenties, csv_row):
+    rows = [csv_row(1), csv_row(2), csv_row(3)]
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+    locatie = Locatie.objects.get(pandcode=1)
+    locatie.naam = "Handmatig"
+    locatie.save()
+    vastgoed = Vastgoed.objects.get(adres__huisnummer=2)
+    vastgoed.bezit = LocatieBezit.objects.get(name="Eigendom")
+    vastgoed.save()
+
+    importer = BatchImporter(ImporterProcessCSV())
+    list(importer.import_rows(enumerate(rows)))
+
+    assert importer.stats.counts["locatie"]["unchanged"] == 1
+    assert Locatie.objects.get(pandcode=1).naam == "Locatie 1"
+    assert Vastgoed.objects.get(adres__huisnummer=2).bezit.name == "ntb"
+
+
+@pytest.mark.django_db
+def test_import_rows_links_other_locaties_to_the_new_vastgoed_at_their_adres(referenties, csv_row):
+    adres = Adres.objects.create(straat="straat", postcode="1000AA", huisnummer=1, woonplaats="amsterdam")
+    other = baker.make(Locatie, pandcode=50, adres=adres)
+    assert other.vastgoed is None
+
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate([csv_row(1), csv_row(2)])))
+
+    vastgoed = Vastgoed.objects.get(adres=adres)
+    assert Locatie.objects.get(pandcode=1).vastgoed == vastgoed
+    assert Locatie.objects.get(pandcode=50).vastgoed == vastgoed
+
+
+@pytest.mark.django_db
+def test_import_rows_counts_objects_per_model(referenties, csv_row):
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate([csv_row(1), csv_row(2), csv_row(3)])))
+    # An adres without vastgoed, for a new locatie
+    Adres.objects.create(straat="Straat", postcode="1000AA", huisnummer=4, woonplaats="Amsterdam")
+    BatchImporter().import_row(0, csv_row(90, naam="Bestaand", afkorting="B90"))
+    rows = [
+        csv_row(1),
+        csv_row(2, naam="Gewijzigd"),
+        csv_row(4),
+        csv_row(5),
+        # Imported row by row, the adres and vastgoed are written before the locatie fails
+        csv_row(6, soort="Onbekend"),
+        csv_row(90, afkorting="X90"),
+    ]
+
+    importer = BatchImporter(ImporterProcessCSV())
+    list(importer.import_rows(enumerate(rows)))
+
+    assert importer.stats.counts == {
+        "locatie": {"created": 2, "updated": 1, "unchanged": 1, "failed": 2},
+        "adres": {"created": 2, "updated": 3, "unchanged": 1, "failed": 0},
+        "vastgoed": {"created": 3, "updated": 2, "unchanged": 1, "failed": 0},
+    }
+    assert importer.stats.locaties_written == 3
+    assert set(importer.stats.timings) == {"parse", "resolve", "write", "m2m"}
+    assert all(seconds > 0 for seconds in importer.stats.timings.values())
+    assert importer.stats.count_message().startswith("Locaties: 2 nieuw, 1 gewijzigd, 1 ongewijzigd, 2 fout.")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_rows_parses_in_parallel_processes(referenties, csv_row):
+    rows = [csv_row(nummer) for nummer in range(1, 8)]
+    rows[2] = csv_row(3, soort="Onbekend")
+    rows[4] = csv_row(5, pandcode="geen nummer")
+
+    serial = list(BatchImporter(chunk_size=3).parse_rows(enumerate(rows)))
+    parallel = list(BatchImporter(chunk_size=3, processes=2).parse_rows(enumerate(rows)))
+
+    assert [(index, row) for index, row, _ in parallel] == list(enumerate(rows))
+    assert [parsed is None for _, _, parsed in parallel] == [False, False, True, False, True, False, False]
+    assert [(parsed.locatie, parsed.fingerprint) for _, _, parsed in parallel if parsed] == [
+        (parsed.locatie, parsed.fingerprint) for _, _, parsed in serial if parsed
+    ]
+
+    results = list(BatchImporter(chunk_size=3, processes=2).import_rows(enumerate(rows)))
+
+    assert [(i, locatie_id, list(errors)) for i, locatie_id, errors in results] == [
+        (0, "L1", []),
+        (1, "L2", []),
+        (2, "L3", ["locatie"]),
+        (3, "L4", []),
+        (4, "L5", ["locatie"]),
+        (5, "L6", []),
+        (6, "L7", []),
+    ]
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 2, 4, 6, 7]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_rows_sends_only_the_rows_to_the_parsing_processes(referenties, csv_row):
+    rows = [csv_row(nummer) for nummer in range(1, 6)]
+    sent = []
+
+    def recording_fork_map(func, iterable, processes):
+        def record():
+            for item in iterable:
+                sent.append(item)
+                yield item
+
+        return fork_map(func, record(), processes)
+
+    with patch("import_export_csv.batch_importer.fork_map", recording_fork_map):
+        parsed = list(BatchImporter(chunk_size=2, processes=2).parse_rows(enumerate(rows)))
+
+    assert all(parsed_row is not None for _, _, parsed_row in parsed)
+    # The importer with its lookups is inherited by the forked processes, it is not pickled with every batch
+    assert sent == [list(enumerate(rows))[:2], list(enumerate(rows))[2:4], list(enumerate(rows))[4:]]
+    assert batch_importer._parse_importer is None
+
+
+@pytest.mark.django_db
+def test_sync_many_to_many_sets_links_with_three_queries(referenties, csv_row, django_assert_num_queries):
+    rows = [csv_row(nummer, voorz="") for nummer in range(1, 4)]
+    list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+    fiets = Voorziening.objects.get(name="Fietsenstalling")
+    lift = Voorziening.objects.get(name="Lift")
+    Locatie.objects.get(pandcode=1).voorzieningen.set([fiets])
+    Locatie.objects.get(pandcode=2).voorzieningen.set([fiets, lift])
+
+    with django_assert_num_queries(3):
+        added, removed = sync_many_to_many(
+            "voorzieningen", {1: [fiets.id, lift.id], 2: [lift.id], 3: [lift.id, lift.id]}
+        )
+
+    assert (added, removed) == (2, 1)
+    voorzieningen = Locatie.voorzieningen.through.objects.order_by("locatie", "voorziening")
+    assert list(voorzieningen.values_list("locatie", "voorziening")) == [
+        (1, fiets.id),
+        (1, lift.id),
+        (2, lift.id),
+        (3, lift.id),
+    ]
+
+    with django_assert_num_queries(1):
+        assert sync_many_to_many("voorzieningen", {1: [fiets.id, lift.id], 2: [lift.id]}) == (0, 0)
+
+
+@pytest.mark.django_db
+def test_import_rows_sets_many_to_many_per_chunk(referenties, csv_row):
+    rows = [csv_row(nummer) for nummer in range(1, 21)]
+
+    with CaptureQueriesContext(connection) as context:
+        list(BatchImporter(ImporterProcessCSV()).import_rows(enumerate(rows)))
+
+    through_queries = [q["sql"] for q in context.captured_queries if "fblocatie_locatie_voorzieningen" in q["sql"]]
+    assert len(through_queries) == 2
+    assert Locatie.voorzieningen.through.objects.count() == 20
+    assert Locatie.pand_directies.through.objects.count() == 20
+
+
+@pytest.mark.django_db
+def test_benchmark_import_reports_speedup_and_rolls_back():
+    out = io.StringIO()
+    pandcode = compute_pandcode()
+
+    call_command("benchmark_import", rows=20, chunk_size=5, stdout=out)
+
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "20 rows, chunks of 5"
+    row_by_row, bulk = (line.strip().rsplit(None, 4) for line in lines[2:])
+    assert row_by_row[0] == "row by row" and row_by_row[3] == "1.00x"
+    assert bulk[0] == "bulk"
+    assert row_by_row[4] == bulk[4] == "0"
+    assert not Locatie.objects.exists()
+    assert not LocatieSoort.objects.exists()
+    # The pandcodes of the 20 rows are reserved, the sequence is not advanced further or moved back
+    assert compute_pandcode() == pandcode + 21
+
+
+def test_benchmark_import_rejects_invalid_options():
+    with pytest.raises(CommandError):
+        call_command("benchmark_import", rows=0)
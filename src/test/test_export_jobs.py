@@ -0,0 +1,213 @@
+import csv
+import io
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.urls import reverse
+from model_bakery import baker
+
+from fblocatie.models import Adres, Locatie
+from import_export_csv.jobs import claim_next_export_job, run_export_job
+from import_export_csv.models import ExportJob
+from referentie_tabellen.models import DienstverleningsKader, LocatieSoort
+
+
+@pytest.fixture()
+def locations():
+    soort = LocatieSoort.objects.create(name="Soort")
+    dvk = DienstverleningsKader.objects.create(name="DVK", dvk_nr=1)
+    return [
+        baker.make(
+            Locatie,
+            pandcode=pandcode,
+            naam=f"Locatie {pandcode}",
+            afkorting=f"L{pandcode}",
+            archief=pandcode == 3,
+            adres=baker.make(Adres, straat=f"Straat {pandcode}", huisnummer=pandcode),
+            locatie_soort=soort,
+            dvk_naam=dvk,
+        )
+        for pandcode in (1, 2, 3)
+    ]
+
+
+def _read_export(job: ExportJob) -> list[dict]:
+    with default_storage.open(job.file_name, "rb") as f:
+        decoded = f.read().decode("utf-8-sig")
+    return list(csv.DictReader(io.StringIO(decoded), delimiter=";"))
+
+
+@pytest.mark.django_db
+def test_export_view_queues_large_exports(client, settings, locations):
+    settings.EXPORT_ASYNC_THRESHOLD = 1
+    user = User.objects.create(username="staff", is_staff=True)
+    client.force_login(user)
+
+    response = client.get(
+        reverse("import_export_urls:locatie-export"), {"search": "Locatie", "columns": ["pandcode", "naam"]}
+    )
+
+    job = ExportJob.objects.get()
+    assert response.status_code == 302
+    assert response.url == reverse("import_export_urls:export-job", kwargs={"pk": job.pk})
+    assert job.status == ExportJob.Status.PENDING
+    assert job.created_by == user
+    assert job.columns == ["pandcode", "naam"]
+    assert job.params["search"] == "Locatie"
+
+
+@pytest.mark.django_db
+def test_export_view_streams_small_exports_directly(client, settings, locations):
+    settings.EXPORT_ASYNC_THRESHOLD = 10
+    client.force_login(User.objects.create(username="staff", is_staff=True))
+
+    response = client.post(reverse("import_export_urls:locatie-export"))
+
+    assert response.status_code == 200
+    assert response["Content-Type"].startswith("text/csv")
+    assert not ExportJob.objects.exists()
+
+
+@pytest.mark.django_db
+def test_process_jobs_writes_export_and_tracks_progress(storage_dir, locations):
+    user = User.objects.create(username="staff", is_staff=True)
+    job = ExportJob.objects.create(params={"archive": "all"}, columns=["pandcode", "straat"], created_by=user)
+
+    call_command("process_jobs", once=True)
+
+    job.refresh_from_db()
+    assert job.status == ExportJob.Status.DONE
+    assert job.total_rows == job.rows_written == 3
+    assert job.progress == 100
+    assert job.started_at is not None and job.finished_at is not None
+    assert job.file_name.startswith("exports/")
+    assert _read_export(job) == [
+        {"pandcode": "1", "straat": "Straat 1"},
+        {"pandcode": "2", "straat": "Straat 2"},
+        {"pandcode": "3", "straat": "Straat 3"},
+    ]
+
+
+@pytest.mark.django_db
+def test_run_export_job_applies_search_params_for_the_requesting_user(storage_dir, locations):
+    # Non-staff users never see archived locations, even when they ask for them
+    user = User.objects.create(username="user", is_staff=False)
+    job = ExportJob.objects.create(params={"archive": "all"}, columns=["pandcode"], created_by=user)
+
+    run_export_job(claim_next_export_job())
+
+    job.refresh_from_db()
+    assert [row["pandcode"] for row in _read_export(job)] == ["1", "2"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_run_export_job_builds_shards_in_parallel_processes(settings, storage_dir, locations):
+    settings.EXPORT_PROCESSES = 2
+    user = User.objects.create(username="user", is_staff=False)
+    job = ExportJob.objects.create(params={"archive": "all"}, columns=["pandcode", "straat"], created_by=user)
+
+    with patch("import_export_csv.exporter.SHARD_ROWS", 1):
+        run_export_job(claim_next_export_job())
+
+    job.refresh_from_db()
+    assert job.status == ExportJob.Status.DONE
+    assert job.total_rows == job.rows_written == 2
+    assert _read_export(job) == [{"pandcode": "1", "straat": "Straat 1"}, {"pandcode": "2", "straat": "Straat 2"}]
+
+
+@pytest.mark.django_db
+def test_run_export_job_marks_failures(storage_dir):
+    job = ExportJob.objects.create(columns=["onbekend"])
+
+    run_export_job(claim_next_export_job())
+
+    job.refresh_from_db()
+    assert job.status == ExportJob.Status.FAILED
+    assert "onbekend" in job.error
+    assert job.is_finished
+
+
+@pytest.mark.django_db
+def test_claim_next_export_job_takes_oldest_pending_job():
+    done = ExportJob.objects.create(status=ExportJob.Status.DONE)
+    first = ExportJob.objects.create()
+    ExportJob.objects.create()
+
+    claimed = claim_next_export_job()
+
+    assert claimed == first != done
+    assert claimed.status == ExportJob.Status.RUNNING
+    assert ExportJob.objects.filter(status=ExportJob.Status.PENDING).count() == 1
+
+
+@pytest.mark.django_db
+def test_claim_next_export_job_returns_none_for_empty_queue():
+    assert claim_next_export_job() is None
+
+
+@pytest.mark.django_db
+def test_export_job_pages_for_owner(client, storage_dir, locations):
+    user = User.objects.create(username="user")
+    client.force_login(user)
+    job = ExportJob.objects.create(columns=["pandcode"], created_by=user)
+    status_url = reverse("import_export_urls:export-job", kwargs={"pk": job.pk})
+    download_url = reverse("import_export_urls:export-job-download", kwargs={"pk": job.pk})
+
+    response = client.get(status_url)
+    assert response.status_code == 200
+    assert b'http-equiv="refresh"' in response.content
+    assert client.get(download_url).status_code == 404
+
+    run_export_job(claim_next_export_job())
+
+    response = client.get(status_url)
+    assert b'http-equiv="refresh"' not in response.content
+    assert download_url.encode() in response.content
+
+    response = client.get(download_url)
+    assert response.status_code == 200
+    assert response["Content-Disposition"].startswith('attachment; filename="locaties_export_')
+    assert b"".join(response.streaming_content).decode("utf-8-sig").splitlines() == ["pandcode", "1", "2", "3"]
+
+
+@pytest.mark.django_db
+def test_process_jobs_deletes_old_export_files(client, storage_dir, locations):
+    user = User.objects.create(username="user")
+    client.force_login(user)
+    old_job = ExportJob.objects.create(columns=["pandcode"], created_by=user)
+    run_export_job(claim_next_export_job())
+    new_job = ExportJob.objects.create(columns=["pandcode"], created_by=user)
+    run_export_job(claim_next_export_job())
+    old_job.refresh_from_db()
+    old = time.time() - 8 * 24 * 3600
+    os.utime(storage_dir / old_job.file_name, (old, old))
+    out = io.StringIO()
+
+    call_command("process_jobs", once=True, stdout=out)
+
+    assert "Deleted 1 old job files" in out.getvalue()
+    assert not default_storage.exists(old_job.file_name)
+    old_job.refresh_from_db()
+    new_job.refresh_from_db()
+    assert old_job.file_name == ""
+    assert default_storage.exists(new_job.file_name)
+    response = client.get(reverse("import_export_urls:export-job", kwargs={"pk": old_job.pk}))
+    assert "Het exportbestand is verwijderd" in response.content.decode()
+    assert client.get(reverse("import_export_urls:export-job-download", kwargs={"pk": old_job.pk})).status_code == 404
+
+
+@pytest.mark.django_db
+def test_export_job_pages_hidden_for_other_users(client):
+    owner = User.objects.create(username="owner")
+    job = ExportJob.objects.create(created_by=owner)
+    client.force_login(User.objects.create(username="other"))
+
+    assert client.get(reverse("import_export_urls:export-job", kwargs={"pk": job.pk})).status_code == 404
+
+    client.force_login(User.objects.create(username="staff", is_staff=True))
+    assert client.get(reverse("import_export_urls:export-job", kwargs={"pk": job.pk})).status_code == 200
@@ -1,8 +1,11 @@
 import csv
+import hashlib
 import io
 from datetime import date
 
 import pytest
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
 from django.db.models.query import QuerySet
 from model_bakery import baker
 
@@ -122,6 +125,26 @@ def test_build_csv_row_m2m_fields_export_empty_or_pipe_joined(field_name, model)
     assert set(row[csv_column].split(" | ")) == {str(a), str(b)}
 
 
+@pytest.mark.django_db
+def test_export_of_m2m_fields_is_the_same_in_every_run():
+    locatie = _make_locatie(pandcode=25, naam="Volgorde")
+    voorzieningen = [Voorziening.objects.create(name=f"Voorziening {i}") for i in range(5)]
+    # Stored and linked in another order than their primary keys
+    for voorziening in voorzieningen[:2]:
+        voorziening.save()
+    locatie.voorzieningen.add(*voorzieningen[3:])
+    locatie.voorzieningen.add(*voorzieningen[:3])
+    expected = " | ".join(str(voorziening) for voorziening in voorzieningen)
+
+    assert exporter.build_csv_row(locatie)[LOCATIE_MAPPING["voorzieningen"]] == expected
+    digests = {
+        hashlib.sha256(b"".join(exporter.iter_csv(exporter.fetch_locations_for_export()))).hexdigest() for _ in range(3)
+    }
+    assert len(digests) == 1
+    _, rows = _parse_csv_response(exporter.get_csv_response(exporter.fetch_locations_for_export()))
+    assert rows[0][LOCATIE_MAPPING["voorzieningen"]] == expected
+
+
 @pytest.mark.django_db
 def test_build_csv_row_m2m_fields_list_matches_mapping_constant():
     # Light sanity check: ensures exporter logic stays aligned with mapping config.
@@ -169,7 +192,7 @@ def test_get_csv_response_exports_vastgoed_fields_when_present():
     bezit = LocatieBezit.objects.create(name="Eigendom")
     Vastgoed.objects.create(adres=locatie.adres, GV_key="GV-XYZ", gv_id="GV-50", bezit=bezit)
 
-    locatie.save()
+    locatie.refresh_from_db()
 
     response = exporter.get_csv_response([locatie])
     _, rows = _parse_csv_response(response)
@@ -185,7 +208,7 @@ def test_export_includes_locatie_information():
 
     bezit = LocatieBezit.objects.create(name="Eigendom HF")
     Vastgoed.objects.create(adres=locatie.adres, GV_key="GV-HF", gv_id="GV-60", bezit=bezit)
-    locatie.save()
+    locatie.refresh_from_db()
 
     d1 = Directie.objects.create(name="Directie HF 1")
     d2 = Directie.objects.create(name="Directie HF 2")
@@ -230,3 +253,141 @@ def test__get_field_converts_none_to_empty_string_but_keeps_false():
     assert exporter._get_field(Obj(), "x") == ""
     assert exporter._get_field(None, "x") == ""
     assert exporter._get_field(Obj(), "y") is False
+
+
+@pytest.mark.django_db
+def test_get_export_columns_keeps_file_order_and_rejects_unknown_columns():
+    assert exporter.get_export_columns() == _expected_columns()
+    assert exporter.get_export_columns(["straat", "naam", "pandcode"]) == ["pandcode", "naam", "straat"]
+
+    with pytest.raises(ValueError, match="onbekend"):
+        exporter.get_export_columns(["naam", "onbekend"])
+
+
+@pytest.mark.django_db
+def test_get_csv_response_exports_only_selected_columns():
+    _make_locatie(pandcode=70, naam="Subset")
+    columns = ["pandcode", "naam", "straat", "huisnummer", "plaats"]
+
+    response = exporter.get_csv_response(exporter.fetch_locations_for_export(columns), columns)
+    fieldnames, rows = _parse_csv_response(response)
+
+    assert fieldnames == columns
+    assert rows == [
+        {"pandcode": "70", "naam": "Subset", "straat": "Straat 70", "huisnummer": "70", "plaats": "Amsterdam"}
+    ]
+
+
+@pytest.mark.django_db
+def test_fetch_locations_for_export_prunes_joins_and_prefetches(django_assert_num_queries):
+    locatie = _make_locatie(pandcode=80, naam="Pruned")
+    locatie.pand_directies.add(Directie.objects.create(name="Directie pruned"))
+
+    qs = exporter.fetch_locations_for_export(["pandcode", "naam", "straat"])
+
+    assert set(qs.query.select_related) == {"adres"}
+    assert qs._prefetch_related_lookups == ()
+    assert qs.query.deferred_loading == ({"pandcode", "naam", "adres__straat"}, False)
+
+    # One query for the rows, nothing for the pruned relations
+    with django_assert_num_queries(1):
+        response = exporter.get_csv_response(qs, ["pandcode", "naam", "straat"])
+
+    _, rows = _parse_csv_response(response)
+    assert rows == [{"pandcode": "80", "naam": "Pruned", "straat": "Straat 80"}]
+
+
+@pytest.mark.django_db
+def test_fetch_locations_for_export_with_relations_in_selection(django_assert_num_queries):
+    locatie = _make_locatie(pandcode=90, naam="Relations")
+    bezit = LocatieBezit.objects.create(name="Huur")
+    Vastgoed.objects.create(adres=locatie.adres, bezit=bezit)
+    locatie.save()
+    locatie.pand_directies.add(Directie.objects.create(name="Directie relations"))
+    columns = ["pandcode", "soort", "vlekken", "bezit"]
+
+    qs = exporter.fetch_locations_for_export(columns)
+
+    assert set(qs.query.select_related) == {"locatie_soort", "vastgoed"}
+    assert qs._prefetch_related_lookups == ("pand_directies",)
+
+    # The rows and a single prefetch for the selected many to many field
+    with django_assert_num_queries(2):
+        response = exporter.get_csv_response(qs, columns)
+
+    _, rows = _parse_csv_response(response)
+    assert rows == [{"pandcode": "90", "soort": "Soort 90", "vlekken": "Directie relations", "bezit": "Huur"}]
+
+
+@pytest.mark.django_db
+def test_iter_csv_yields_the_same_csv_as_the_response_in_chunks():
+    for pandcode in range(100, 105):
+        _make_locatie(pandcode=pandcode, naam=f"Chunk {pandcode}")
+    qs = exporter.fetch_locations_for_export()
+
+    chunks = list(exporter.iter_csv(qs.iterator(chunk_size=2), chunk_rows=2))
+
+    # Two chunks of two rows, the header is written with the first row
+    assert len(chunks) == 3
+    assert all(isinstance(chunk, bytes) for chunk in chunks)
+    assert b"".join(chunks) == exporter.get_csv_response(qs).content
+
+
+def test_iter_csv_without_locations_yields_only_the_header():
+    assert b"".join(exporter.iter_csv([], ["pandcode", "naam"])) == "﻿pandcode;naam\r\n".encode()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_iter_csv_shards_builds_the_same_csv_in_parallel_processes():
+    locaties = [_make_locatie(pandcode=pandcode, naam=f"Shard {pandcode}") for pandcode in (5, 1, 9, 3, 7)]
+    locaties[0].pand_directies.add(Directie.objects.create(name="Directie shard"))
+    qs = exporter.fetch_locations_for_export()
+
+    shards = list(exporter.iter_csv_shards(qs, processes=2, shard_rows=2))
+
+    # Three shards of at most two locations, in pandcode order
+    assert [rows for rows, _ in shards] == [2, 2, 1]
+    assert b"".join(data for _, data in shards) == exporter.get_csv_response(qs).content
+
+
+@pytest.mark.django_db(transaction=True)
+def test_iter_csv_shards_keeps_search_filter_and_selected_columns():
+    for pandcode in range(1, 7):
+        _make_locatie(pandcode=pandcode, naam=f"Oneven {pandcode}" if pandcode % 2 else f"Even {pandcode}")
+    columns = ["pandcode", "naam"]
+    user = User.objects.create(username="user")
+    qs = exporter.fetch_locations_for_export(columns).search_filter(params={"search": "Oneven"}, user=user)
+
+    content = b"".join(data for _, data in exporter.iter_csv_shards(qs, columns, processes=2, shard_rows=1))
+
+    assert content == "\ufeffpandcode;naam\r\n1;Oneven 1\r\n3;Oneven 3\r\n5;Oneven 5\r\n".encode()
+
+
+@pytest.mark.django_db
+def test_iter_csv_shards_without_locations_yields_only_the_header():
+    shards = list(exporter.iter_csv_shards(exporter.fetch_locations_for_export(["pandcode"]), ["pandcode"]))
+
+    assert shards == [(0, "\ufeffpandcode\r\n".encode())]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_benchmark_export_reports_speedup_per_number_of_processes():
+    for pandcode in range(1, 5):
+        _make_locatie(pandcode=pandcode, naam=f"Benchmark {pandcode}")
+    out = io.StringIO()
+
+    call_command("benchmark_export", processes=[1, 2], shard_rows=2, repeat=1, stdout=out)
+
+    lines = out.getvalue().splitlines()
+    assert lines[0].startswith("4 locations, ")
+    assert lines[1].split() == ["processes", "seconds", "speedup", "bytes"]
+    serial, parallel = (line.split() for line in lines[2:])
+    assert serial[0] == "1" and serial[2] == "1.00x"
+    assert parallel[0] == "2"
+    # Both exports are the same file
+    assert serial[3] == parallel[3]
+
+
+def test_benchmark_export_rejects_invalid_options():
+    with pytest.raises(CommandError):
+        call_command("benchmark_export", processes=[0])
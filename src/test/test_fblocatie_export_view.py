@@ -74,3 +74,41 @@ def test_fblocatie_export_view_respects_search_query_params():
     assert response.status_code == 200
     rows = _parse_csv_response(response)
     assert {row["naam"] for row in rows} == {"Foo locatie"}
+
+
+@pytest.mark.django_db
+def test_fblocatie_export_view_exports_selected_columns():
+    user = User.objects.create(username="staff", is_staff=True)
+
+    adres = baker.make(Adres, straat="Straat 1", postcode="1234AB", huisnummer=1, woonplaats="Amsterdam")
+    baker.make(
+        Locatie,
+        pandcode=1,
+        naam="Foo locatie",
+        afkorting="FOO",
+        adres=adres,
+        locatie_soort=LocatieSoort.objects.create(name="Soort"),
+        dvk_naam=DienstverleningsKader.objects.create(name="DVK 1", dvk_nr=1),
+    )
+
+    rf = RequestFactory()
+    url = reverse("import_export_urls:locatie-export")
+    request = rf.post(url, {"columns": ["pandcode", "straat"]})
+    request.user = user
+
+    response = LocationExportView.as_view()(request)
+
+    assert response.status_code == 200
+    assert _parse_csv_response(response) == [{"pandcode": "1", "straat": "Straat 1"}]
+
+
+@pytest.mark.django_db
+def test_fblocatie_export_view_rejects_unknown_columns(client):
+    user = User.objects.create(username="staff", is_staff=True)
+    client.force_login(user)
+
+    response = client.get(reverse("import_export_urls:locatie-export"), {"columns": ["onbekend"]})
+
+    assert response.status_code == 200
+    assert response["Content-Type"].startswith("text/html")
+    assert "Het formulier is niet juist ingevuld." in [str(m) for m in response.context["messages"]]
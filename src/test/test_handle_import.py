@@ -1,12 +1,23 @@
+import io
 from unittest.mock import MagicMock, patch
 
 import pytest
 from django.contrib import messages
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management import call_command
 
-from import_export_csv.handle_import import handle_import_csv
+from fblocatie.models import Locatie
+from import_export_csv.error_report import ImportErrorReport
+from import_export_csv.handle_import import handle_import_csv, iter_csv_lines, read_csv_rows
+from import_export_csv.management.commands.benchmark_import_memory import (
+    generate_file,
+    peak_memory,
+    read_all_rows,
+    stream_rows,
+)
+from referentie_tabellen.models import DienstverleningsKader, LocatieBezit, LocatieSoort
 
 
 def _build_request():
@@ -18,10 +29,7 @@ def _build_request():
 
 
 def _build_file(name: str, content: str):
-    fake_file = MagicMock()
-    fake_file.name = name
-    fake_file.read.return_value = content.encode("utf-8-sig")
-    return fake_file
+    return SimpleUploadedFile(name, content.encode("utf-8-sig"), content_type="text/csv")
 
 
 @pytest.mark.django_db
@@ -57,9 +65,8 @@ def test_handle_import_csv_with_fake_file():
     # Call the function
     result = handle_import_csv(request, fake_file)
 
-    # Check that the result is int (should be 0 as per implementation)
-    assert isinstance(result, int)
-    assert result == 0
+    # The number of locations created or updated
+    assert result == 1
 
     # Check that at least one info message was added
     info_messages = [m for m in message_storage if m.level == messages.INFO]
@@ -67,6 +74,8 @@ def test_handle_import_csv_with_fake_file():
 
     # Check that the processed columns message is present
     assert any("Kolommen" in m.message for m in info_messages)
+    assert "Locaties: 1 nieuw, 0 gewijzigd, 0 ongewijzigd, 0 fout." in [m.message for m in info_messages][1]
+    assert info_messages[2].message.startswith("Tijd per fase (seconden): inlezen ")
 
     # Check that no error or warning messages about missing/excess columns
     error_messages = [m for m in message_storage if m.level == messages.ERROR]
@@ -110,7 +119,7 @@ def test_handle_import_csv_warns_on_missing_columns(importer_cls):
     assert result == 0
     importer_cls.return_value.main.assert_not_called()
     warning_messages = [m.message for m in message_storage if m.level == messages.WARNING]
-    assert warning_messages == ["Rij 1 is niet verwerkt want deze mist een kolom"]
+    assert warning_messages == ["1 rij (1) niet verwerkt want de rij mist een kolom"]
 
 
 @patch("import_export_csv.handle_import.ImporterProcessCSV")
@@ -123,7 +132,7 @@ def test_handle_import_csv_warns_on_excess_columns(importer_cls):
     assert result == 0
     importer_cls.return_value.main.assert_not_called()
     warning_messages = [m.message for m in message_storage if m.level == messages.WARNING]
-    assert warning_messages == ["Rij 1 is niet verwerkt want deze heeft teveel kolommen"]
+    assert warning_messages == ["1 rij (1) niet verwerkt want de rij heeft teveel kolommen"]
 
 
 @patch("import_export_csv.handle_import.ImporterProcessCSV")
@@ -141,7 +150,7 @@ def test_handle_import_csv_reports_validation_error(importer_cls):
     assert result == 0
     error_messages = [m.message for m in message_storage if m.level == messages.ERROR]
     assert len(error_messages) == 1
-    assert "Fout importeren locatie LOC-1:" in error_messages[0]
+    assert error_messages[0].startswith("1 rij (1) met een fout in rij: Error in main:")
     assert "ongeldige rij" in error_messages[0]
 
 
@@ -163,4 +172,107 @@ def test_handle_import_csv_reports_importer_errors(importer_cls):
 
     assert result == 0
     error_messages = [m.message for m in message_storage if m.level == messages.ERROR]
-    assert error_messages == ["Fout importeren locatie LOC-2: {'locatie': ['kapot']}"]
+    assert error_messages == ["1 rij (1) met een fout in locatie: kapot"]
+
+
+@pytest.mark.django_db
+def test_handle_import_csv_reports_errors_per_type():
+    LocatieSoort.objects.create(name="Kantoor")
+    DienstverleningsKader.objects.create(name="Basis", dvk_nr=1)
+    LocatieBezit.objects.create(name="ntb")
+    csv_content = (
+        "pandcode;naam;afkorting;soort;dvk_naam;straat;postcode;huisnummer;plaats;bezit\n"
+        "1;Locatie 1;L1;Kantoor;Basis;Straat;1000AA;1;Amsterdam;\n"
+        "2;Locatie 2;L2\n"
+        "3;Locatie 3;L3;Onbekend;Basis;Straat;1000AA;3;Amsterdam;\n"
+        "4;Locatie 4;L4;Kantoor;Basis;Straat;1000AA;4;Amsterdam;\n"
+        "5;Locatie 5;L5;Winkel;Basis;Straat;1000AA;5;Amsterdam;\n"
+        "6;Locatie 6;L6;Onbekend;Basis;Straat;1000AA;6;Amsterdam;\n"
+    )
+    request, message_storage = _build_request()
+    error_report = ImportErrorReport()
+
+    handle_import_csv(request, _build_file("locations.csv", csv_content), error_report=error_report)
+
+    reported = [(m.level, m.message) for m in message_storage if m.level != messages.INFO]
+    assert [(level, message.split(":")[0]) for level, message in reported] == [
+        (messages.ERROR, "3 rijen (3, 5, 6) met een fout in locatie"),
+        (messages.ERROR, "3 rijen (3, 5, 6) met een fout in locatie"),
+        (messages.WARNING, "1 rij (2) niet verwerkt want de rij mist een kolom"),
+    ]
+    assert reported[0][1].endswith(
+        ": '...' is niet aanwezig in de <class 'referentie_tabellen.models.LocatieSoort'> tabel"
+    )
+    assert ': locatie niet aangemaakt: null value in column "locatie_soort_id"' in reported[1][1]
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 4]
+
+    lines = error_report.to_csv().decode("utf-8-sig").splitlines()
+    assert lines[0] == "onderdeel;fout;aantal;rijen;locaties;voorbeeld"
+    assert lines[1] == "overgeslagen;de rij mist een kolom;1;2;;de rij mist een kolom"
+    soort_error = "'...' is niet aanwezig in de <class 'referentie_tabellen.models.LocatieSoort'> tabel"
+    assert lines[2].startswith(f"locatie;{soort_error};3;3, 5, 6;L3, L5, L6;'Onbekend' is niet aanwezig")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64 * 1024])
+def test_read_csv_rows_streams_the_file_in_chunks(chunk_size):
+    content = 'pandcode;naam;notitie\r\n1;Café;"twee\r\nregels"\r\n2;Ærø;€ ½\r\n3;Zoë;\r\n'
+    csv_file = SimpleUploadedFile("locations.csv", content.encode("utf-8-sig"))
+
+    rows = list(read_csv_rows(csv_file, chunk_size=chunk_size))
+
+    assert rows == [
+        {"pandcode": "1", "naam": "Café", "notitie": "twee\r\nregels"},
+        {"pandcode": "2", "naam": "Ærø", "notitie": "€ ½"},
+        {"pandcode": "3", "naam": "Zoë", "notitie": ""},
+    ]
+
+
+def test_iter_csv_lines_keeps_line_endings():
+    csv_file = SimpleUploadedFile("locations.csv", b"a;b\r\n1;2\n3;4")
+
+    assert list(iter_csv_lines(csv_file, chunk_size=4)) == ["a;b\r\n", "1;2\n", "3;4"]
+
+
+@patch("import_export_csv.handle_import.ImporterProcessCSV")
+def test_handle_import_csv_imports_rows_before_invalid_encoding(importer_cls):
+    importer = importer_cls.return_value
+    importer.errors = {}
+    # More than one chunk of valid rows before the invalid bytes
+    rows = "".join(f"{i};Locatie {i}\n" for i in range(10000))
+    csv_file = SimpleUploadedFile("locations.csv", f"pandcode;naam\n{rows}".encode() + b"\xff;kapot\n")
+    request, message_storage = _build_request()
+
+    handle_import_csv(request, csv_file)
+
+    error_messages = [m.message for m in message_storage if m.level == messages.ERROR]
+    assert len(error_messages) == 1
+    assert error_messages[0].startswith("De locaties na rij ")
+    rows_read = int(error_messages[0].split()[4])
+    assert 0 < rows_read < 10000
+    assert importer.main.call_count == rows_read
+
+
+def test_streamed_import_file_uses_constant_memory():
+    small, large = generate_file(2000), generate_file(20000)
+
+    read_small, at_once_small = peak_memory(read_all_rows, small)
+    read_large, at_once_large = peak_memory(read_all_rows, large)
+    streamed_small_rows, streamed_small = peak_memory(stream_rows, small)
+    streamed_large_rows, streamed_large = peak_memory(stream_rows, large)
+
+    assert read_small == streamed_small_rows == 2000
+    assert read_large == streamed_large_rows == 20000
+    # Reading the file at once needs a multiple of its size, streaming it about the same for every size
+    assert at_once_large > 2 * large.size
+    assert streamed_large < 1.2 * streamed_small
+    assert streamed_large < large.size / 4
+
+
+def test_benchmark_import_memory_reports_peak_memory_per_size():
+    out = io.StringIO()
+
+    call_command("benchmark_import_memory", rows=[100, 1000], stdout=out)
+
+    lines = out.getvalue().splitlines()
+    assert lines[0].split() == ["rows", "file", "KiB", "at", "once", "KiB", "streamed", "KiB"]
+    assert [line.split()[0] for line in lines[1:]] == ["100", "1000"]
@@ -0,0 +1,303 @@
+import io
+import os
+import threading
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from django.contrib import messages
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connections
+from django.urls import reverse
+from django.utils import timezone
+
+from fblocatie.models import Locatie
+from import_export_csv.handle_import import IMPORT_LOCK
+from import_export_csv.jobs import (
+    ImportProgress,
+    claim_next_import_job,
+    create_import_job,
+    delete_old_job_files,
+    job_lock,
+    run_import_job,
+)
+from import_export_csv.models import ExportJob, ImportJob
+from shared.locks import advisory_lock
+
+CSV_CONTENT = (
+    "pandcode;naam;afkorting;soort;dvk_naam;straat;postcode;huisnummer;plaats;bezit\n"
+    "1;Locatie 1;L1;Kantoor;Basis;Straat;1000AA;1;Amsterdam;\n"
+    "2;Locatie 2;L2\n"
+    "3;Locatie 3;L3;Onbekend;Basis;Straat;1000AA;3;Amsterdam;\n"
+    "4;Locatie 4;L4;Kantoor;Basis;Straat;1000AA;4;Amsterdam;\n"
+)
+
+
+def _hold_import_lock(release_when, timeout: float = 10) -> threading.Thread:
+    """Hold the import lock in another database session until `release_when()` is true"""
+    locked = threading.Event()
+
+    def hold():
+        try:
+            with advisory_lock(IMPORT_LOCK):
+                locked.set()
+                deadline = time.monotonic() + timeout
+                while not release_when() and time.monotonic() < deadline:
+                    time.sleep(0.05)
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    locked.wait(timeout)
+    return thread
+
+
+def _upload(content: str = CSV_CONTENT, name: str = "locaties.csv") -> SimpleUploadedFile:
+    return SimpleUploadedFile(name, content.encode("utf-8-sig"), content_type="text/csv")
+
+
+@pytest.mark.django_db
+def test_import_view_queues_large_files(client, settings, storage_dir):
+    settings.IMPORT_ASYNC_THRESHOLD = 10
+    user = User.objects.create(username="staff", is_staff=True)
+    client.force_login(user)
+
+    response = client.post(reverse("import_export_urls:locatie-import"), {"csv_file": _upload()})
+
+    job = ImportJob.objects.get()
+    assert response.status_code == 302
+    assert response.url == reverse("import_export_urls:import-job", kwargs={"pk": job.pk})
+    assert job.status == ImportJob.Status.PENDING
+    assert job.created_by == user
+    assert job.original_name == "locaties.csv"
+    assert job.file_name.startswith("imports/")
+    with default_storage.open(job.file_name, "rb") as f:
+        assert f.read().decode("utf-8-sig") == CSV_CONTENT
+    assert not Locatie.objects.exists()
+
+
+@pytest.mark.django_db
+def test_import_view_imports_small_files_directly(client, settings, storage_dir, referenties):
+    settings.IMPORT_ASYNC_THRESHOLD = 10 * 1024
+    client.force_login(User.objects.create(username="staff", is_staff=True))
+
+    response = client.post(reverse("import_export_urls:locatie-import"), {"csv_file": _upload()})
+
+    assert response.status_code == 200
+    assert not ImportJob.objects.exists()
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 4]
+
+
+@pytest.mark.django_db
+def test_process_jobs_imports_file_and_stores_report(storage_dir, referenties):
+    job = create_import_job(_upload(), User.objects.create(username="staff", is_staff=True))
+
+    call_command("process_jobs", once=True)
+
+    job.refresh_from_db()
+    assert job.status == ImportJob.Status.DONE
+    assert job.total_rows == job.rows_processed == 4
+    assert job.error_rows == 1
+    assert job.progress == 100
+    assert job.started_at is not None and job.finished_at is not None
+    assert [(level, message.split(":")[0]) for level, message in job.report[1:]] == [
+        (messages.WARNING, "1 rij (2) niet verwerkt want de rij mist een kolom"),
+        (messages.ERROR, "1 rij (3) met een fout in locatie"),
+        (messages.ERROR, "1 rij (3) met een fout in locatie"),
+        (messages.INFO, "Locaties"),
+        (messages.INFO, "Tijd per fase (seconden)"),
+    ]
+    assert job.report_messages[0] == ("info", job.report[0][1])
+    with default_storage.open(f"import_errors/{job.error_report}", "rb") as f:
+        assert f.read().decode("utf-8-sig").splitlines()[1].startswith("overgeslagen;de rij mist een kolom;1;2;")
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 4]
+    # The uploaded file contains personal data, it is not kept after the import
+    assert not default_storage.exists(job.file_name)
+
+
+@pytest.mark.django_db
+def test_run_import_job_marks_failures(storage_dir):
+    job = ImportJob.objects.create(file_name="imports/verdwenen.csv")
+
+    run_import_job(claim_next_import_job())
+
+    job.refresh_from_db()
+    assert job.status == ImportJob.Status.FAILED
+    assert job.error
+    assert job.is_finished
+
+
+@pytest.mark.django_db
+def test_delete_old_job_files_deletes_old_error_reports_and_import_files(storage_dir, referenties):
+    user = User.objects.create(username="staff", is_staff=True)
+    done = create_import_job(_upload(), user)
+    run_import_job(claim_next_import_job())
+    done.refresh_from_db()
+    pending = create_import_job(_upload(name="wachtend.csv"), user)
+    left_over = default_storage.save("imports/achtergebleven.csv", ContentFile(b"pandcode\n1\n"))
+    recent = default_storage.save("import_errors/importfouten_recent.csv", ContentFile(b""))
+    report = f"import_errors/{done.error_report}"
+    old = time.time() - 8 * 24 * 3600
+    for path in (report, pending.file_name, left_over):
+        os.utime(storage_dir / path, (old, old))
+
+    assert delete_old_job_files() == 2
+
+    assert not default_storage.exists(report)
+    assert not default_storage.exists(left_over)
+    assert default_storage.exists(pending.file_name)
+    assert default_storage.exists(recent)
+    done.refresh_from_db()
+    assert done.error_report == ""
+
+
+@pytest.mark.django_db
+def test_process_jobs_fails_the_jobs_of_stopped_workers(storage_dir):
+    user = User.objects.create(username="staff", is_staff=True)
+    abandoned = create_import_job(_upload(), user)
+    running = create_import_job(_upload(name="bezig.csv"), user)
+    ImportJob.objects.update(status=ImportJob.Status.RUNNING, started_at=timezone.now() - timedelta(minutes=5))
+    just_claimed = ExportJob.objects.create(status=ExportJob.Status.RUNNING, started_at=timezone.now())
+    out = io.StringIO()
+
+    # The worker of `running` still holds its lock
+    with advisory_lock(job_lock(running), dedicated=True):
+        call_command("process_jobs", once=True, stdout=out)
+
+    assert "Marked 1 abandoned jobs as failed" in out.getvalue()
+    abandoned.refresh_from_db()
+    assert abandoned.status == ImportJob.Status.FAILED
+    assert abandoned.error.startswith("De verwerking is afgebroken")
+    assert abandoned.finished_at is not None
+    assert not default_storage.exists(abandoned.file_name)
+    running.refresh_from_db()
+    assert running.status == ImportJob.Status.RUNNING
+    assert default_storage.exists(running.file_name)
+    just_claimed.refresh_from_db()
+    assert just_claimed.status == ExportJob.Status.RUNNING
+
+
+@pytest.mark.django_db
+def test_import_progress_is_saved_per_interval():
+    job = ImportJob.objects.create(file_name="imports/locaties.csv")
+    progress = ImportProgress(job)
+
+    with patch("import_export_csv.jobs.PROGRESS_INTERVAL", 2):
+        progress(1, 0)
+        assert ImportJob.objects.get().rows_processed == 0
+        progress(3, 1)
+        assert ImportJob.objects.values_list("rows_processed", "error_rows").get() == (3, 1)
+        progress(4, 1)
+
+    assert (job.rows_processed, job.error_rows) == (4, 1)
+    assert ImportJob.objects.get().rows_processed == 3
+
+
+@pytest.mark.django_db
+def test_claim_next_import_job_takes_oldest_pending_job():
+    ImportJob.objects.create(file_name="imports/klaar.csv", status=ImportJob.Status.DONE)
+    first = ImportJob.objects.create(file_name="imports/eerste.csv")
+    ImportJob.objects.create(file_name="imports/tweede.csv")
+
+    claimed = claim_next_import_job()
+
+    assert claimed == first
+    assert claimed.status == ImportJob.Status.RUNNING
+    assert claim_next_import_job() != first
+    assert claim_next_import_job() is None
+
+
+@pytest.mark.django_db
+def test_import_job_page_shows_progress_and_report(client, storage_dir, referenties):
+    client.force_login(User.objects.create(username="staff", is_staff=True))
+    job = create_import_job(_upload(), None)
+    url = reverse("import_export_urls:import-job", kwargs={"pk": job.pk})
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert b'http-equiv="refresh"' in response.content
+
+    run_import_job(claim_next_import_job())
+    job.refresh_from_db()
+
+    response = client.get(url)
+    assert b'http-equiv="refresh"' not in response.content
+    assert "Rijen met fouten: 1" in response.content.decode()
+    assert "1 rij (3) met een fout in locatie" in response.content.decode()
+    report_url = reverse("import_export_urls:import-error-report", kwargs={"name": job.error_report})
+    assert report_url in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_import_job_page_is_for_staff_only(client):
+    job = ImportJob.objects.create(file_name="imports/locaties.csv")
+    client.force_login(User.objects.create(username="user"))
+
+    assert client.get(reverse("import_export_urls:import-job", kwargs={"pk": job.pk})).status_code == 403
+
+
+@pytest.mark.django_db
+def test_import_error_report_download(client, settings, storage_dir, referenties):
+    settings.IMPORT_ASYNC_THRESHOLD = 10 * 1024
+    client.force_login(User.objects.create(username="staff", is_staff=True))
+
+    response = client.post(reverse("import_export_urls:locatie-import"), {"csv_file": _upload()})
+
+    name = response.context["error_report"]
+    assert f'href="{reverse("import_export_urls:import-error-report", kwargs={"name": name})}"' in (
+        response.content.decode()
+    )
+    download = client.get(reverse("import_export_urls:import-error-report", kwargs={"name": name}))
+    content = b"".join(download.streaming_content).decode("utf-8-sig")
+    assert download.status_code == 200
+    assert content.splitlines()[0] == "onderdeel;fout;aantal;rijen;locaties;voorbeeld"
+    assert "L3" in content
+    not_a_report = reverse("import_export_urls:import-error-report", kwargs={"name": "locaties.csv"})
+    assert client.get(not_a_report).status_code == 404
+
+
+@pytest.mark.django_db(transaction=True)
+def test_run_import_job_waits_for_running_import(storage_dir, referenties):
+    job = create_import_job(_upload(), None)
+    claim_next_import_job()
+    waited = []
+
+    def job_is_waiting() -> bool:
+        if ImportJob.objects.filter(pk=job.pk, status=ImportJob.Status.WAITING).exists():
+            waited.append(job.pk)
+        return bool(waited)
+
+    holder = _hold_import_lock(job_is_waiting)
+    run_import_job(ImportJob.objects.get(pk=job.pk))
+    holder.join()
+
+    job.refresh_from_db()
+    assert waited
+    assert job.status == ImportJob.Status.DONE
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 4]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_view_queues_import_while_another_import_runs(client, settings, storage_dir, referenties):
+    settings.IMPORT_ASYNC_THRESHOLD = 10 * 1024
+    client.force_login(User.objects.create(username="staff", is_staff=True))
+    finished = threading.Event()
+    holder = _hold_import_lock(finished.is_set)
+
+    try:
+        response = client.post(reverse("import_export_urls:locatie-import"), {"csv_file": _upload()})
+    finally:
+        finished.set()
+        holder.join()
+
+    job = ImportJob.objects.get()
+    assert response.status_code == 302
+    assert response.url == reverse("import_export_urls:import-job", kwargs={"pk": job.pk})
+    assert job.status == ImportJob.Status.PENDING
+    assert not Locatie.objects.exists()
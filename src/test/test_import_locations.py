@@ -0,0 +1,122 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connections
+
+from fblocatie.models import Locatie
+from import_export_csv.batch_importer import BatchImporter
+from import_export_csv.jobs import claim_next_import_job, create_import_job, run_import_job
+from import_export_csv.models import ImportJob
+
+HEADER = "pandcode;naam;afkorting;soort;dvk_naam;straat;postcode;huisnummer;huisletter;numtoeg;plaats;bezit\n"
+
+
+@pytest.fixture()
+def csv_path(tmp_path):
+    lines = [f"{i};Locatie {i};L{i};Kantoor;Basis;Straat;1000AA;{i};;;Amsterdam;\n" for i in range(1, 7)]
+    lines[2] = "3;Locatie 3;L3;Onbekend;Basis;Straat;1000AA;3;;;Amsterdam;\n"
+    path = tmp_path / "locaties.csv"
+    path.write_text(HEADER + "".join(lines), encoding="utf-8-sig")
+    return path
+
+
+@pytest.mark.django_db
+def test_import_locations_imports_file(referenties, csv_path):
+    out, err = io.StringIO(), io.StringIO()
+
+    call_command("import_locations", str(csv_path), chunk_size=2, progress_interval=4, stdout=out, stderr=err)
+
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 2, 4, 5, 6]
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "Imported 4 of 6 rows, 1 with errors"
+    assert lines[1].startswith("Imported 6 rows in ") and lines[1].endswith(" seconds, 1 with errors")
+    assert lines[2].startswith("locatie 5 created, 0 updated, 0 unchanged, 1 failed")
+    assert err.getvalue().startswith("1 rij (3) met een fout in locatie")
+    assert lines[3] == f"The rows with errors are in {csv_path}.errors.csv"
+    assert "L3" in (csv_path.parent / "locaties.csv.errors.csv").read_text(encoding="utf-8-sig")
+    assert not (csv_path.parent / "locaties.csv.checkpoint").exists()
+
+
+@pytest.mark.django_db
+def test_import_locations_resumes_after_failure(referenties, csv_path, mocker):
+    match_existing = BatchImporter.match_existing
+    checkpoint = csv_path.parent / "locaties.csv.checkpoint"
+    calls = []
+
+    def fail_second_chunk(parsed_rows):
+        calls.append(parsed_rows)
+        if len(calls) == 2:
+            raise OSError("verbinding verbroken")
+        return match_existing(parsed_rows)
+
+    mocker.patch.object(BatchImporter, "match_existing", side_effect=fail_second_chunk)
+    with pytest.raises(CommandError, match="failed after row 3: verbinding verbroken"):
+        call_command("import_locations", str(csv_path), chunk_size=2, stdout=io.StringIO(), stderr=io.StringIO())
+
+    assert json.loads(checkpoint.read_text())["rows"] == 3
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 2]
+    with pytest.raises(CommandError, match="checkpoint .* exists"):
+        call_command("import_locations", str(csv_path), stdout=io.StringIO())
+
+    mocker.stopall()
+    out = io.StringIO()
+    call_command("import_locations", str(csv_path), resume=True, stdout=out, stderr=io.StringIO())
+
+    assert out.getvalue().startswith("Continuing after row 3 of 6\n")
+    assert "locatie 3 created" in out.getvalue()
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 2, 4, 5, 6]
+    assert not checkpoint.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_locations_holds_the_import_lock_while_parsing_in_processes(referenties, csv_path, storage_dir):
+    job = create_import_job(SimpleUploadedFile("locaties.csv", csv_path.read_bytes()), None)
+    claim_next_import_job()
+    waiting = []
+
+    def second_import():
+        try:
+            run_import_job(ImportJob.objects.get(pk=job.pk))
+        finally:
+            connections.close_all()
+
+    second = threading.Thread(target=second_import)
+
+    class Output(io.StringIO):
+        def write(self, text):
+            # The first chunk is written, so the rows are parsed by the processes, which closed the connections
+            if text.startswith("Imported 2 of") and not second.is_alive():
+                second.start()
+                deadline = time.monotonic() + 10
+                while not waiting and time.monotonic() < deadline:
+                    if ImportJob.objects.filter(pk=job.pk, status=ImportJob.Status.WAITING).exists():
+                        waiting.append(job.pk)
+                    time.sleep(0.05)
+            return super().write(text)
+
+    call_command(
+        "import_locations",
+        str(csv_path),
+        processes=2,
+        chunk_size=2,
+        progress_interval=2,
+        stdout=Output(),
+        stderr=io.StringIO(),
+    )
+    second.join()
+
+    assert waiting
+    job.refresh_from_db()
+    assert job.status == ImportJob.Status.DONE
+    assert list(Locatie.objects.values_list("pandcode", flat=True)) == [1, 2, 4, 5, 6]
+
+
+def test_import_locations_rejects_missing_file(tmp_path):
+    with pytest.raises(CommandError, match="does not exist"):
+        call_command("import_locations", str(tmp_path / "geen.csv"))
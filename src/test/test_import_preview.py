@@ -0,0 +1,92 @@
+import pytest
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from fblocatie.models import Adres, Locatie, Vastgoed
+from import_export_csv.batch_importer import BatchImporter
+from import_export_csv.preview import ImportPreview, RowDiff
+
+
+def _preview(rows: list) -> list[RowDiff]:
+    return list(ImportPreview().preview_rows(enumerate(rows)))
+
+
+@pytest.fixture
+def imported(referenties, csv_row):
+    list(BatchImporter().import_rows(enumerate([csv_row(1), csv_row(2), csv_row(3)])))
+
+
+@pytest.mark.django_db
+def test_preview_reports_changes_without_writing(imported, csv_row):
+    rows = [
+        csv_row(1),
+        csv_row(2, naam="Nieuwe naam", voorz="Fietsenstalling | Lift", bezit="Eigendom", straat="andere straat"),
+        csv_row(4, bouwjaar=""),
+        csv_row(3, soort="Onbekend"),
+        csv_row(2, afkorting="X2"),
+        csv_row(5, naam="Locatie 1"),
+        csv_row(6, bouwjaar="oud"),
+    ]
+    counts = (Adres.objects.count(), Vastgoed.objects.count(), Locatie.objects.count())
+
+    diffs = _preview(rows)
+
+    assert (Adres.objects.count(), Vastgoed.objects.count(), Locatie.objects.count()) == counts
+    assert Locatie.objects.get(pandcode=2).naam == "Locatie 2"
+    assert [(diff.index, diff.locatie_id, diff.status) for diff in diffs] == [
+        (0, "L1", RowDiff.UNCHANGED),
+        (1, "L2", RowDiff.UPDATED),
+        (2, "L4", RowDiff.CREATED),
+        (3, "L3", RowDiff.ERROR),
+        (4, "X2", RowDiff.ERROR),
+        (5, "L5", RowDiff.ERROR),
+        (6, "L6", RowDiff.ERROR),
+    ]
+    assert diffs[0].changes == {}
+    assert diffs[1].changes == {
+        "adres.straat": ("Straat", "Andere straat"),
+        "vastgoed.bezit": ("ntb", "Eigendom"),
+        "naam": ("Locatie 2", "Nieuwe naam"),
+        "voorzieningen": ("Fietsenstalling", "Fietsenstalling, Lift"),
+    }
+    assert diffs[2].changes["naam"] == (None, "Locatie 4")
+    assert diffs[2].changes["locatie_soort"] == (None, "Kantoor")
+    assert "vastgoed.bouwjaar" not in diffs[2].changes
+    assert list(diffs[3].errors) == ["locatie"]
+    assert diffs[4].errors == {"locatie": ["pandcode 2 hoort bij afkorting L2"]}
+    assert diffs[5].errors == {"locatie": ["de naam Locatie 1 is al in gebruik bij pandcode 1"]}
+    assert list(diffs[6].errors) == ["vastgoed"]
+
+
+@pytest.mark.django_db
+def test_preview_queries_do_not_grow_with_the_number_of_rows(referenties, csv_row):
+    list(BatchImporter().import_rows(enumerate([csv_row(nummer) for nummer in range(1, 201)])))
+
+    with CaptureQueriesContext(connection) as few_rows:
+        _preview([csv_row(nummer, naam=f"Nieuw {nummer}") for nummer in range(196, 206)])
+    with CaptureQueriesContext(connection) as many_rows:
+        diffs = _preview([csv_row(nummer, naam=f"Nieuw {nummer}") for nummer in range(1, 401)])
+
+    assert [diff.status for diff in diffs] == [RowDiff.UPDATED] * 200 + [RowDiff.CREATED] * 200
+    assert len(many_rows.captured_queries) == len(few_rows.captured_queries)
+
+
+@pytest.mark.django_db
+def test_import_view_dry_run_shows_preview(client, imported, csv_row):
+    client.force_login(User.objects.create(username="staff", is_staff=True))
+    header = ";".join(csv_row(1))
+    lines = [";".join(row.values()) for row in (csv_row(1, naam="Gewijzigd"), csv_row(4))]
+    csv_file = SimpleUploadedFile("locaties.csv", "\n".join([header, *lines]).encode("utf-8-sig"))
+
+    response = client.post(reverse("import_export_urls:locatie-import"), {"csv_file": csv_file, "dry_run": "on"})
+
+    content = response.content.decode()
+    assert response.status_code == 200
+    assert "Resultaat proefimport" in content
+    assert "Nieuw: 1, Gewijzigd: 1, Ongewijzigd: 0, Fout: 0" in content
+    assert "naam: Locatie 1 &rarr; Gewijzigd" in content
+    assert Locatie.objects.get(pandcode=1).naam == "Locatie 1"
+    assert not Locatie.objects.filter(pandcode=4).exists()
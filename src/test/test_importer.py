@@ -1,11 +1,23 @@
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
+from fblocatie.models import Locatie
 from import_export_csv.importer import ImporterProcessCSV
-from referentie_tabellen.models import Persoon
+from import_export_csv.lookups import PersoonResolver, ReferenceLookup
+from referentie_tabellen.models import (
+    DienstverleningsKader,
+    Directie,
+    GelieerdePartij,
+    LocatieBezit,
+    LocatieSoort,
+    Persoon,
+    ThemaPortefeuille,
+)
 
 
 def test_get_persoon_none():
-    obj, err = ImporterProcessCSV._get_persoon(None)
+    obj, err = ImporterProcessCSV()._get_persoon(None)
     assert obj is None
     assert err is None
 
@@ -13,14 +25,14 @@ def test_get_persoon_none():
 @pytest.mark.django_db
 def test_get_persoon_existing():
     p = Persoon.objects.create(voornaam="Jan", achternaam="Jansen")
-    obj, err = ImporterProcessCSV._get_persoon("Jan Jansen")
+    obj, err = ImporterProcessCSV()._get_persoon("Jan Jansen")
     assert err is None
     assert obj == p
 
 
 @pytest.mark.django_db
 def test_get_persoon_not_found():
-    obj, err = ImporterProcessCSV._get_persoon("Non Existent")
+    obj, err = ImporterProcessCSV()._get_persoon("Non Existent")
     assert obj is None
     assert isinstance(err, tuple)
     assert err[0] == "Non Existent"
@@ -29,7 +41,7 @@ def test_get_persoon_not_found():
 
 @pytest.mark.django_db
 def test_get_persoon_invalid_format():
-    obj, err = ImporterProcessCSV._get_persoon("SingleName")
+    obj, err = ImporterProcessCSV()._get_persoon("SingleName")
     assert obj is None
     assert isinstance(err, tuple)
     assert err[0] == "SingleName"
@@ -46,7 +58,7 @@ def test_get_persoon_invalid_format():
 )
 @pytest.mark.django_db
 def test_get_persoon_duo_persons(name):
-    obj, err = ImporterProcessCSV._get_persoon(name)
+    obj, err = ImporterProcessCSV()._get_persoon(name)
     assert obj is None
     assert isinstance(err, tuple)
     assert err[0] == name
@@ -81,3 +93,130 @@ def test_get_many_to_many_duo_persons(names, expected):
     assert isinstance(result, list)
     assert importer.error_list[0][0] == expected
     assert isinstance(importer.error_list[0][1], Persoon.DoesNotExist)
+
+
+@pytest.mark.django_db
+def test_reference_lookup_loads_each_table_once(django_assert_num_queries):
+    soort = LocatieSoort.objects.create(name="Kantoor")
+    LocatieSoort.objects.create(name="Loket")
+    directie = Directie.objects.create(name="Directie")
+    lookup = ReferenceLookup()
+
+    with django_assert_num_queries(2):
+        assert lookup.get_id(LocatieSoort, "Kantoor") == soort.id
+        assert lookup.get_id(LocatieSoort, "Kantoor") == soort.id
+        assert lookup.get_id(Directie, "Directie") == directie.id
+        with pytest.raises(LocatieSoort.DoesNotExist):
+            lookup.get_id(LocatieSoort, "Onbekend")
+
+
+@pytest.mark.django_db
+def test_reference_lookup_raises_like_get():
+    ThemaPortefeuille.objects.create(name="Dubbel")
+    ThemaPortefeuille.objects.create(name="Dubbel")
+    lookup = ReferenceLookup()
+
+    with pytest.raises(LocatieSoort.DoesNotExist) as lookup_error:
+        lookup.get_id(LocatieSoort, "Onbekend")
+    with pytest.raises(LocatieSoort.DoesNotExist) as get_error:
+        LocatieSoort.objects.get(name="Onbekend")
+    assert str(lookup_error.value) == str(get_error.value)
+
+    with pytest.raises(ThemaPortefeuille.MultipleObjectsReturned) as lookup_error:
+        lookup.get_id(ThemaPortefeuille, "Dubbel")
+    with pytest.raises(ThemaPortefeuille.MultipleObjectsReturned) as get_error:
+        ThemaPortefeuille.objects.get(name="Dubbel")
+    assert str(lookup_error.value) == str(get_error.value)
+
+
+@pytest.mark.django_db
+def test_get_referentietabellen_fields_sets_ids_and_reports_unknown_values():
+    soort = LocatieSoort.objects.create(name="Kantoor")
+    importer = ImporterProcessCSV()
+    referentie_tabellen = [("locatie_soort", LocatieSoort), ("gelieerd", GelieerdePartij)]
+
+    result = importer.get_referentietabellen_fields(referentie_tabellen, {"locatie_soort": "Kantoor", "gelieerd": "X"})
+
+    assert result == {"locatie_soort_id": soort.id, "gelieerd": None}
+    assert importer.error_list == [f" 'X' is niet aanwezig in de {GelieerdePartij} tabel"]
+
+
+@pytest.mark.django_db
+def test_get_many_to_many_resolves_names_and_reports_unknown_values():
+    directie = Directie.objects.create(name="Directie")
+    importer = ImporterProcessCSV()
+
+    result = importer._get_many_to_many(Directie, "Directie | Onbekend")
+
+    assert result == [directie.id]
+    assert importer.error_list == [f"Error 'Onbekend' from {Directie}: Directie matching query does not exist."]
+
+
+@pytest.mark.django_db
+def test_main_looks_up_referentie_tabellen_once_per_import():
+    LocatieSoort.objects.create(name="Kantoor")
+    Directie.objects.create(name="Directie")
+    DienstverleningsKader.objects.create(name="Basis", dvk_nr=1)
+    LocatieBezit.objects.create(name="ntb")
+    importer = ImporterProcessCSV()
+    rows = [
+        {
+            "pandcode": str(pandcode),
+            "naam": f"Locatie {pandcode}",
+            "afkorting": f"L{pandcode}",
+            "soort": "Kantoor",
+            "dvk_naam": "Basis",
+            "budget_dir": "Directie",
+            "vlekken": "Directie",
+            "straat": f"Straat {pandcode}",
+            "huisnummer": str(pandcode),
+            "bezit": "",
+        }
+        for pandcode in (1, 2, 3)
+    ]
+
+    with CaptureQueriesContext(connection) as context:
+        for row in rows:
+            importer.main(row)
+            assert importer.errors == {}
+
+    # Queries on a referentie tabel itself, not the joins of the many to many fields
+    reference_queries = [
+        q["sql"]
+        for q in context.captured_queries
+        if 'FROM "referentie_tabellen_' in q["sql"] and "JOIN" not in q["sql"]
+    ]
+    # One query for each of the tables LocatieSoort, DienstverleningsKader, Directie and LocatieBezit
+    assert len(reference_queries) == 4
+    assert Locatie.objects.filter(locatie_soort__name="Kantoor", budget_dir__name="Directie").count() == 3
+    assert Locatie.objects.get(pandcode=1).pand_directies.get().name == "Directie"
+
+
+@pytest.mark.django_db
+def test_persoon_resolver_loads_personen_once(django_assert_num_queries):
+    jan = Persoon.objects.create(voornaam="Jan", achternaam="de Vries")
+    piet = Persoon.objects.create(voornaam="Piet", achternaam="Jansen")
+    resolver = PersoonResolver()
+
+    with django_assert_num_queries(1):
+        assert resolver.get("Jan de Vries") == jan
+        assert resolver.get(" Piet  Jansen ") == piet
+        with pytest.raises(Persoon.DoesNotExist, match="Persoon matching query does not exist."):
+            resolver.get("Jan Jansen")
+        with pytest.raises(ValueError):
+            resolver.get("Jan")
+
+
+@pytest.mark.django_db
+def test_get_many_to_many_resolves_personen_with_one_query(django_assert_num_queries):
+    jan = Persoon.objects.create(voornaam="Jan", achternaam="Jansen")
+    piet = Persoon.objects.create(voornaam="Piet", achternaam="Jansen")
+    importer = ImporterProcessCSV()
+
+    with django_assert_num_queries(1):
+        assert importer._get_many_to_many(Persoon, "Jan Jansen | Piet Jansen") == [jan.id, piet.id]
+        assert importer._get_many_to_many(Persoon, "Piet Jansen|Onbekend Persoon") == [piet.id]
+        assert importer.get_referentietabellen_fields([("tom", Persoon)], {"tom": "Jan Jansen"}) == {"tom": jan}
+
+    assert importer.error_list[0][0] == "Onbekend Persoon"
+    assert isinstance(importer.error_list[0][1], Persoon.DoesNotExist)
@@ -1,8 +1,28 @@
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
 import pytest
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
 from model_bakery import baker
 
-from fblocatie.models import Adres, Locatie, Vastgoed, calc_lat_lon_from_geometry
+from fblocatie.models import (
+    Adres,
+    Locatie,
+    Vastgoed,
+    _calc_lat_lon,
+    calc_lat_lon_from_geometries,
+    calc_lat_lon_from_geometry,
+    compute_pandcode,
+    rd_to_wgs84,
+    relink_vastgoed,
+    reserve_pandcodes,
+)
+from referentie_tabellen.models import Voorziening
 
 
 @pytest.mark.parametrize(
@@ -22,6 +42,82 @@ def test_calc_lat_lon_from_geometry(test_x, test_y, expected):
     assert round(dict["lon"], 6) == expected["lon"]
 
 
+def test_rd_to_wgs84_is_built_once_per_thread():
+    transformation = rd_to_wgs84()
+
+    assert rd_to_wgs84() is transformation
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(rd_to_wgs84).result() is not transformation
+
+
+def test_calc_lat_lon_from_geometry_remembers_coordinates():
+    _calc_lat_lon.cache_clear()
+
+    first = calc_lat_lon_from_geometry(122324, 487928)
+    first["lat"] = 0
+    second = calc_lat_lon_from_geometry("122324", 487928.0)
+
+    assert _calc_lat_lon.cache_info().hits == 1
+    assert round(second["lat"], 6) == 52.378247
+
+
+def test_calc_lat_lon_from_geometries_matches_single_points():
+    coordinates = [(122324, 487928), (131508.0, 479894.0), (122324, 487928)]
+
+    assert calc_lat_lon_from_geometries(coordinates) == [calc_lat_lon_from_geometry(x, y) for x, y in coordinates]
+    assert calc_lat_lon_from_geometries([]) == []
+
+
+def test_normalize_many_sets_lat_lon_like_normalize():
+    adressen = [Adres(straat="straat", rd_x="122324", rd_y=487928), Adres(rd_x=None, rd_y=487928)]
+    single = Adres(straat="straat", rd_x="122324", rd_y=487928)
+
+    Adres.normalize_many(adressen)
+    single.normalize()
+
+    assert (adressen[0].straat, adressen[0].lat, adressen[0].lon, adressen[0].map_url) == (
+        single.straat,
+        single.lat,
+        single.lon,
+        single.map_url,
+    )
+    assert (adressen[1].lat, adressen[1].lon) == (None, None)
+
+
+@pytest.mark.django_db
+def test_backfill_coordinates_updates_adressen_without_lat_lon():
+    baker.make(Adres, rd_x=122324, rd_y=487928)
+    baker.make(Adres, rd_x=131508, rd_y=479894)
+    baker.make(Adres, rd_x=None, rd_y=None)
+    Adres.objects.filter(rd_x=122324).update(lat=None, lon=None, map_url="")
+    Adres.objects.filter(rd_x=131508).update(lat=1, lon=1)
+    out = io.StringIO()
+
+    call_command("backfill_coordinates", batch_size=1, stdout=out)
+
+    assert out.getvalue() == "Updated the coordinates of 1 adressen.\n"
+    assert list(Adres.objects.order_by("rd_x").values_list("lat", "lon")) == [
+        (52.378247, 4.907321),
+        (1, 1),
+        (None, None),
+    ]
+    assert "52.378247" in Adres.objects.get(rd_x=122324).map_url
+
+    call_command("backfill_coordinates", "--all", stdout=out)
+
+    assert Adres.objects.get(rd_x=131508).lat == 52.306511
+
+
+def test_benchmark_coordinates_reports_speedup():
+    out = io.StringIO()
+
+    call_command("benchmark_coordinates", points=20, stdout=out)
+
+    lines = [line.strip() for line in out.getvalue().splitlines()]
+    assert lines[0] == "20 points"
+    assert [line.split()[0] for line in lines[2:]] == ["uncached", "cached", "remembered", "batch"]
+
+
 @pytest.mark.parametrize(
     "test_x, test_y, expected",
     [
@@ -98,6 +194,175 @@ def test_save_vastgoed_matching_adres():
     assert locatie.vastgoed == vastgoed
 
 
+@pytest.mark.django_db
+def test_save_without_changes_does_nothing(django_assert_num_queries):
+    adres = baker.make(Adres, rd_x=122324, rd_y=487928)
+    baker.make(Vastgoed, adres=adres)
+    baker.make(Locatie, adres=adres)
+    locatie, adres, vastgoed = Locatie.objects.get(), Adres.objects.get(), Vastgoed.objects.get()
+
+    with django_assert_num_queries(0):
+        locatie.save()
+        adres.save()
+        vastgoed.save()
+
+
+@pytest.mark.django_db
+def test_save_with_the_same_values_as_text_does_nothing(django_assert_num_queries):
+    vastgoed = baker.make(Vastgoed, bouwjaar=1990, vvo="12.50")
+    vastgoed = Vastgoed.objects.get(pk=vastgoed.pk)
+
+    # Like the values of an import file
+    vastgoed.bouwjaar = "1990"
+    vastgoed.vvo = "12.5"
+    with django_assert_num_queries(0):
+        vastgoed.save()
+
+
+@pytest.mark.django_db
+def test_save_writes_only_changed_fields():
+    baker.make(Locatie, naam="Oud", beschrijving="Beschrijving")
+    Locatie.objects.update(import_fingerprint="abc")
+    locatie = Locatie.objects.get()
+    updated_at = locatie.updated_at
+
+    locatie.naam = "Nieuw"
+    with CaptureQueriesContext(connection) as queries:
+        locatie.save()
+
+    sql = [query["sql"] for query in queries.captured_queries]
+    assert len(sql) == 1
+    assert sql[0].startswith('UPDATE "fblocatie_locatie" SET ')
+    assert {'"naam"', '"import_fingerprint"', '"updated_at"'} == set(
+        re.findall(r'"\w+"(?= = )', sql[0].split(" WHERE ")[0])
+    )
+    assert Locatie.objects.values_list("naam", "import_fingerprint").get() == ("Nieuw", "")
+    assert Locatie.objects.get().updated_at > updated_at
+
+
+@pytest.mark.django_db
+def test_changing_links_marks_the_locatie_as_changed():
+    voorziening = Voorziening.objects.create(name="Lift")
+    locatie, other = baker.make(Locatie, _quantity=2)
+    Locatie.objects.update(import_fingerprint="abc")
+    updated_at = dict(Locatie.objects.values_list("pandcode", "updated_at"))
+    locatie = Locatie.objects.get(pk=locatie.pk)
+
+    # Like an admin edit of only the links: the save writes nothing, then the links are set
+    locatie.save()
+    locatie.voorzieningen.set([voorziening])
+
+    assert Locatie.objects.values_list("import_fingerprint", flat=True).get(pk=locatie.pk) == ""
+    assert Locatie.objects.get(pk=locatie.pk).updated_at > updated_at[locatie.pk]
+    assert Locatie.objects.values_list("import_fingerprint", flat=True).get(pk=other.pk) == "abc"
+
+    other.voorzieningen.add(voorziening)
+    Locatie.objects.update(import_fingerprint="abc")
+    voorziening.locatie_set.clear()
+
+    assert set(Locatie.objects.values_list("import_fingerprint", flat=True)) == {""}
+    assert not Locatie.voorzieningen.through.objects.exists()
+
+
+@pytest.mark.django_db
+def test_reading_a_deferred_field_keeps_the_changes_of_other_fields():
+    baker.make(Locatie, naam="Oud", beschrijving="Beschrijving")
+    locatie = Locatie.objects.only("pandcode", "naam").get()
+
+    locatie.naam = "Nieuw"
+    assert locatie.beschrijving == "Beschrijving"
+    locatie.save()
+
+    assert Locatie.objects.values_list("naam", "beschrijving").get() == ("Nieuw", "Beschrijving")
+    assert locatie.changed_fields() == []
+
+
+@pytest.mark.django_db
+def test_adres_save_transforms_only_changed_coordinates():
+    baker.make(Adres, rd_x=122324, rd_y=487928)
+    adres = Adres.objects.get()
+
+    adres.straat = "Andere straat"
+    with patch("fblocatie.models.calc_lat_lon_from_geometry") as calc_lat_lon:
+        adres.save()
+        calc_lat_lon.assert_not_called()
+
+    adres.rd_x, adres.rd_y = 131508, 479894
+    adres.save()
+    assert Adres.objects.values_list("straat", "lat", "lon").get() == ("Andere straat", 52.306511, 5.042756)
+
+
+@pytest.mark.django_db
+def test_locatie_save_links_vastgoed_of_changed_adres():
+    adres, other_adres = baker.make(Adres, _quantity=2)
+    vastgoed = baker.make(Vastgoed, adres=other_adres)
+    baker.make(Locatie, adres=adres)
+    locatie = Locatie.objects.get()
+
+    locatie.adres = other_adres
+    locatie.save()
+
+    assert Locatie.objects.get().vastgoed == vastgoed
+
+
+@pytest.mark.django_db
+def test_new_vastgoed_is_linked_to_the_locaties_at_its_adres():
+    locatie = baker.make(Locatie)
+
+    vastgoed = baker.make(Vastgoed, adres=locatie.adres)
+
+    assert Locatie.objects.get().vastgoed == vastgoed
+
+
+@pytest.mark.django_db
+def test_relink_vastgoed_links_all_locaties_with_one_query(django_assert_num_queries):
+    adres, other_adres, without_vastgoed = baker.make(Adres, _quantity=3)
+    vastgoed = baker.make(Vastgoed, adres=adres)
+    other_vastgoed = baker.make(Vastgoed, adres=other_adres)
+    unlinked = baker.make(Locatie, adres=adres)
+    linked = baker.make(Locatie, adres=other_adres)
+    wrongly_linked = baker.make(Locatie, adres=without_vastgoed)
+    Locatie.objects.filter(pk=unlinked.pk).update(vastgoed=None)
+    Locatie.objects.filter(pk=wrongly_linked.pk).update(vastgoed=vastgoed)
+
+    with django_assert_num_queries(1):
+        assert relink_vastgoed() == 2
+
+    assert dict(Locatie.objects.values_list("pandcode", "vastgoed")) == {
+        unlinked.pk: vastgoed.pk,
+        linked.pk: other_vastgoed.pk,
+        wrongly_linked.pk: None,
+    }
+    assert relink_vastgoed() == 0
+
+
+@pytest.mark.django_db
+def test_moving_vastgoed_to_another_adres_relinks_locaties():
+    adres, other_adres = baker.make(Adres, _quantity=2)
+    baker.make(Vastgoed, adres=adres)
+    locatie, other_locatie = baker.make(Locatie, adres=adres), baker.make(Locatie, adres=other_adres)
+    vastgoed = Vastgoed.objects.get()
+
+    vastgoed.adres = other_adres
+    vastgoed.save()
+
+    assert Locatie.objects.get(pk=locatie.pk).vastgoed is None
+    assert Locatie.objects.get(pk=other_locatie.pk).vastgoed == vastgoed
+
+
+@pytest.mark.django_db
+def test_relink_vastgoed_command():
+    locatie = baker.make(Locatie)
+    vastgoed = baker.make(Vastgoed, adres=locatie.adres)
+    Locatie.objects.update(vastgoed=None)
+    out = io.StringIO()
+
+    call_command("relink_vastgoed", stdout=out)
+
+    assert out.getvalue() == "Linked 1 locaties to the vastgoed at their adres.\n"
+    assert Locatie.objects.get().vastgoed == vastgoed
+
+
 @pytest.mark.django_db
 def test_adres_unique_case_insensitive():
 
@@ -121,3 +386,55 @@ def test_adres_unique_case_insensitive():
     adres1.save()
     with pytest.raises(ValidationError):
         adres2.clean()
+
+
+@pytest.mark.django_db
+def test_reserve_pandcodes_allocates_new_pandcodes():
+    first = compute_pandcode()
+    reserved = reserve_pandcodes(3)
+
+    assert reserved == sorted(reserved)
+    assert first < reserved[0]
+    assert len(set(reserved)) == 3
+    assert reserve_pandcodes(1)[0] > reserved[-1]
+
+
+@pytest.mark.django_db
+def test_locatie_with_chosen_pandcode_advances_pandcode_sequence():
+    pandcode = compute_pandcode() + 100
+
+    baker.make(Locatie, pandcode=pandcode)
+    baker.make(Locatie, pandcode=pandcode - 50)
+
+    assert compute_pandcode() == pandcode + 1
+    assert baker.make(Locatie).pandcode == pandcode + 2
+
+
+@pytest.mark.django_db
+def test_locatie_allocates_pandcode_when_saved():
+    with CaptureQueriesContext(connection) as context:
+        assert Locatie().pandcode is None
+    assert not context.captured_queries
+
+    locatie = baker.prepare(Locatie, _save_related=True)
+
+    pandcode = compute_pandcode()
+    with CaptureQueriesContext(connection) as context:
+        locatie.save()
+
+    assert locatie.pandcode == pandcode + 1
+    assert not [q for q in context.captured_queries if "setval" in q["sql"]]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reserve_pandcodes_concurrently_allocates_different_pandcodes():
+    def reserve(count):
+        try:
+            return reserve_pandcodes(count)
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        reserved = [pandcode for pandcodes in executor.map(reserve, [25] * 8) for pandcode in pandcodes]
+
+    assert len(set(reserved)) == 200
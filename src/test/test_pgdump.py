@@ -1,141 +1,303 @@
 import csv
+import hashlib
 import io
-import os
+import zipfile
+from types import SimpleNamespace
 from unittest.mock import patch
 
 import pytest
-from django.core.management import call_command
-from django.http import HttpResponse
+from azure.core.exceptions import ResourceNotFoundError
+from django.core.management import CommandError, call_command
 from model_bakery import baker
 
 from fblocatie.management.commands.pgdump import Command as PgDumpCommand
+from fblocatie.management.commands.pgdump import OverwriteStorage, get_dump_models, iter_zip
 from fblocatie.models import Adres, Locatie
-from referentie_tabellen.models import DienstverleningsKader, LocatieSoort
+from referentie_tabellen.models import DienstverleningsKader, Directie, LocatieSoort
+
+
+class FakeBlobClient:
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+
+    def stage_block(self, block_id, data):
+        self.container.staged.setdefault(self.name, {})[block_id] = data
+
+    def commit_block_list(self, block_ids, metadata=None, **kwargs):
+        staged = self.container.staged.pop(self.name)
+        self.container.blobs[self.name] = b"".join(staged[block_id] for block_id in block_ids)
+        self.container.metadata[self.name] = metadata or {}
+        self.container.commits.append((self.name, list(block_ids), kwargs))
+
+    def get_blob_properties(self):
+        if self.name not in self.container.blobs:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return SimpleNamespace(metadata=self.container.metadata[self.name])
+
+
+class FakeContainerClient:
+    """In-process stand-in for an Azure container, with the block blob API used by OverwriteStorage"""
+
+    def __init__(self):
+        self.staged = {}
+        self.blobs = {}
+        self.metadata = {}
+        self.commits = []
+
+    def get_blob_client(self, name):
+        return FakeBlobClient(self, name)
+
+
+class FakeBlobStorage:
+    container = None
+
+    def __init__(self, **kwargs):
+        self.client = FakeBlobStorage.container
+
+    def _get_valid_path(self, name):
+        return f"pgdump/{name}"
+
+
+def _decode_csv(content: bytes) -> list[dict]:
+    return list(csv.DictReader(io.StringIO(content.decode("utf-8-sig")), delimiter=";"))
+
+
+def _decode_table(content: bytes) -> list[dict]:
+    return list(csv.DictReader(io.StringIO(content.decode("utf-8"))))
 
 
 class TestPgDumpCommand:
     @pytest.fixture()
-    def command(self, tmp_path):
-        command = PgDumpCommand()
-        command.TMP_DIRECTORY = str(tmp_path / "tmp_pgdump")
-        command.EXPORT_FILE_NAME = "all_locations.csv"
-        return command
-
-    def _dummy_csv_response(self, content: bytes = b"\xef\xbb\xbfcol_a;col_b\n1;2\n"):
-        response = HttpResponse(content_type="text/csv; charset=utf-8")
-        response.write(content)
-        return response
-
-    @pytest.mark.django_db
-    def test_create_export_csv(self, command):
+    def filesystem_storage(self, settings, tmp_path):
+        settings.STORAGES = {
+            **settings.STORAGES,
+            "pgdump": {"BACKEND": "django.core.files.storage.FileSystemStorage", "OPTIONS": {"location": tmp_path}},
+        }
+        return tmp_path
+
+    @pytest.fixture()
+    def blob_storage(self, settings):
+        FakeBlobStorage.container = FakeContainerClient()
+        settings.STORAGES = {
+            **settings.STORAGES,
+            "pgdump": {"BACKEND": f"{__name__}.FakeBlobStorage", "OPTIONS": {}},
+        }
+        return FakeBlobStorage.container
+
+    @pytest.fixture()
+    def locaties(self):
         locatie_soort = LocatieSoort.objects.create(name="Soort 1")
         dvk = DienstverleningsKader.objects.create(name="DVK 1", dvk_nr=1)
+        return [
+            baker.make(
+                Locatie,
+                pandcode=pandcode,
+                naam=f"Locatie {pandcode}",
+                afkorting=f"L{pandcode}",
+                adres=baker.make(Adres, straat=f"Straat {pandcode}", huisnummer=pandcode),
+                locatie_soort=locatie_soort,
+                dvk_naam=dvk,
+            )
+            for pandcode in range(1, 6)
+        ]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_pgdump_streams_export_to_filesystem_storage(self, filesystem_storage, locaties):
+        call_command("pgdump")
+
+        assert sorted(p.name for p in filesystem_storage.iterdir()) == ["all_locations.csv", "pgdump.zip"]
+        content = (filesystem_storage / "all_locations.csv").read_bytes()
+        assert content.startswith(b"\xef\xbb\xbf")
+
+        rows = _decode_csv(content)
+        assert [row["pandcode"] for row in rows] == ["1", "2", "3", "4", "5"]
+        assert rows[0]["naam"] == "Locatie 1"
+        assert rows[0]["straat"] == "Straat 1"
+
+    @pytest.mark.django_db(transaction=True)
+    def test_pgdump_overwrites_existing_file(self, filesystem_storage, locaties):
+        (filesystem_storage / "all_locations.csv").write_bytes(b"old content that is longer than the new file" * 100)
 
-        adres = baker.make(
-            Adres,
-            straat="Straat 1",
-            postcode="1234AB",
-            huisnummer=1,
-            woonplaats="Amsterdam",
-            map_url="https://example.com/maps",
+        call_command("pgdump", columns=["pandcode"])
+
+        content = (filesystem_storage / "all_locations.csv").read_bytes()
+        assert content == "\ufeffpandcode\r\n1\r\n2\r\n3\r\n4\r\n5\r\n".encode()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_pgdump_streams_export_as_blob_blocks(self, blob_storage, locaties):
+        # Small chunks and blocks; the export is uploaded in several blocks instead of one file
+        with (
+            patch.object(PgDumpCommand, "CHUNK_SIZE", 2),
+            patch.object(OverwriteStorage, "BLOCK_SIZE", 64),
+        ):
+            call_command("pgdump", columns=["pandcode", "naam"])
+
+        assert blob_storage.staged == {}
+        assert list(blob_storage.blobs) == ["pgdump/all_locations.csv", "pgdump/pgdump.zip"]
+        name, block_ids, kwargs = blob_storage.commits[0]
+        assert len(block_ids) > 1
+        assert kwargs["content_settings"].content_type == "text/csv"
+        assert blob_storage.commits[1][2]["content_settings"].content_type == "application/zip"
+
+        rows = _decode_csv(blob_storage.blobs["pgdump/all_locations.csv"])
+        assert rows == [{"pandcode": str(i), "naam": f"Locatie {i}"} for i in range(1, 6)]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_pgdump_reports_uploaded_size(self, blob_storage, locaties):
+        out = io.StringIO()
+
+        call_command("pgdump", stdout=out)
+
+        content = blob_storage.blobs["pgdump/all_locations.csv"]
+        sha256 = hashlib.sha256(content).hexdigest()
+        assert (
+            f"Successfully uploaded all_locations.csv ({len(content)} bytes, sha256 {sha256}) to Azure Storage in "
+            in (out.getvalue())
         )
+        assert blob_storage.metadata["pgdump/all_locations.csv"] == {"sha256": sha256}
+        assert "Data dump completed successfully." in out.getvalue()
+
+    def test_save_stream_stages_an_empty_block_for_empty_streams(self, blob_storage):
+        assert OverwriteStorage().save_stream("empty.csv", iter([])) == (0, hashlib.sha256(b"").hexdigest(), True)
+        assert blob_storage.blobs == {"pgdump/empty.csv": b""}
+
+    @pytest.mark.django_db(transaction=True)
+    def test_pgdump_skips_unchanged_blob_export(self, blob_storage, locaties):
+        call_command("pgdump", columns=["pandcode", "naam"])
+        out = io.StringIO()
+
+        call_command("pgdump", columns=["pandcode", "naam"], stdout=out)
+
+        # Only the first run committed the export, the second only staged it
+        assert [commit[0] for commit in blob_storage.commits].count("pgdump/all_locations.csv") == 1
+        assert "Skipped upload of all_locations.csv: unchanged (" in out.getvalue()
 
-        locatie = baker.make(
-            Locatie,
-            naam="Locatie 1",
-            afkorting="L1",
-            adres=adres,
-            locatie_soort=locatie_soort,
-            dvk_naam=dvk,
+        Locatie.objects.filter(pandcode=1).update(naam="Gewijzigd")
+        out = io.StringIO()
+
+        call_command("pgdump", columns=["pandcode", "naam"], stdout=out)
+
+        assert [commit[0] for commit in blob_storage.commits].count("pgdump/all_locations.csv") == 2
+        assert "Successfully uploaded all_locations.csv (" in out.getvalue()
+        assert b"Gewijzigd" in blob_storage.blobs["pgdump/all_locations.csv"]
+
+    def test_save_stream_skips_unchanged_file(self, filesystem_storage):
+        path = filesystem_storage / "all_locations.csv"
+        path.write_bytes(b"same content")
+        storage = OverwriteStorage()
+
+        assert storage.save_stream("all_locations.csv", iter([b"same ", b"content"]), skip_unchanged=True) == (
+            12,
+            hashlib.sha256(b"same content").hexdigest(),
+            False,
         )
+        assert sorted(p.name for p in filesystem_storage.iterdir()) == ["all_locations.csv"]
+
+        _, _, replaced = storage.save_stream("all_locations.csv", iter([b"new content"]), skip_unchanged=True)
+        assert replaced
+        assert path.read_bytes() == b"new content"
+
+        # Without skip_unchanged the file is always replaced
+        assert storage.save_stream("all_locations.csv", iter([b"new content"]))[2]
 
-        command.create_export_csv()
+    def test_save_stream_keeps_existing_file_when_generation_fails(self, filesystem_storage):
+        (filesystem_storage / "all_locations.csv").write_bytes(b"previous export")
 
-        file_path = os.path.join(command.TMP_DIRECTORY, command.EXPORT_FILE_NAME)
-        with open(file_path, "rb") as f:
-            decoded = f.read().decode("utf-8-sig")
+        def failing_chunks():
+            yield b"partial"
+            raise RuntimeError("database gone")
 
-        reader = csv.DictReader(io.StringIO(decoded), delimiter=";")
-        assert reader.fieldnames is not None
-        assert "pandcode" in reader.fieldnames
-        assert "naam" in reader.fieldnames
+        with pytest.raises(RuntimeError):
+            OverwriteStorage().save_stream("all_locations.csv", failing_chunks())
 
-        rows = list(reader)
-        assert len(rows) == 1
-        assert rows[0]["pandcode"] == str(locatie.pandcode)
-        assert rows[0]["naam"] == locatie.naam
+        assert sorted(p.name for p in filesystem_storage.iterdir()) == ["all_locations.csv"]
+        assert (filesystem_storage / "all_locations.csv").read_bytes() == b"previous export"
 
+    def test_save_stream_requires_streaming_support(self, filesystem_storage):
+        storage = OverwriteStorage()
+        with patch.object(storage.storage, "path", side_effect=NotImplementedError):
+            with pytest.raises(NotImplementedError, match="does not support streaming uploads"):
+                storage.save_stream("all_locations.csv", iter([b"x"]))
+
+    @patch.object(PgDumpCommand, "upload_dump_zip")
     @patch("fblocatie.management.commands.pgdump.fetch_locations_for_export")
-    @patch("fblocatie.management.commands.pgdump.get_csv_response")
-    def test_create_export_csv_writes_single_csv_file(self, mock_get_csv_response, mock_fetch, command):
-        mock_fetch.return_value = []
-        mock_get_csv_response.return_value = self._dummy_csv_response()
+    @patch("fblocatie.management.commands.pgdump.iter_csv")
+    def test_pgdump_command_passes_selected_columns(self, mock_iter_csv, mock_fetch, mock_dump, filesystem_storage):
+        mock_iter_csv.return_value = iter([b"pandcode;naam\r\n"])
 
-        command.create_export_csv()
+        call_command("pgdump", columns=["pandcode", "naam"])
 
-        assert os.path.isdir(command.TMP_DIRECTORY)
+        mock_fetch.assert_called_once_with(["pandcode", "naam"])
+        assert mock_iter_csv.call_args.args[1] == ["pandcode", "naam"]
 
-        file_path = os.path.join(command.TMP_DIRECTORY, command.EXPORT_FILE_NAME)
-        assert os.path.isfile(file_path)
+    def test_pgdump_command_rejects_unknown_columns(self):
+        with pytest.raises(CommandError, match="onbekend"):
+            call_command("pgdump", columns=["onbekend"])
 
-        with open(file_path, "rb") as f:
-            content = f.read()
+    def test_pgdump_command_rejects_invalid_workers(self):
+        with pytest.raises(CommandError, match="--workers"):
+            call_command("pgdump", workers=0)
 
-        assert content.startswith(b"\xef\xbb\xbf")
-        assert b"col_a;col_b" in content
+    def test_pgdump_command_rejects_invalid_processes(self):
+        with pytest.raises(CommandError, match="--processes"):
+            call_command("pgdump", processes=0)
 
-    @patch("fblocatie.management.commands.pgdump.fetch_locations_for_export")
-    @patch("fblocatie.management.commands.pgdump.get_csv_response")
-    def test_create_export_csv_overwrites_existing_file(self, mock_get_csv_response, mock_fetch, command):
-        mock_fetch.return_value = []
+    @pytest.mark.django_db(transaction=True)
+    @patch.object(PgDumpCommand, "upload_dump_zip")
+    def test_pgdump_builds_export_in_parallel_processes(self, mock_dump, filesystem_storage, locaties):
+        call_command("pgdump", processes=1)
+        serial = (filesystem_storage / "all_locations.csv").read_bytes()
+        (filesystem_storage / "all_locations.csv").unlink()
 
-        first = self._dummy_csv_response(b"\xef\xbb\xbfcol_a;col_b\nfirst;1\n")
-        second = self._dummy_csv_response(b"\xef\xbb\xbfcol_a;col_b\nsecond;2\n")
-        mock_get_csv_response.side_effect = [first, second]
+        with patch("import_export_csv.exporter.SHARD_ROWS", 2):
+            call_command("pgdump", processes=2)
 
-        command.create_export_csv()
-        command.create_export_csv()
+        assert (filesystem_storage / "all_locations.csv").read_bytes() == serial
 
-        file_path = os.path.join(command.TMP_DIRECTORY, command.EXPORT_FILE_NAME)
-        with open(file_path, "rb") as f:
-            content = f.read()
+    def test_get_dump_models_includes_many_to_many_tables(self):
+        tables = {model._meta.db_table for model in get_dump_models()}
 
-        assert content == second.content
+        assert {"fblocatie_locatie", "fblocatie_adres", "referentie_tabellen_persoon"} <= tables
+        assert {"fblocatie_locatie_pand_directies", "fblocatie_locatie_loc_manager"} <= tables
+        assert not any(table.startswith("auth_") for table in tables)
 
-    @patch("fblocatie.management.commands.pgdump.OverwriteStorage.save_without_postfix")
-    def test_upload_to_blob_uploads_single_file(self, mock_save, command):
-        os.makedirs(command.TMP_DIRECTORY, exist_ok=True)
-        file_path = os.path.join(command.TMP_DIRECTORY, command.EXPORT_FILE_NAME)
-        with open(file_path, "wb") as f:
-            f.write(b"dummy")
+    @pytest.mark.django_db(transaction=True)
+    def test_pgdump_dumps_all_tables_into_zip(self, filesystem_storage, locaties):
+        directie = Directie.objects.create(name="Directie 1")
+        locaties[0].pand_directies.add(directie)
+        out = io.StringIO()
 
-        command.upload_to_blob()
+        call_command("pgdump", workers=2, stdout=out)
 
-        assert mock_save.call_count == 1
-        kwargs = mock_save.call_args.kwargs
-        assert kwargs["name"] == command.EXPORT_FILE_NAME
-        assert hasattr(kwargs["content"], "read")
+        with zipfile.ZipFile(filesystem_storage / "pgdump.zip") as archive:
+            assert set(archive.namelist()) == {f"{model._meta.db_table}.csv" for model in get_dump_models()}
+            locatie_rows = _decode_table(archive.read("fblocatie_locatie.csv"))
+            through_rows = _decode_table(archive.read("fblocatie_locatie_pand_directies.csv"))
+            empty_rows = _decode_table(archive.read("referentie_tabellen_persoon.csv"))
 
-    def test_remove_dump_deletes_temporary_directory(self, command):
-        os.makedirs(command.TMP_DIRECTORY, exist_ok=True)
-        command.remove_dump()
+        assert [row["pandcode"] for row in locatie_rows] == ["1", "2", "3", "4", "5"]
+        assert [row["naam"] for row in locatie_rows] == [f"Locatie {i}" for i in range(1, 6)]
+        assert through_rows == [
+            {
+                "id": str(locaties[0].pand_directies.through.objects.get().pk),
+                "locatie_id": "1",
+                "directie_id": str(directie.pk),
+            }
+        ]
+        assert empty_rows == []
 
-        assert not os.path.exists(command.TMP_DIRECTORY)
+        output = out.getvalue()
+        assert "Dumped fblocatie_locatie: 5 rows in " in output
+        assert "Dumped fblocatie_locatie_pand_directies: 1 rows in " in output
+        assert "Successfully uploaded pgdump.zip (" in output
 
-    @patch("fblocatie.management.commands.pgdump.fetch_locations_for_export")
-    @patch("fblocatie.management.commands.pgdump.get_csv_response")
-    @patch("fblocatie.management.commands.pgdump.OverwriteStorage.save_without_postfix")
-    def test_pgdump_command_end_to_end(self, mock_save, mock_get_csv_response, mock_fetch, tmp_path):
-        # Patch the command's temp directory to keep the test isolated.
-        tmp_directory = str(tmp_path / "tmp_pgdump")
-        with (
-            patch.object(PgDumpCommand, "TMP_DIRECTORY", tmp_directory),
-            patch.object(PgDumpCommand, "EXPORT_FILE_NAME", "all_locations.csv"),
-        ):
-            mock_fetch.return_value = []
-            mock_get_csv_response.return_value = self._dummy_csv_response()
+    def test_iter_zip_streams_entries(self):
+        files = [("a.csv", io.BytesIO(b"a;b\r\n1;2\r\n")), ("empty.csv", io.BytesIO(b""))]
 
-            call_command("pgdump")
+        content = b"".join(iter_zip(files))
 
-        assert mock_save.call_count == 1
-        assert not os.path.isdir(tmp_directory)
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            assert archive.namelist() == ["a.csv", "empty.csv"]
+            assert archive.read("a.csv") == b"a;b\r\n1;2\r\n"
+            assert archive.read("empty.csv") == b""
@@ -0,0 +1,193 @@
+import threading
+import time
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, connections
+from django.urls import reverse
+from model_bakery import baker
+
+from fblocatie.models import Adres, Locatie
+from referentie_tabellen.models import DienstverleningsKader, LocatieSoort
+from shared.locks import advisory_lock, advisory_lock_id, try_advisory_lock
+from shared.singleflight import SHARED_CACHE, single_flight, single_flight_key
+
+
+def _make_locatie(pandcode: int, naam: str) -> Locatie:
+    return baker.make(
+        Locatie,
+        pandcode=pandcode,
+        naam=naam,
+        afkorting=f"L{pandcode}",
+        adres=baker.make(Adres, huisnummer=pandcode),
+        locatie_soort=LocatieSoort.objects.create(name=f"Soort {pandcode}"),
+        dvk_naam=DienstverleningsKader.objects.create(name=f"DVK {pandcode}", dvk_nr=pandcode),
+    )
+
+
+def test_advisory_lock_id_is_stable_signed_64_bit():
+    assert advisory_lock_id("export") == advisory_lock_id("export")
+    assert advisory_lock_id("export") != advisory_lock_id("search")
+    assert -(2**63) <= advisory_lock_id("export") < 2**63
+
+
+def test_single_flight_key_ignores_argument_order():
+    assert single_flight_key("x", a=1, b={"c": 2, "d": 3}) == single_flight_key("x", b={"d": 3, "c": 2}, a=1)
+    assert single_flight_key("x", a=1) != single_flight_key("x", a=2)
+    assert single_flight_key("x", a=1).startswith("x:")
+
+
+@pytest.mark.django_db
+def test_advisory_lock_is_released_after_the_context():
+    lock_id = advisory_lock_id("test-lock")
+    query = "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()"
+
+    with advisory_lock("test-lock"):
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            assert cursor.fetchone()[0] == 1
+
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        assert cursor.fetchone()[0] == 0
+        cursor.execute("SELECT pg_try_advisory_lock(%s), pg_advisory_unlock(%s)", [lock_id, lock_id])
+        assert cursor.fetchone() == (True, True)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_try_advisory_lock_does_not_wait_for_another_session():
+    locked, release = threading.Event(), threading.Event()
+    waits = []
+
+    def hold():
+        try:
+            with advisory_lock("test-lock"):
+                locked.set()
+                release.wait(10)
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    locked.wait(10)
+    try:
+        with try_advisory_lock("test-lock") as acquired:
+            assert not acquired
+    finally:
+        threading.Timer(0.2, release.set).start()
+        with advisory_lock("test-lock", on_wait=lambda: waits.append(1)):
+            pass
+        thread.join()
+
+    assert waits == [1]
+    with try_advisory_lock("test-lock") as acquired:
+        assert acquired
+
+
+@pytest.mark.django_db
+def test_single_flight_reuses_cached_result():
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"value": len(calls)}
+
+    assert single_flight("test:reuse", compute) == {"value": 1}
+    assert single_flight("test:reuse", compute) == {"value": 1}
+    assert len(calls) == 1
+
+
+@pytest.mark.django_db
+def test_single_flight_does_not_cache_failures():
+    def fail():
+        raise RuntimeError("kapot")
+
+    with pytest.raises(RuntimeError):
+        single_flight("test:failure", fail)
+
+    assert single_flight("test:failure", lambda: "ok") == "ok"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_single_flight_computes_concurrent_calls_once():
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return "result"
+
+    def worker():
+        try:
+            results.append(single_flight("test:concurrent", compute))
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    caches[SHARED_CACHE].clear()
+    assert results == ["result"] * 4
+    assert len(calls) == 1
+
+
+@pytest.mark.django_db
+def test_coalesced_search_filter_matches_search_filter(django_assert_num_queries):
+    user = User.objects.create(username="staff", is_staff=True)
+    foo = _make_locatie(1, "Foo")
+    _make_locatie(2, "Bar")
+    params = {"property": "naam", "search": "Foo", "page": "1"}
+
+    assert list(Locatie.objects.coalesced_search_filter(params, user)) == [foo]
+
+    # The matching pandcodes are reused from the shared cache, also when other params differ
+    with django_assert_num_queries(2):
+        result = Locatie.objects.coalesced_search_filter({**params, "page": "2"}, user)
+        assert list(result) == [foo]
+
+
+@pytest.mark.django_db
+def test_coalesced_search_filter_shares_results_only_briefly(settings):
+    settings.SINGLE_FLIGHT_SEARCH_TIMEOUT = 1
+    user = User.objects.create(username="staff", is_staff=True)
+    foo = _make_locatie(1, "Foo")
+    params = {"property": "naam", "search": "Foo"}
+    assert list(Locatie.objects.coalesced_search_filter(params, user)) == [foo]
+
+    foo_bar = _make_locatie(2, "Foo bar")
+    time.sleep(1.1)
+
+    assert list(Locatie.objects.coalesced_search_filter(params, user)) == [foo, foo_bar]
+
+
+@pytest.mark.django_db
+def test_coalesced_search_filter_without_search_term_is_not_cached():
+    user = User.objects.create(username="user", is_staff=False)
+    foo = _make_locatie(1, "Foo")
+
+    qs = Locatie.objects.coalesced_search_filter({"archive": "all"}, user)
+
+    assert "IN" not in str(qs.query)
+    assert list(qs) == [foo]
+
+
+@pytest.mark.django_db
+def test_export_view_reuses_identical_export(client, settings):
+    settings.EXPORT_ASYNC_THRESHOLD = 10
+    client.force_login(User.objects.create(username="staff", is_staff=True))
+    _make_locatie(1, "Foo")
+    url = reverse("import_export_urls:locatie-export")
+
+    first = client.get(url, {"search": "Foo", "columns": ["naam"]})
+    Locatie.objects.filter(pk=1).update(naam="Foo gewijzigd")
+    second = client.get(url, {"search": "Foo", "columns": ["naam"]})
+    other = client.get(url, {"search": "Foo", "columns": ["pandcode", "naam"]})
+
+    assert first.content == second.content == "\ufeffnaam\r\nFoo\r\n".encode("utf-8")
+    assert other.content == "\ufeffpandcode;naam\r\n1;Foo gewijzigd\r\n".encode("utf-8")
+    assert second["Content-Disposition"].startswith('attachment; filename="locaties_export_')